@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import io
+import json
+import math
+import platform
+import random
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import route_service
+
+# Benchmarks of route_service on synthetic networks, from a few routes up to 10k routes and 100k stops, written as
+# JSON so runs (and planner engines) can be compared. For example:
+#   python benchmark.py --routes 100 1000 10000 --topology radial --output bench.json
+#   python benchmark.py --routes 100 1000 --baseline bench.json  # exits 1 if a benchmark got slower
+#   python benchmark.py --load --routes 1000 --latency 0.02 --page-size 500  # loading from a local stand-in API
+
+TOPOLOGIES = ("grid", "radial")
+# Every route of a radial network branches into up to this many routes
+RADIAL_BRANCHING = 4
+ENGINES = ("network", "batch", "table", "generic")
+
+
+###
+# Synthetic Networks
+###
+def synthetic_network(
+        routes: int = 100, stops_per_route: int = 10, transfer_density: float = 0.5, topology: str = "grid", seed: int = 0
+) -> Tuple[List[dict], List[List[dict]]]:
+    """
+    JSON:API route and stop resources, shaped like the MBTA API's, of a synthetic network: routes[i] serves the stops
+    in route_stops[i], every route stops_per_route of them counting those it shares with other routes.
+
+    A grid lays the routes out on a square lattice. Each route shares a stop with its neighbours in its row, and with
+    the route below it with probability transfer_density (always in the first column, so the network is connected).
+    Trips take about sqrt(routes) transfers.
+
+    A radial network is a tree of routes: RADIAL_BRANCHING trunk routes meet at a central stop, and every other route
+    shares a stop with the route it branches from, and with the next route with probability transfer_density. Trips
+    take about log(routes) transfers.
+    """
+    if topology not in TOPOLOGIES:
+        raise ValueError(f"Unknown topology {topology}, expected one of {', '.join(TOPOLOGIES)}")
+    rng = random.Random(seed)
+    members: List[List[Optional[int]]] = [[None] * stops_per_route for _ in range(routes)]
+    stop_count = 0
+
+    def new_stop() -> int:
+        nonlocal stop_count
+        stop_count += 1
+        return stop_count - 1
+
+    def share(a: int, b: int):
+        # One of a's stops (a new one, unless a has no room left) becomes one of b's, if b has room for it
+        free_a = [position for position, stop in enumerate(members[a]) if stop is None]
+        free_b = [position for position, stop in enumerate(members[b]) if stop is None]
+        if not free_b:
+            return
+        if free_a:
+            stop = members[a][rng.choice(free_a)] = new_stop()
+        else:
+            stop = rng.choice(members[a])
+            if stop in members[b]:
+                return
+        members[b][rng.choice(free_b)] = stop
+
+    if topology == "grid":
+        width = max(1, math.ceil(math.sqrt(routes)))
+        for route in range(routes):
+            if route % width:
+                share(route - 1, route)
+            if route >= width and (route % width == 0 or rng.random() < transfer_density):
+                share(route - width, route)
+    else:
+        hub = new_stop()
+        for route in range(routes):
+            if route < RADIAL_BRANCHING:
+                members[route][0] = hub
+            else:
+                share((route - RADIAL_BRANCHING) // RADIAL_BRANCHING, route)
+        for route in range(RADIAL_BRANCHING, routes - 1):
+            if rng.random() < transfer_density:
+                share(route, route + 1)
+
+    stops = {}
+    route_resources, route_stops = [], []
+    for route, route_members in enumerate(members):
+        route_members = [new_stop() if stop is None else stop for stop in route_members]
+        for stop in route_members:
+            if stop not in stops:
+                stops[stop] = _stop_resource(stop)
+        route_resources.append(_route_resource(route, route_members))
+        route_stops.append([stops[stop] for stop in route_members])
+    return route_resources, route_stops
+
+
+def _route_resource(route: int, route_members: List[int]) -> dict:
+    return {
+        "type": "route", "id": f"route-{route}",
+        "attributes": {
+            "color": "FFC72C", "description": "Local Bus", "direction_destinations": [f"Stop {route_members[0]}", f"Stop {route_members[-1]}"],
+            "direction_names": ["Outbound", "Inbound"], "fare_class": "Local Bus", "long_name": f"Route {route}",
+            "short_name": str(route), "sort_order": route, "text_color": "000000", "type": route_service.RouteTypes.BUS.value
+        },
+        "links": {"self": f"/routes/route-{route}"},
+        "relationships": {"line": {"data": {"id": f"line-{route}", "type": "line"}}}
+    }
+
+
+def _stop_resource(stop: int) -> dict:
+    return {
+        "type": "stop", "id": f"stop-{stop}",
+        "attributes": {
+            "address": None, "at_street": None, "description": None, "latitude": 42.0 + (stop % 1000) / 10000,
+            "location_type": 1, "longitude": -71.0 - (stop // 1000) / 10000, "municipality": "Boston",
+            "name": f"Stop {stop}", "on_street": None, "platform_code": None, "platform_name": None,
+            "vehicle_type": route_service.RouteTypes.BUS.value, "wheelchair_boarding": 0
+        },
+        "links": {"self": f"/stops/stop-{stop}"},
+        "relationships": {"parent_station": {"data": None}, "zone": {"data": None}}
+    }
+
+
+def generic_network(routes: List[dict], route_stops: List[List[dict]]) -> Dict[str, route_service.Stop]:
+    """
+    The network as plain Route and Stop objects linked to each other (no Network), which RouteService plans over with
+    its generic search. Returns the stops by id.
+    """
+    stops: Dict[str, route_service.Stop] = {}
+    for route_resource, stop_resources in zip(routes, route_stops):
+        route = route_service.Route(route_resource["id"])
+        for stop_resource in stop_resources:
+            stop = stops.get(stop_resource["id"])
+            if stop is None:
+                stop = stops[stop_resource["id"]] = route_service.Stop(stop_resource["id"])
+            route.stops.add(stop)
+            stop.routes.add(route)
+    return stops
+
+
+###
+# Benchmarks
+###
+def summarize(samples: Sequence[float], count: Optional[int] = None) -> dict:
+    """
+    Statistics of the timed samples (in seconds), per operation in microseconds. Samples each covering several
+    operations (count in all) only have a mean.
+    """
+    total = sum(samples)
+    count = len(samples) if count is None else count
+    summary = {"count": count, "total_s": total, "mean_us": total / count * 1e6 if count else 0.0, "ops_per_s": count / total if total else 0.0}
+    if count == len(samples) and samples:
+        ordered = sorted(samples)
+        for name, fraction in (("min_us", 0.0), ("p50_us", 0.5), ("p90_us", 0.9), ("p99_us", 0.99), ("max_us", 1.0)):
+            summary[name] = ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))] * 1e6
+    return summary
+
+
+def timed(operation: Callable, arguments: Sequence[tuple]) -> Tuple[List[float], list]:
+    """
+    The time operation(*arguments) took for each of the arguments, and what it returned.
+    """
+    samples, results = [], []
+    for argument in arguments:
+        started = time.perf_counter()
+        result = operation(*argument)
+        samples.append(time.perf_counter() - started)
+        results.append(result)
+    return samples, results
+
+
+def build(routes: List[dict], route_stops: List[List[dict]], documents: Optional[Tuple[bytes, List[bytes]]] = None, phases: Optional[Dict[str, List[float]]] = None) -> route_service.MBTARouteService:
+    """
+    A service with the network of the resources, built the way MBTARouteService builds one from API responses:
+    decoding the JSON documents (one for the routes, one per route for its stops), parsing the resources and
+    assembling the network. The time each phase took is appended to phases.
+    """
+    service = route_service.MBTARouteService(workers=1)
+    if documents is None:
+        documents = json.dumps({"data": routes}).encode("utf-8"), [json.dumps({"data": stops}).encode("utf-8") for stops in route_stops]
+    started = time.perf_counter()
+    routes = json.loads(documents[0])["data"]
+    route_stops = [json.loads(document)["data"] for document in documents[1]]
+    decoded = time.perf_counter()
+    parsed_routes = [service._route(route) for route in routes]
+    parsed_route_stops = [[service._stop(stop) for stop in stops] for stops in route_stops]
+    parsed = time.perf_counter()
+    service._assemble(parsed_routes, parsed_route_stops)
+    assembled = time.perf_counter()
+    if phases is not None:
+        for phase, seconds in (("decode", decoded - started), ("parse", parsed - decoded), ("assemble", assembled - parsed), ("total", assembled - started)):
+            phases.setdefault(phase, []).append(seconds)
+    return service
+
+
+def run(
+        routes: int = 100, stops_per_route: int = 10, transfer_density: float = 0.5, topology: str = "grid", seed: int = 0,
+        trips: int = 1000, lookups: int = 1000, repeat: int = 3, engines: Sequence[str] = ENGINES, table_limit: int = 2000
+) -> dict:
+    """
+    Generate a synthetic network (see synthetic_network()) and time building it from JSON, stop and route lookups,
+    stop name completions, question two's statistics and trip() between the same random pairs of stops with each
+    engine:
+    network - MBTARouteService's search over the network's arrays
+    batch - trips() over the pairs grouped by starting stop, sharing each search (no per trip latencies)
+    table - lookups in a precomputed TransferTable (whose build is timed too), for up to table_limit routes
+    generic - RouteService's search over plain Route and Stop objects
+    Trips an engine plans with a different number of routes than the network engine are counted as disagreements.
+    """
+    rng = random.Random(seed)
+    network_routes, network_route_stops = synthetic_network(routes, stops_per_route, transfer_density, topology, seed)
+    results: Dict[str, dict] = {}
+
+    documents = json.dumps({"data": network_routes}).encode("utf-8"), [json.dumps({"data": stops}).encode("utf-8") for stops in network_route_stops]
+    phases: Dict[str, List[float]] = {}
+    service = None
+    for _ in range(max(1, repeat)):
+        service = build(network_routes, network_route_stops, documents, phases)
+    for phase, samples in phases.items():
+        results[f"load.{phase}"] = summarize(samples)
+    network = service.network
+
+    stop_ids = list(network.stop_ids)
+    route_ids = list(network.route_ids)
+    sampled_stops = [network.stops[network.stop_ids[stop_id]] for stop_id in rng.choices(stop_ids, k=lookups)]
+    sampled_routes = [network.routes[network.route_ids[route_id]] for route_id in rng.choices(route_ids, k=lookups)]
+    for name, lookup, keys in (
+            ("stop.id", service.stop, [(stop.id,) for stop in sampled_stops]),
+            ("stop.name", service.stop, [(stop.name.upper(),) for stop in sampled_stops]),
+            ("route.id", service.route, [(route.id,) for route in sampled_routes]),
+            ("route.name", service.route, [(route.long_name.lower(),) for route in sampled_routes]),
+            ("stop.complete", service.stop_index.complete, [(stop.name[:len(stop.name) // 2], 20) for stop in sampled_stops]),
+    ):
+        results[f"lookup.{name}"] = summarize(timed(lookup, keys)[0])
+
+    def statistics():
+        with contextlib.redirect_stdout(io.StringIO()):
+            route_service.two(service)
+    results["statistics.two"] = summarize(timed(statistics, [()] * max(1, repeat))[0])
+
+    pairs = [tuple(rng.sample(stop_ids, 2)) for _ in range(trips)]
+    stop_pairs = [(network.stops[network.stop_ids[a]], network.stops[network.stop_ids[b]]) for a, b in pairs]
+    expected = None
+    for engine in engines:
+        if engine == "network":
+            samples, planned = timed(service.trip, stop_pairs)
+        elif engine == "batch":
+            ordered = sorted(range(len(stop_pairs)), key=lambda pair: pairs[pair][0])
+            started = time.perf_counter()
+            trips_by_pair = dict(zip(ordered, service.trips(stop_pairs[pair] for pair in ordered)))
+            samples, planned = [time.perf_counter() - started], [trips_by_pair[pair] for pair in range(len(stop_pairs))]
+        elif engine == "table":
+            if len(route_ids) > table_limit:
+                results["trip.table"] = {"skipped": f"{len(route_ids)} routes, more than the table limit of {table_limit}"}
+                continue
+            table_service = build(network_routes, network_route_stops, documents)
+            table = table_service.precompute()
+            results["build.table"] = dict(summarize([table.build_seconds]), bytes=table.nbytes)
+            table_network = table_service.network
+            samples, planned = timed(table_service.trip, [
+                (table_network.stops[table_network.stop_ids[a]], table_network.stops[table_network.stop_ids[b]]) for a, b in pairs
+            ])
+        elif engine == "generic":
+            generic_stops = generic_network(network_routes, network_route_stops)
+            samples, planned = timed(route_service.RouteService().trip, [(generic_stops[a], generic_stops[b]) for a, b in pairs])
+        else:
+            raise ValueError(f"Unknown engine {engine}, expected one of {', '.join(ENGINES)}")
+        lengths = [len(trip) for trip in planned]
+        results[f"trip.{engine}"] = summarize(samples, len(pairs))
+        if expected is None:
+            expected = lengths
+            results[f"trip.{engine}"]["unreachable"] = lengths.count(0)
+        else:
+            results[f"trip.{engine}"]["disagreements"] = sum(1 for length, other in zip(lengths, expected) if length != other)
+
+    return {
+        "parameters": {
+            "routes": routes, "stops_per_route": stops_per_route, "transfer_density": transfer_density, "topology": topology,
+            "seed": seed, "trips": trips, "lookups": lookups, "repeat": repeat
+        },
+        "network": {
+            "routes": len(route_ids), "stops": len(stop_ids), "connecting_stops": len(network.connecting_stops()),
+            "memberships": sum(len(stops) for stops in network_route_stops)
+        },
+        "results": results
+    }
+
+
+def run_load(
+        routes: int = 1000, stops_per_route: int = 10, transfer_density: float = 0.5, topology: str = "grid", seed: int = 0,
+        repeat: int = 3, latency: float = 0.0, page_size: Optional[int] = None, rate_limit: Optional[float] = None,
+        workers: int = 8, bulk: int = 0, lean: bool = False
+) -> dict:
+    """
+    Time loading a synthetic network end to end from a local stand-in for the API (fake_mbta.FakeMBTAServer, with
+    latency, page_size and rate_limit) by an MBTARouteService with workers, bulk and lean:
+    cold - a load without a cache
+    refresh - refresh() of the unchanged network, revalidated with ETags
+    refresh_changed - refresh() after one route changed
+    revalidate - a load revalidating an expired cached network
+    cached - a load from a fresh cached network
+    Each reports the wall-clock time, and the requests made (by status) and response bytes received per load.
+    """
+    import tempfile
+    import fake_mbta
+
+    network_routes, network_route_stops = synthetic_network(routes, stops_per_route, transfer_density, topology, seed)
+    samples: Dict[str, List[float]] = {}
+    traffic: Dict[str, Dict[str, int]] = {}
+
+    def service(cache: Optional[route_service.NetworkCache] = None) -> route_service.MBTARouteService:
+        load_service = route_service.MBTARouteService(route_types=[route_service.RouteTypes.BUS], workers=workers, bulk=bulk, cache=cache, lean=lean)
+        load_service.base_url = server.base_url
+        load_service.backoff_factor = 0.1
+        return load_service
+
+    def measure(scenario: str, operation: Callable):
+        before = dict(server.stats)
+        started = time.perf_counter()
+        operation()
+        samples.setdefault(scenario, []).append(time.perf_counter() - started)
+        counts = traffic.setdefault(scenario, {})
+        for name, count in server.stats.items():
+            counts[name] = counts.get(name, 0) + count - before.get(name, 0)
+
+    with fake_mbta.FakeMBTAServer(network_routes, network_route_stops, latency=latency, page_size=page_size, rate_limit=rate_limit) as server:
+        with tempfile.TemporaryDirectory() as directory:
+            for iteration in range(max(1, repeat)):
+                server.update(network_routes, network_route_stops)
+                with service() as loaded:
+                    measure("cold", loaded.load)
+                    measure("refresh", loaded.refresh)
+                    changed = [dict(route, attributes=dict(route["attributes"], long_name=f"{route['attributes']['long_name']} ({iteration})")) if index == 0 else route for index, route in enumerate(network_routes)]
+                    server.update(changed, network_route_stops)
+                    measure("refresh_changed", loaded.refresh)
+                cache = route_service.NetworkCache(directory, ttl=0)
+                with service(cache) as cached:
+                    cached.load()
+                with service(cache) as revalidated:
+                    measure("revalidate", revalidated.load)
+                cache.ttl = 24 * 60 * 60
+                with service(cache) as cached:
+                    measure("cached", cached.load)
+                cache.clear()
+
+    results = {}
+    for scenario, scenario_samples in samples.items():
+        results[f"load.{scenario}"] = dict(summarize(scenario_samples), **{
+            name: count / len(scenario_samples) for name, count in sorted(traffic[scenario].items())
+        })
+    return {
+        "parameters": {
+            "routes": routes, "stops_per_route": stops_per_route, "transfer_density": transfer_density, "topology": topology,
+            "seed": seed, "repeat": repeat, "latency": latency, "page_size": page_size, "rate_limit": rate_limit,
+            "workers": workers, "bulk": bulk, "lean": lean
+        },
+        "network": {"routes": len(network_routes), "stops": len(set(stop["id"] for stops in network_route_stops for stop in stops))},
+        "results": results
+    }
+
+
+def regressions(report: dict, baseline: dict, tolerance: float = 0.25) -> List[str]:
+    """
+    The benchmarks of report whose mean time per operation is more than tolerance (a fraction) above that of the run
+    with the same parameters in baseline.
+    """
+    baseline_runs = {json.dumps(run_report["parameters"], sort_keys=True): run_report["results"] for run_report in baseline.get("runs", [])}
+    slower = []
+    for run_report in report["runs"]:
+        baseline_results = baseline_runs.get(json.dumps(run_report["parameters"], sort_keys=True), {})
+        for name, result in run_report["results"].items():
+            before = baseline_results.get(name, {}).get("mean_us")
+            after = result.get("mean_us")
+            if before and after is not None and after > before * (1 + tolerance):
+                slower.append(f"{run_report['parameters']['topology']} {run_report['parameters']['routes']} routes {name}: {before:.1f} us -> {after:.1f} us")
+    return slower
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Benchmark route_service on synthetic networks, writing the results as JSON")
+    argument_parser.add_argument('--routes', nargs="+", default=[100, 1000], type=int, help='numbers of routes, one run each (default: %(default)s)')
+    argument_parser.add_argument('--stops-per-route', default=10, type=int, metavar="STOPS", help='stops of every route, counting shared stops (default: %(default)s)')
+    argument_parser.add_argument('--transfer-density', default=0.5, type=float, metavar="FRACTION", help='probability of the optional transfers between neighbouring routes (default: %(default)s)')
+    argument_parser.add_argument('--topology', nargs="+", default=["grid"], choices=TOPOLOGIES, help='network layouts, one run each (default: %(default)s)')
+    argument_parser.add_argument('--engines', nargs="+", default=list(ENGINES), choices=ENGINES, help='trip planners to time (default: %(default)s)')
+    argument_parser.add_argument('--trips', default=1000, type=int, help='random trips timed per engine (default: %(default)s)')
+    argument_parser.add_argument('--lookups', default=1000, type=int, help='random stop and route lookups timed (default: %(default)s)')
+    argument_parser.add_argument('--repeat', default=3, type=int, help='times the network is built and the statistics computed (default: %(default)s)')
+    argument_parser.add_argument('--table-limit', default=2000, type=int, metavar="ROUTES", help='only time transfer tables of networks of up to ROUTES routes (default: %(default)s)')
+    argument_parser.add_argument('--seed', default=0, type=int, help='random seed of the networks and trips (default: %(default)s)')
+    load_group = argument_parser.add_argument_group("end to end loading", "with --load, time loading each network from a local stand-in for the API instead (see run_load())")
+    load_group.add_argument('--load', default=False, action="store_true", help='time loading from a local stand-in API')
+    load_group.add_argument('--latency', default=0.0, type=float, metavar="SECONDS", help='delay of every response (default: %(default)s)')
+    load_group.add_argument('--page-size', type=int, metavar="RESOURCES", help='paginate responses longer than RESOURCES')
+    load_group.add_argument('--rate-limit', type=float, metavar="REQUESTS", help='answer requests beyond REQUESTS per second with 429 Too Many Requests')
+    load_group.add_argument('--workers', default=8, type=int, help='concurrent requests of the loading service (default: %(default)s)')
+    load_group.add_argument('--bulk', default=0, type=int, metavar="ROUTES", help='request the stops of up to ROUTES routes per request')
+    load_group.add_argument('--lean', default=False, action="store_true", help='only request the attributes needed to plan trips')
+    argument_parser.add_argument('-o', '--output', metavar="FILE", help='write the results to FILE instead of standard output')
+    argument_parser.add_argument('--baseline', metavar="FILE", help='compare with the results in FILE, exiting with status 1 if a benchmark got slower')
+    argument_parser.add_argument('--tolerance', default=0.25, type=float, metavar="FRACTION", help='slowdown compared with the baseline that is not a regression (default: %(default)s)')
+    parsed_arguments = argument_parser.parse_args()
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "python": platform.python_version(), "platform": platform.platform(),
+        "runs": []
+    }
+    for topology in parsed_arguments.topology:
+        for routes in parsed_arguments.routes:
+            print(f"{topology}, {routes} routes", file=sys.stderr)
+            if parsed_arguments.load:
+                report["runs"].append(run_load(
+                    routes, parsed_arguments.stops_per_route, parsed_arguments.transfer_density, topology, parsed_arguments.seed,
+                    parsed_arguments.repeat, parsed_arguments.latency, parsed_arguments.page_size, parsed_arguments.rate_limit,
+                    parsed_arguments.workers, parsed_arguments.bulk, parsed_arguments.lean
+                ))
+                continue
+            report["runs"].append(run(
+                routes, parsed_arguments.stops_per_route, parsed_arguments.transfer_density, topology, parsed_arguments.seed,
+                parsed_arguments.trips, parsed_arguments.lookups, parsed_arguments.repeat, parsed_arguments.engines,
+                parsed_arguments.table_limit
+            ))
+    if parsed_arguments.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(parsed_arguments.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if parsed_arguments.baseline is not None:
+        with open(parsed_arguments.baseline) as baseline_file:
+            slower = regressions(report, json.load(baseline_file), parsed_arguments.tolerance)
+        for regression in slower:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
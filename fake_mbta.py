@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import hashlib
+import http.server
+import json
+import math
+import queue
+import threading
+import time
+import urllib.parse
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import route_service
+
+# A local stand-in for the MBTA API's /routes and /stops, serving generated or recorded networks so loading can be
+# measured (see benchmark.py --load) and tested offline. For example:
+#   python fake_mbta.py --routes 1000 --latency 0.05 --page-size 100 --rate-limit 20 --port 8080
+#   python route_service.py --base-url http://127.0.0.1:8080 --bus --no-cache --two
+#   python fake_mbta.py --record subway.json  # the routes and stops the API serves now, to serve with --fixtures
+
+
+class FakeMBTAServer(http.server.ThreadingHTTPServer):
+    """
+    Serves routes and the stops of each route (route_stops[i] are those of routes[i]) the way the MBTA API does,
+    honoring filter[type], filter[id], filter[route], include=route and sparse fieldsets (fields[...]).
+
+    Every response is delayed by latency seconds. Collections longer than page_size, or the page[limit] asked for,
+    are paginated with page[offset], the following page linked from links.next. Beyond rate_limit requests per second
+    (after a burst of as many) requests are answered with a 429 whose Retry-After is retry_after, or the whole seconds
+    until the next request is allowed. Responses carry an ETag and requests sending it back (If-None-Match) are
+    answered with an empty 304. While drop_connections is set, requests are answered by closing the connection, and
+    the first stop request of each route in throttled is answered with a 429 (Retry-After: 0). The connections
+    accepted, requests served, their statuses and the body bytes sent are counted in stats.
+
+    Requests with Accept: text/event-stream are answered with a stream of server-sent events, as the API streams
+    updates: a reset holding the routes (or stops) requested, then the events passed to send() for the path, until
+    disconnect(). The open streams of each path are listed in streams, by the query they were requested with. The
+    first stream_failures[path] stream requests of a path are answered with a 503.
+    """
+    daemon_threads = True
+
+    def __init__(
+            self, routes: List[dict], route_stops: List[List[dict]], address: Tuple[str, int] = ("127.0.0.1", 0),
+            latency: float = 0.0, page_size: Optional[int] = None, rate_limit: Optional[float] = None,
+            retry_after: Optional[int] = None, etags: bool = True
+    ):
+        super().__init__(address, FakeMBTAHandler)
+        self.latency = latency
+        self.page_size = page_size
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.etags = etags
+        self.drop_connections = False
+        self.throttled: Set[str] = set()
+        self.stream_failures: Dict[str, int] = collections.Counter()
+        self.streams: Dict[str, Dict[queue.Queue, Dict[str, str]]] = {"/routes": {}, "/stops": {}}
+        self.stats: Dict[str, int] = collections.Counter()
+        self.routes: List[dict] = []
+        self.route_stops: Dict[str, List[dict]] = {}
+        self._lock = threading.Lock()
+        self._responses: Dict[Tuple[str, str], Tuple[bytes, str]] = {}
+        self.update(routes, route_stops)
+        self._tokens = rate_limit or 0.0
+        self._refilled = time.monotonic()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def update(self, routes: List[dict], route_stops: List[List[dict]]):
+        """
+        Serve routes and route_stops from now on.
+        """
+        with self._lock:
+            self.routes, self.route_stops = list(routes), {route["id"]: list(stops) for route, stops in zip(routes, route_stops)}
+            self._responses = {}
+
+    def response(self, path: str, query: str) -> Optional[Tuple[bytes, str]]:
+        return self._responses.get((path, query))
+
+    def remember(self, path: str, query: str, body: bytes, etag: str):
+        with self._lock:
+            self._responses[(path, query)] = (body, etag)
+
+    def count(self, **counts: int):
+        with self._lock:
+            self.stats.update(counts)
+
+    def throttle(self, route_id: Optional[str]) -> bool:
+        """
+        Whether to answer the stop request of route_id with a 429, which is only done once.
+        """
+        with self._lock:
+            if route_id not in self.throttled:
+                return False
+            self.throttled.discard(route_id)
+            return True
+
+    def fail_stream(self, path: str) -> bool:
+        """
+        Whether to answer a stream request of path with a 503, which is done stream_failures[path] times.
+        """
+        with self._lock:
+            if self.stream_failures[path] <= 0:
+                return False
+            self.stream_failures[path] -= 1
+            return True
+
+    def open_stream(self, path: str, query: Dict[str, str]) -> queue.Queue:
+        """
+        The queue of the events to send on a new stream of path.
+        """
+        events = queue.Queue()
+        with self._lock:
+            self.streams[path][events] = query
+        return events
+
+    def close_stream(self, path: str, events: queue.Queue):
+        with self._lock:
+            self.streams[path].pop(events, None)
+
+    def send(self, path: str, event: str, data: object):
+        """
+        Send an event with data (encoded as JSON) on every open stream of path.
+        """
+        with self._lock:
+            streams = list(self.streams[path])
+        for events in streams:
+            events.put(f"event: {event}\ndata: {json.dumps(data)}\n\n")
+
+    def disconnect(self, path: str):
+        """
+        End every open stream of path.
+        """
+        with self._lock:
+            streams = list(self.streams[path])
+        for events in streams:
+            events.put(None)
+
+    def allow(self) -> Optional[int]:
+        """
+        Take a request from the rate limit, returning None if it is allowed or else the seconds to retry after.
+        """
+        if not self.rate_limit:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled) * self.rate_limit)
+            self._refilled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return None
+            return self.retry_after if self.retry_after is not None else math.ceil((1 - self._tokens) / self.rate_limit)
+
+    def start(self) -> "FakeMBTAServer":
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.05,), name="FakeMBTAServer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        for path in self.streams:
+            self.disconnect(path)
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+    def __enter__(self) -> "FakeMBTAServer":
+        return self.start()
+
+    def __exit__(self, *_unused_args):
+        self.stop()
+
+
+class FakeMBTAHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the API
+    disable_nagle_algorithm = True  # headers and body are written separately
+
+    def log_message(self, *_unused_args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.count(connections=1)
+
+    def do_GET(self):
+        server: FakeMBTAServer = self.server
+        if server.drop_connections:
+            server.count(requests=1, dropped=1)
+            self.close_connection = True
+            return
+        if server.latency:
+            time.sleep(server.latency)
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        retry_after = server.allow()
+        if retry_after is None and url.path == "/stops" and server.throttle(query.get("filter[route]")):
+            retry_after = 0
+        if retry_after is not None:
+            self.send_empty(429, {"Retry-After": str(retry_after)})
+            return
+        if url.path not in ("/routes", "/stops"):
+            self.send_empty(404)
+            return
+        if self.headers.get("Accept") == "text/event-stream":
+            self.stream(url, query)
+            return
+        cached = server.response(url.path, url.query)  # encoding the body dominates serving it
+        if cached is None:
+            body = self.encode(url, query)
+            cached = (body, f'"{hashlib.sha1(body).hexdigest()[:20]}"')
+            server.remember(url.path, url.query, *cached)
+        body, etag = cached
+        if server.etags and self.headers.get("If-None-Match") == etag:
+            self.send_empty(304, {"ETag": etag})
+            return
+        server.count(requests=1, **{"200": 1}, bytes=len(body))  # before the client can see the response
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.api+json")
+        self.send_header("Content-Length", str(len(body)))
+        if server.etags:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, url: urllib.parse.SplitResult, query: Dict[str, str]):
+        """
+        Answer with a reset of the resources requested, then the events sent for the path until it is disconnected,
+        each in a chunk of its own.
+        """
+        server: FakeMBTAServer = self.server
+        if server.fail_stream(url.path):
+            self.send_empty(503)
+            return
+        events = server.open_stream(url.path, query)  # events sent once the request is seen follow the reset
+        try:
+            reset = self.sparse(query, self.routes(query) if url.path == "/routes" else self.stops(query))
+            server.count(requests=1, **{"200": 1}, streams=1)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            event = f": keep-alive\nevent: reset\ndata: {json.dumps(reset)}\n\n"
+            while event is not None:
+                body = event.encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(body), body))
+                self.wfile.flush()
+                server.count(bytes=len(body))
+                event = events.get()
+            self.wfile.write(b"0\r\n\r\n")
+        except OSError:
+            self.close_connection = True
+        finally:
+            server.close_stream(url.path, events)
+
+    def encode(self, url: urllib.parse.SplitResult, query: Dict[str, str]) -> bytes:
+        data = self.sparse(query, self.routes(query) if url.path == "/routes" else self.stops(query))
+        document = {"data": data, "jsonapi": {"version": "1.0"}}
+        included = self.included(query) if url.path == "/stops" else []
+        if included:
+            document["included"] = self.sparse(query, included)
+
+        limit = int(query["page[limit]"]) if query.get("page[limit]") else self.server.page_size
+        offset = int(query.get("page[offset]") or 0)
+        if limit and (offset or len(data) > limit):
+            document["data"] = data[offset:offset + limit]
+            document["links"] = {"first": self.page(url, query, 0, limit), "last": self.page(url, query, max(0, (len(data) - 1) // limit * limit), limit)}
+            if offset + limit < len(data):
+                document["links"]["next"] = self.page(url, query, offset + limit, limit)
+        return json.dumps(document).encode("utf-8")
+
+    @staticmethod
+    def sparse(query: Dict[str, str], resources: List[dict]) -> List[dict]:
+        """
+        Resources limited to the attributes and relationships their type's sparse fieldset (fields[type]) asks for.
+        """
+        sparse = []
+        for resource in resources:
+            if query.get(f"fields[{resource['type']}]") is not None:
+                fields = set(query[f"fields[{resource['type']}]"].split(","))
+                resource = dict(resource, attributes={a: v for a, v in resource["attributes"].items() if a in fields})
+                if "relationships" in resource:
+                    resource["relationships"] = {r: v for r, v in resource["relationships"].items() if r in fields}
+            sparse.append(resource)
+        return sparse
+
+    def routes(self, query: Dict[str, str]) -> List[dict]:
+        routes = self.server.routes
+        if query.get("filter[type]"):
+            route_types = set(int(route_type) for route_type in query["filter[type]"].split(","))
+            routes = [route for route in routes if route["attributes"].get("type") in route_types]
+        if query.get("filter[id]"):
+            route_ids = set(query["filter[id]"].split(","))
+            routes = [route for route in routes if route["id"] in route_ids]
+        return routes
+
+    def stops(self, query: Dict[str, str]) -> List[dict]:
+        route_stops = self.server.route_stops
+        if query.get("filter[route]"):
+            route_ids = [route_id for route_id in query["filter[route]"].split(",") if route_id in route_stops]
+        else:
+            route_ids = list(route_stops)
+        stop_ids = set(query["filter[id]"].split(",")) if query.get("filter[id]") else None
+        included = "route" in query.get("include", "").split(",")
+        stops: Dict[str, dict] = {}
+        for route_id in route_ids:
+            for stop in route_stops[route_id]:
+                if stop_ids is not None and stop["id"] not in stop_ids:
+                    continue
+                stops.setdefault(stop["id"], stop)
+                if included:  # a stop of several routes is sent once, naming each of them
+                    related = stops[stop["id"]].get("relationships", {}).get("route", {}).get("data")
+                    related = (related if isinstance(related, list) else []) + [{"id": route_id, "type": "route"}]
+                    stops[stop["id"]] = dict(stop, relationships=dict(stop.get("relationships") or {}, route={"data": related}))
+        return list(stops.values())
+
+    def included(self, query: Dict[str, str]) -> List[dict]:
+        if "route" not in query.get("include", "").split(",") or not query.get("filter[route]"):
+            return []
+        route_ids = set(query["filter[route]"].split(","))
+        return [route for route in self.server.routes if route["id"] in route_ids]
+
+    def page(self, url: urllib.parse.SplitResult, query: Dict[str, str], offset: int, limit: int) -> str:
+        query = dict(query, **{"page[offset]": str(offset), "page[limit]": str(limit)})
+        return f"{self.server.base_url}{url.path}?{urllib.parse.urlencode(query)}"
+
+    def send_empty(self, status: int, headers: Optional[Dict[str, str]] = None):
+        self.server.count(requests=1, **{str(status): 1})
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+###
+# Fixtures
+###
+def record(service: route_service.MBTARouteService) -> Tuple[List[dict], List[List[dict]]]:
+    """
+    The routes and stops of a service's network as API resources, to serve or save_fixtures().
+    """
+    network = service.network
+    return [route.as_json() for route in network.routes], [[stop.as_json() for stop in route.stops] for route in network.routes]
+
+
+def save_fixtures(path: str, routes: List[dict], route_stops: List[List[dict]]):
+    with open(path, "w") as fixtures:
+        json.dump({"routes": routes, "stops": {route["id"]: stops for route, stops in zip(routes, route_stops)}}, fixtures)
+
+
+def load_fixtures(path: str) -> Tuple[List[dict], List[List[dict]]]:
+    with open(path) as fixtures:
+        recorded = json.load(fixtures)
+    return recorded["routes"], [recorded["stops"].get(route["id"], []) for route in recorded["routes"]]
+
+
+def main(arguments: Optional[Sequence[str]] = None):
+    import benchmark
+
+    argument_parser = argparse.ArgumentParser(description="Serve a generated or recorded network like the MBTA API")
+    argument_parser.add_argument('--host', default="127.0.0.1", help='address to listen on (default: %(default)s)')
+    argument_parser.add_argument('--port', default=8080, type=int, help='port to listen on (default: %(default)s)')
+    argument_parser.add_argument('--fixtures', metavar="FILE", help='serve the network recorded in FILE (see --record) instead of a generated one')
+    argument_parser.add_argument('--record', metavar="FILE", help='record the network the API serves now (of --route-types) in FILE and exit')
+    argument_parser.add_argument('--route-types', nargs="+", default=[0, 1], type=int, metavar="TYPE", help='route types recorded (default: %(default)s)')
+    argument_parser.add_argument('--routes', default=1000, type=int, help='routes of the generated network (default: %(default)s)')
+    argument_parser.add_argument('--stops-per-route', default=10, type=int, metavar="STOPS", help='stops of every generated route (default: %(default)s)')
+    argument_parser.add_argument('--transfer-density', default=0.5, type=float, metavar="FRACTION", help='see benchmark.py (default: %(default)s)')
+    argument_parser.add_argument('--topology', default="grid", choices=benchmark.TOPOLOGIES, help='layout of the generated network (default: %(default)s)')
+    argument_parser.add_argument('--seed', default=0, type=int, help='random seed of the generated network (default: %(default)s)')
+    argument_parser.add_argument('--latency', default=0.0, type=float, metavar="SECONDS", help='delay every response by SECONDS (default: %(default)s)')
+    argument_parser.add_argument('--page-size', type=int, metavar="RESOURCES", help='paginate collections longer than RESOURCES')
+    argument_parser.add_argument('--rate-limit', type=float, metavar="REQUESTS", help='answer requests beyond REQUESTS per second with 429 Too Many Requests')
+    argument_parser.add_argument('--retry-after', type=int, metavar="SECONDS", help='Retry-After sent with a 429 (default: until the next request is allowed)')
+    argument_parser.add_argument('--no-etags', dest="etags", default=True, action="store_false", help='do not send ETags, or answer 304 Not Modified')
+    parsed_arguments = argument_parser.parse_args(arguments)
+
+    if parsed_arguments.record is not None:
+        import os
+        service = route_service.MBTARouteService(os.environ.get("MBTA_API_KEY"), route_types=[route_service.RouteTypes(t) for t in parsed_arguments.route_types])
+        save_fixtures(parsed_arguments.record, *record(service))
+        print(f"Recorded {len(service.network.routes)} routes and {len(service.network.stops)} stops in {parsed_arguments.record}")
+        return
+    if parsed_arguments.fixtures is not None:
+        routes, route_stops = load_fixtures(parsed_arguments.fixtures)
+    else:
+        routes, route_stops = benchmark.synthetic_network(
+            parsed_arguments.routes, parsed_arguments.stops_per_route, parsed_arguments.transfer_density,
+            parsed_arguments.topology, parsed_arguments.seed
+        )
+    server = FakeMBTAServer(
+        routes, route_stops, (parsed_arguments.host, parsed_arguments.port), parsed_arguments.latency,
+        parsed_arguments.page_size, parsed_arguments.rate_limit, parsed_arguments.retry_after, parsed_arguments.etags
+    )
+    print(f"Serving {len(routes)} routes on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Served {dict(server.stats)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,83 @@
 #!/usr/bin/env python3
-import json
-import logging
+import array
+import bisect
+import collections
+import collections.abc
+import heapq
+import itertools
+import math
 import os
+import struct
+import sys
+import threading
+import time
 from enum import Enum
-from typing import Optional, List, Dict, Set, Union
+from typing import (
+    TYPE_CHECKING, AbstractSet, Callable, FrozenSet, Iterable, Iterator, Optional, List, Dict, Sequence, Set, Tuple, Union
+)
 
-import requests
-from requests.adapters import HTTPAdapter, Retry
+# The HTTP stack (requests), json and logging are imported where they are used, answering from a cached network
+# never needs the HTTP stack and a command line run should not pay for it. test_import_time keeps it that way.
+if TYPE_CHECKING:
+    import mmap
+    import requests
+DEBUG, INFO, WARNING = 10, 20, 30  # the logging levels
+
+
+class _Logger:
+    """
+    A class attribute for the class's logger, logging.getLogger(name). Until something imports logging nothing can
+    have configured it, and unconfigured logging drops debug and info messages, so until then those are dropped here
+    without importing it.
+    """
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        logging = sys.modules.get("logging")
+        return self if logging is None else logging.getLogger(self.name)
+
+    def isEnabledFor(self, level: int) -> bool:
+        return level >= WARNING
+
+    def debug(self, *_unused_args, **_unused_kwargs):
+        pass
+
+    info = debug
+
+    def __getattr__(self, name: str):  # warning() and the other methods, which import logging
+        import logging
+        return getattr(logging.getLogger(self.name), name)
+
+
+def _replace_file(path: str, data: bytes):
+    """
+    Replace the file at path with data. It is written under a temporary name in the same directory and renamed into
+    place, so a reader never sees a partial file.
+    """
+    import tempfile
+
+    handle, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as temporary_file:
+            temporary_file.write(data)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
 
 
 ###
 # Generic Abstract Classes
 ###
 class Route:
-    __slots__ = ("id", "stops")
+    """
+    A route and the stops it serves. Until the route is part of a Network its stops are a plain set, afterwards they
+    are a read only view of the network's membership arrays.
+    """
+    __slots__ = ("id", "_stops", "_network", "_index")
 
     def __eq__(self, other):
         return isinstance(other, self.__class__) and hash(self) == hash(other)
@@ -23,7 +87,9 @@ class Route:
 
     def __init__(self, route_id: Union[int, str]):
         self.id = route_id
-        self.stops: Set[Stop] = set()
+        self._stops: Optional[Set[Stop]] = None  # created when first used, routes loaded into a Network never need it
+        self._network: Optional[Network] = None
+        self._index = -1
 
     def __repr__(self):
         return f"{self.__class__.__name__}({self})"
@@ -31,9 +97,21 @@ class Route:
     def __str__(self):
         return str(self.id)
 
+    @property
+    def stops(self) -> AbstractSet["Stop"]:
+        if self._network is not None:
+            return self._network.route_stops(self._index)
+        if self._stops is None:
+            self._stops = set()
+        return self._stops
+
 
 class Stop:
-    __slots__ = ("id", "routes", "stops")
+    """
+    A stop and the routes serving it. Until the stop is part of a Network its routes are a plain set, afterwards they
+    are a read only view of the network's membership arrays.
+    """
+    __slots__ = ("id", "_routes", "_network", "_index")
 
     def __eq__(self, other):
         return isinstance(other, self.__class__) and hash(self) == hash(other)
@@ -43,7 +121,9 @@ class Stop:
 
     def __init__(self, stop_id: Union[int, str]):
         self.id: Union[int, str] = stop_id
-        self.routes: Set[Route] = set()
+        self._routes: Optional[Set[Route]] = None  # created when first used, stops loaded into a Network never need it
+        self._network: Optional[Network] = None
+        self._index = -1
 
     def __repr__(self):
         return f"{self.__class__}({self})"
@@ -51,9 +131,502 @@ class Stop:
     def __str__(self):
         return str(self.id)
 
+    @property
+    def routes(self) -> AbstractSet[Route]:
+        if self._network is not None:
+            return self._network.stop_routes(self._index)
+        if self._routes is None:
+            self._routes = set()
+        return self._routes
+
+
+class MembershipView(collections.abc.Set):
+    """
+    The routes of a stop, or the stops of a route: members[indices[start:end]], where indices are sorted dense ids.
+    """
+    __slots__ = ("_network", "_members", "_indices", "_start", "_end")
+
+    def __init__(self, network: "Network", members: list, indices: array.array, start: int, end: int):
+        self._network = network
+        self._members = members
+        self._indices = indices
+        self._start = start
+        self._end = end
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __iter__(self):
+        members, indices = self._members, self._indices
+        for position in range(self._start, self._end):
+            yield members[indices[position]]
+
+    def __contains__(self, item):
+        if getattr(item, "_network", None) is self._network:
+            position = bisect.bisect_left(self._indices, item._index, self._start, self._end)
+            return position < self._end and self._indices[position] == item._index
+        return any(member == item for member in self)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({{{', '.join(repr(member) for member in self)}}})"
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return frozenset(iterable)
+
+
+class LazySequence(collections.abc.Sequence):
+    """
+    A read only sequence of length objects, each made by factory(index) the first time it is used and kept after.
+    """
+    __slots__ = ("_items", "_factory", "_lock")
+
+    def __init__(self, length: int, factory: Callable[[int], object]):
+        self._items: list = [None] * length
+        self._factory = factory
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self._items)))]
+        item = self._items[index]
+        if item is None:
+            with self._lock:  # so every thread sees the same object
+                item = self._items[index]
+                if item is None:
+                    item = self._items[index] = self._factory(index % len(self._items))
+        return item
+
+    def __iter__(self):
+        for index in range(len(self._items)):
+            yield self[index]
+
+
+class NameIndex:
+    """
+    A prefix index over names, for completion. The names are kept sorted by their case folded form, so the names
+    starting with a prefix are one contiguous slice found with two binary searches, O(log n) however many names there
+    are, and only the slice that is asked for is copied out.
+    """
+    __slots__ = ("keys", "names")
+
+    def __init__(self, names: Iterable[str]):
+        entries = sorted(set((name.casefold(), name) for name in names))
+        self.keys: List[str] = [key for key, _ in entries]
+        self.names: List[str] = [name for _, name in entries]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def complete(self, prefix: str, limit: Optional[int] = None) -> List[str]:
+        """
+        The names starting with prefix (ignoring case), in order, at most limit of them.
+        """
+        prefix = prefix.casefold()
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + "\U0010ffff", start)  # past every key that starts with prefix
+        if limit is not None:
+            end = min(end, start + limit)
+        return self.names[start:end]
+
+    def suggest(self, text: str, limit: Optional[int] = 10) -> List[str]:
+        """
+        The names sharing the longest prefix with text that any name has, for "did you mean" listings.
+        """
+        text = text.strip()
+        while text:
+            suggestions = self.complete(text, limit)
+            if suggestions:
+                return suggestions
+            text = text[:-1]
+        return []
+
+
+class FuzzyIndex:
+    """
+    A typo tolerant index of named items (items[i] named names[i], or str(items[i])), using trigrams. Names are
+    normalised (case folded, with punctuation as spaces) and padded, and every trigram maps to the names containing it.
+    A search counts the trigrams each name shares with the text from the posting lists of the text's trigrams only,
+    then ranks the names by their Dice similarity, 2 * shared / (trigrams in the name + trigrams in the text), 1.0 for
+    a perfect match.
+    """
+    __slots__ = ("items", "names", "positions", "sizes", "postings")
+
+    def __init__(self, items: Sequence, names: Optional[Iterable[str]] = None):
+        grouped: Dict[str, List[int]] = {}
+        for position, name in enumerate(names if names is not None else (str(item) for item in items)):
+            grouped.setdefault(self.normalise(name), []).append(position)
+        self.items = items  # only the items found are used, a lazy sequence stays lazy
+        self.names: List[str] = sorted(grouped)
+        self.positions: List[List[int]] = [grouped[name] for name in self.names]
+        self.sizes = array.array("i")
+        postings: Dict[str, array.array] = {}
+        for index, name in enumerate(self.names):
+            trigrams = self.trigrams(name)
+            self.sizes.append(len(trigrams))
+            for trigram in trigrams:
+                postings.setdefault(trigram, array.array("i")).append(index)
+        self.postings = postings
+
+    @staticmethod
+    def normalise(name: str) -> str:
+        return " ".join("".join(c if c.isalnum() else " " for c in name.casefold()).split())
+
+    @staticmethod
+    def trigrams(name: str) -> Set[str]:
+        padded = f"  {name} "
+        return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    def search(self, text: str, k: int = 5, threshold: float = 0.5) -> List[Tuple[object, float]]:
+        """
+        At most k (item, similarity) pairs for the items named most like text, best first, none less similar than
+        threshold. Items with the same name are equally similar and are returned together.
+
+        Only names that can reach the threshold are scored. A name as similar as threshold shares at least required of
+        the text's trigrams, so it must contain one of the rarest len(trigrams) - required + 1; the names in those short
+        posting lists are the candidates, and the common trigrams are checked only for them, by binary search.
+        """
+        postings = self.postings
+        trigrams = sorted(self.trigrams(self.normalise(text)), key=lambda trigram: len(postings.get(trigram, ())))
+        size = len(trigrams)
+        if k <= 0 or size == 0:
+            return []
+        required = max(1, math.ceil(threshold * size / (2.0 - threshold)))
+        shared = collections.Counter()
+        for trigram in trigrams[:size - required + 1]:
+            shared.update(postings.get(trigram, ()))
+        common = [postings[trigram] for trigram in trigrams[size - required + 1:] if trigram in postings]
+
+        sizes, best = self.sizes, []  # best is a heap of the k most similar (score, -index)
+        for index, count in shared.items():
+            bound = threshold if len(best) < k else max(threshold, best[0][0])
+            if 2.0 * (count + len(common)) / (size + sizes[index]) < bound:
+                continue
+            for posting in common:
+                position = bisect.bisect_left(posting, index)
+                if position < len(posting) and posting[position] == index:
+                    count += 1
+            score = 2.0 * count / (size + sizes[index])
+            if score >= bound:
+                if len(best) < k:
+                    heapq.heappush(best, (score, -index))
+                else:
+                    heapq.heappushpop(best, (score, -index))
+        matches = []
+        for score, index in sorted(best, reverse=True):
+            matches.extend((self.items[position], score) for position in self.positions[-index])
+        return matches[:k]
+
+
+class Network:
+    """
+    Compact route/stop incidence. Routes and stops are numbered densely (their position in routes and stops) and
+    membership is stored in CSR form, offsets plus sorted indices in flat integer arrays:
+    - the stops of route r are route_stop_indices[route_stop_offsets[r]:route_stop_offsets[r + 1]]
+    - the routes of stop s are stop_route_indices[stop_route_offsets[s]:stop_route_offsets[s + 1]]
+    - the routes connected to route r are transfer_routes[transfer_offsets[r]:transfer_offsets[r + 1]], and the
+      stops connecting r to the route at position t are transfer_stop_indices[transfer_stop_offsets[t]:...[t + 1]]
+    Route and Stop objects become views of the network once it is built, and the planner runs on the arrays.
+    A network is never modified once built, so its lookup indexes, from ids and case-insensitive names (the str() of
+    routes and stops, kept in route_labels and stop_labels) to dense ids, are computed once, when it is built. The
+    frozen sets of its routes and stops (route_set, stop_set) are computed once, when first used.
+    A network restored from saved arrays (see restore() and NetworkSnapshot) makes its route and stop objects as they
+    are used, the planner and the lookup indexes do not need them.
+    """
+    __slots__ = (
+        "routes", "stops", "route_stop_offsets", "route_stop_indices", "stop_route_offsets", "stop_route_indices",
+        "transfer_offsets", "transfer_routes", "transfer_stop_offsets", "transfer_stop_indices",
+        "route_ids", "stop_ids", "route_names", "stop_names", "route_labels", "stop_labels",
+        "_route_set", "_stop_set", "_stop_index", "_fuzzy_index"
+    )
+    _arrays = __slots__[2:10]
+
+    def __init__(self, routes: List[Route], route_stops: List[List[Stop]]):
+        """
+        Build the network from routes and the stops of each (route_stops[i] belong to routes[i]). Stops with the same
+        id are the same stop, the first object seen is kept. Every route and kept stop is bound to this network.
+        """
+        self.routes: Sequence[Route] = list(routes)
+        self.stops: Sequence[Stop] = []
+        stop_indexes: Dict[Union[int, str], int] = {}
+        route_members: List[List[int]] = []
+        for stops in route_stops:
+            members = set()
+            for stop in stops:
+                index = stop_indexes.get(stop.id)
+                if index is None:
+                    index = stop_indexes[stop.id] = len(self.stops)
+                    self.stops.append(stop)
+                members.add(index)
+            route_members.append(sorted(members))
+        route_members.extend([] for _ in range(len(self.routes) - len(route_members)))
+
+        stop_members: List[List[int]] = [[] for _ in self.stops]
+        for route_index, members in enumerate(route_members):
+            for stop_index in members:
+                stop_members[stop_index].append(route_index)  # sorted, routes are visited in order
+        self.route_stop_offsets, self.route_stop_indices = self.__csr(route_members)
+        self.stop_route_offsets, self.stop_route_indices = self.__csr(stop_members)
+
+        connections: List[Dict[int, List[int]]] = [{} for _ in self.routes]
+        for stop_index, members in enumerate(stop_members):
+            if len(members) > 1:
+                for route_index in members:
+                    for connection in members:
+                        if connection != route_index:
+                            connections[route_index].setdefault(connection, []).append(stop_index)
+        self.transfer_offsets, self.transfer_routes = self.__csr([sorted(c) for c in connections])
+        self.transfer_stop_offsets, self.transfer_stop_indices = self.__csr(
+            [c[connection] for c in connections for connection in sorted(c)]
+        )
+
+        for index, route in enumerate(self.routes):
+            route._network, route._index, route._stops = self, index, None
+        for index, stop in enumerate(self.stops):
+            stop._network, stop._index, stop._routes = self, index, None
+        self.__index(
+            [route.id for route in self.routes], [stop.id for stop in self.stops],
+            [str(route) for route in self.routes], [str(stop) for stop in self.stops]
+        )
+
+    @classmethod
+    def restore(
+            cls, arrays: Dict[str, array.array], route_ids: List[Union[int, str]], stop_ids: List[Union[int, str]],
+            route_labels: List[str], stop_labels: List[str], route: Callable[[int], Route], stop: Callable[[int], Stop]
+    ) -> "Network":
+        """
+        A network from the arrays (by attribute name) and the ids and labels of the routes and stops of one built
+        before. The route and stop with dense id i are made by route(i) and stop(i) the first time they are used.
+        """
+        network = cls.__new__(cls)
+        for name in cls._arrays:
+            setattr(network, name, arrays[name])
+        network.routes = LazySequence(len(route_ids), lambda index: network.__bind(route(index), index))
+        network.stops = LazySequence(len(stop_ids), lambda index: network.__bind(stop(index), index))
+        network.__index(route_ids, stop_ids, route_labels, stop_labels)
+        return network
+
+    def patch(
+            self, routes: List[Route], route_stops: Dict[Union[int, str], List[Stop]], copy: Callable[[Stop], Stop],
+            updated: Iterable[Stop] = ()
+    ) -> "Network":
+        """
+        A new network of routes, in that order. The routes whose ids are in route_stops serve those stops, the others
+        (which must be routes of this network) serve the stops they serve in this one. Objects belong to one network,
+        so the stops kept are copied by copy(stop), unless updated or route_stops have a stop with the same id, which
+        is used instead. Stops no route serves any longer are left out. The prefix index of the stop names is kept when
+        they are unchanged.
+        """
+        stops: Dict[Union[int, str], Stop] = {stop.id: stop for stop in updated}
+        for members in route_stops.values():
+            for stop in members:
+                stops.setdefault(stop.id, stop)
+        stop_ids = list(self.stop_ids)
+
+        def kept(index: int) -> Stop:
+            stop = stops.get(stop_ids[index])
+            if stop is None:
+                stop = stops[stop_ids[index]] = copy(self.stops[index])
+            return stop
+
+        network = self.__class__(routes, [
+            route_stops[route.id] if route.id in route_stops else [kept(index) for index in self.__members(route)]
+            for route in routes
+        ])
+        if network.stop_labels == self.stop_labels:
+            network._stop_index = self._stop_index
+        return network
+
+    def __members(self, route: Route) -> array.array:
+        index = self.route_ids[route.id]
+        return self.route_stop_indices[self.route_stop_offsets[index]:self.route_stop_offsets[index + 1]]
+
+    def __bind(self, resource: Union[Route, Stop], index: int) -> Union[Route, Stop]:
+        resource._network, resource._index = self, index
+        return resource
+
+    def __index(self, route_ids: list, stop_ids: list, route_labels: List[str], stop_labels: List[str]):
+        self.route_ids: Dict[Union[int, str], int] = {route_id: index for index, route_id in enumerate(route_ids)}
+        self.stop_ids: Dict[Union[int, str], int] = {stop_id: index for index, stop_id in enumerate(stop_ids)}
+        self.route_names: Dict[str, int] = {label.casefold(): index for index, label in enumerate(route_labels)}
+        self.stop_names: Dict[str, int] = {label.casefold(): index for index, label in enumerate(stop_labels)}
+        self.route_labels, self.stop_labels = route_labels, stop_labels
+        self._route_set: Optional[FrozenSet[Route]] = None
+        self._stop_set: Optional[FrozenSet[Stop]] = None
+        self._stop_index: Optional[NameIndex] = None
+        self._fuzzy_index: Optional[FuzzyIndex] = None
+
+    @staticmethod
+    def __csr(rows: List[List[int]]) -> Tuple[array.array, array.array]:
+        offsets = array.array("i", [0])
+        indices = array.array("i")
+        for row in rows:
+            indices.extend(row)
+            offsets.append(len(indices))
+        return offsets, indices
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).itemsize * len(getattr(self, name)) for name in self._arrays)
+
+    @property
+    def route_set(self) -> FrozenSet[Route]:
+        if self._route_set is None:
+            self._route_set = frozenset(self.routes)
+        return self._route_set
+
+    @property
+    def stop_set(self) -> FrozenSet[Stop]:
+        if self._stop_set is None:
+            self._stop_set = frozenset(self.stops)
+        return self._stop_set
+
+    def route(self, key: Union[int, str, None]) -> Optional[Route]:
+        """
+        The route with the id key, or else the name key (ignoring case).
+        """
+        index = self.__find(key, self.route_ids, self.route_names)
+        return None if index is None else self.routes[index]
+
+    def stop(self, key: Union[int, str, None]) -> Optional[Stop]:
+        """
+        The stop with the id key, or else the name key (ignoring case).
+        """
+        index = self.__find(key, self.stop_ids, self.stop_names)
+        return None if index is None else self.stops[index]
+
+    @staticmethod
+    def __find(key, ids: dict, names: dict) -> Optional[int]:
+        found = ids.get(key)
+        if found is None and key is not None:
+            key = str(key)
+            found = ids.get(key)
+            if found is None:
+                found = names.get(key.casefold())
+        return found
+
+    def route_stops(self, route_index: int) -> MembershipView:
+        return MembershipView(
+            self, self.stops, self.route_stop_indices, self.route_stop_offsets[route_index], self.route_stop_offsets[route_index + 1]
+        )
+
+    def stop_routes(self, stop_index: int) -> MembershipView:
+        return MembershipView(
+            self, self.routes, self.stop_route_indices, self.stop_route_offsets[stop_index], self.stop_route_offsets[stop_index + 1]
+        )
+
+    def transfers(self, route_index: int) -> Dict[Route, Set[Stop]]:
+        transfers = {}
+        for position in range(self.transfer_offsets[route_index], self.transfer_offsets[route_index + 1]):
+            start, end = self.transfer_stop_offsets[position], self.transfer_stop_offsets[position + 1]
+            transfers[self.routes[self.transfer_routes[position]]] = set(self.stops[s] for s in self.transfer_stop_indices[start:end])
+        return transfers
+
+    @property
+    def stop_index(self) -> NameIndex:
+        """
+        The prefix index of the stop names, built the first time it is needed.
+        """
+        if self._stop_index is None:
+            self._stop_index = NameIndex(self.stop_labels)
+        return self._stop_index
+
+    @property
+    def fuzzy_index(self) -> FuzzyIndex:
+        """
+        The typo tolerant index of the stops, built the first time it is needed.
+        """
+        if self._fuzzy_index is None:
+            self._fuzzy_index = FuzzyIndex(self.stops, self.stop_labels)
+        return self._fuzzy_index
+
+    def connecting_stops(self) -> List[Stop]:
+        offsets = self.stop_route_offsets
+        return [self.stops[index] for index in range(len(self.stops)) if offsets[index + 1] - offsets[index] >= 2]
+
+    def trip(self, here: int, there: int) -> List[int]:
+        """
+        The dense ids of the routes of a trip with the fewest transfers from stop here to stop there, by a breadth
+        first search over the transfer arrays (see RouteService.trip).
+        """
+        origins = self.stop_route_indices[self.stop_route_offsets[here]:self.stop_route_offsets[here + 1]]
+        destinations = set(self.stop_route_indices[self.stop_route_offsets[there]:self.stop_route_offsets[there + 1]])
+        for route in origins:
+            if route in destinations:
+                return [route]
+
+        transfer_offsets, transfer_routes = self.transfer_offsets, self.transfer_routes
+        previous: Dict[int, int] = {route: -1 for route in origins}
+        frontier = list(origins)
+        while frontier:
+            next_frontier = []
+            for route in frontier:
+                for position in range(transfer_offsets[route], transfer_offsets[route + 1]):
+                    connection = transfer_routes[position]
+                    if connection in previous:
+                        continue
+                    previous[connection] = route
+                    if connection in destinations:
+                        trip = [connection]
+                        while previous[trip[-1]] != -1:
+                            trip.append(previous[trip[-1]])
+                        trip.reverse()
+                        return trip
+                    next_frontier.append(connection)
+            frontier = next_frontier
+        return []
+
+    def search(self, here: int) -> Tuple[array.array, array.array]:
+        """
+        The breadth first search of trip() from stop here run to the end, for answering many trips from one stop. Gives
+        the previous route of every route (-1 for the starting stop's routes, -2 for routes that cannot be reached) and
+        the order the routes were reached in (-1 if never), see trip_from().
+        """
+        previous = array.array("i", [-2]) * len(self.routes)
+        order = array.array("i", [-1]) * len(self.routes)
+        frontier = list(self.stop_route_indices[self.stop_route_offsets[here]:self.stop_route_offsets[here + 1]])
+        for reached, route in enumerate(frontier):
+            previous[route], order[route] = -1, reached
+        reached = len(frontier)
+        transfer_offsets, transfer_routes = self.transfer_offsets, self.transfer_routes
+        while frontier:
+            next_frontier = []
+            for route in frontier:
+                for position in range(transfer_offsets[route], transfer_offsets[route + 1]):
+                    connection = transfer_routes[position]
+                    if order[connection] == -1:
+                        previous[connection], order[connection] = route, reached
+                        reached += 1
+                        next_frontier.append(connection)
+            frontier = next_frontier
+        return previous, order
+
+    def trip_from(self, search: Tuple[array.array, array.array], there: int) -> List[int]:
+        """
+        The trip() to stop there from the stop searched from. The destination route trip() would stop at is the one
+        its search reaches first, so trips come out the same either way.
+        """
+        previous, order = search
+        best = -1
+        for route in self.stop_route_indices[self.stop_route_offsets[there]:self.stop_route_offsets[there + 1]]:
+            if order[route] != -1 and (best == -1 or order[route] < order[best]):
+                best = route
+        if best == -1:
+            return []
+        trip = [best]
+        while previous[trip[-1]] != -1:
+            trip.append(previous[trip[-1]])
+        trip.reverse()
+        return trip
+
 
 class RouteService:
-    _logger = logging.Logger("RouteService")
+    _logger = _Logger("RouteService")
+    # The precomputed transfer table and the routes it indexes, replaced together
+    _transfer_lookup: Optional[Tuple["TransferTable", List[Route]]] = None
 
     @property
     def routes(self) -> Set[Route]:
@@ -69,42 +642,289 @@ class RouteService:
     def stop(self, stop: Union[int, str, None] = None) -> Optional[Stop]:
         raise NotImplementedError
 
+    @property
+    def connecting_stops(self) -> Set[Stop]:
+        return set(s for s in self.stops if len(s.routes) >= 2)
+
+    @property
+    def stop_index(self) -> NameIndex:
+        """
+        The prefix index of the stop names. Implementations that do not change between calls should cache it.
+        """
+        return NameIndex(str(stop) for stop in self.stops)
+
+    def stop_candidates(self, name: str, k: int = 5, threshold: float = 0.5) -> List[Tuple[Stop, float]]:
+        """
+        At most k (stop, similarity) pairs for the stops named most like name, best first, tolerating typos and
+        abbreviations (see FuzzyIndex). Implementations that do not change between calls should cache the index.
+        """
+        return FuzzyIndex(list(self.stops)).search(name, k, threshold)
+
+    def transfers(self, route: Route) -> Dict[Route, Set[Stop]]:
+        """
+        The routes connected to route, each mapped to the stops where a transfer between the two can be made.
+        Implementations with a precomputed index should override this, the default rescans the route's stops.
+        """
+        connections: Dict[Route, Set[Stop]] = {}
+        for stop in route.stops:
+            for connection in stop.routes:
+                if connection != route:
+                    connections.setdefault(connection, set()).add(stop)
+        return connections
+
     def trip(self, here: Stop, there: Stop) -> List[Route]:
         self._logger.info(f"{here} -> {there}")
         if isinstance(here, Stop) and isinstance(there, Stop):
             self._logger.info(f"Here line routes: {','.join(str(r) for r in here.routes)}")
             self._logger.info(f"There line routes: {','.join(str(r) for r in there.routes)}")
 
-            routes = []
-            for route in here.routes:
-                trip = self.__create_trip(route, there)
-                if trip:
-                    routes.append(trip)
-            routes.sort(key=lambda r: len(r))
-            if routes:
-                return routes[0]
+            lookup = self._transfer_lookup
+            if lookup is not None:
+                return self.__look_up_trip(lookup, here, there)
+            return self.__plan_trip(here, there)
         return []
 
-    def __create_trip(self, looking: Route, destination: Stop, visited: Optional[List[Route]] = None) -> List[Route]:
-        if visited is not None:
-            visit_and_look = visited + [looking]
-        else:
-            visit_and_look = [looking]
-        if destination in looking.stops:
-            return visit_and_look
-        trips = []
-        for stop in looking.stops:
-            for route in stop.routes:
-                if route not in visit_and_look:
-                    to_destination = self.__create_trip(route, destination, visit_and_look)
-                    if to_destination:
-                        trips.append(to_destination)
-        if trips:
-            trips.sort(key=lambda t: len(t))
-            return trips[0]
+    def trips(self, pairs: Iterable[Tuple[Stop, Stop]], origins: int = 1024) -> Iterator[List[Route]]:
+        """
+        The trip() for every (here, there) pair, yielded in order as the pairs are read. The search from each starting
+        stop is run to the end once and shared by every pair starting there, keeping the searches of the last origins
+        starting stops, so pairs grouped or sorted by their starting stop are cheapest.
+        """
+        searches: "collections.OrderedDict[Stop, tuple]" = collections.OrderedDict()
+        for here, there in pairs:
+            lookup = self._transfer_lookup
+            if not isinstance(here, Stop) or not isinstance(there, Stop):
+                yield []
+            elif lookup is not None:
+                yield self.__look_up_trip(lookup, here, there)
+            else:
+                search = searches.get(here)
+                if search is None:
+                    search = searches[here] = self.__search(here)
+                    if len(searches) > origins:
+                        searches.popitem(last=False)
+                else:
+                    searches.move_to_end(here)
+                yield self.__trip_from(search, here, there)
+
+    def __search(self, here: Stop) -> tuple:
+        """
+        The search from here of __plan_trip() run to the end, as (network, search) using the network's arrays when
+        here belongs to one, or (None, (previous, order)) mapping routes to the route before them and their position.
+        """
+        network = here._network
+        if network is not None:
+            return network, network.search(here._index)
+        previous: Dict[Route, Optional[Route]] = {route: None for route in here.routes}
+        order: Dict[Route, int] = {route: reached for reached, route in enumerate(previous)}
+        frontier = list(previous)
+        while frontier:
+            next_frontier = []
+            for route in frontier:
+                for connection in self.transfers(route):
+                    if connection not in previous:
+                        previous[connection], order[connection] = route, len(order)
+                        next_frontier.append(connection)
+            frontier = next_frontier
+        return None, (previous, order)
+
+    def __trip_from(self, search: tuple, here: Stop, there: Stop) -> List[Route]:
+        network, search = search
+        if network is not None:
+            if there._network is not network:
+                return self.__plan_trip(here, there)
+            return [network.routes[route] for route in network.trip_from(search, there._index)]
+        previous, order = search
+        reached = [route for route in there.routes if route in order]
+        if not reached:
+            return []
+        trip = [min(reached, key=order.__getitem__)]
+        while previous[trip[-1]] is not None:
+            trip.append(previous[trip[-1]])
+        trip.reverse()
+        return trip
+
+    def precompute(self, table: Optional["TransferTable"] = None) -> "TransferTable":
+        """
+        Switch trip() to table lookups. The table is built from this service's routes unless one (e.g. loaded from
+        disk) is given, in which case it must cover exactly the routes of this service.
+        """
+        if table is None:
+            table = TransferTable.build(self)
+        self._transfer_lookup = self._table_lookup(table, self.routes)
+        return table
+
+    @staticmethod
+    def _table_lookup(table: "TransferTable", routes: Iterable[Route]) -> Tuple["TransferTable", List[Route]]:
+        routes = {str(route.id): route for route in routes}
+        if set(routes) != set(table.route_ids):
+            raise RouteServiceException("Transfer table does not match the available routes")
+        return table, [routes[route_id] for route_id in table.route_ids]
+
+    def __look_up_trip(self, lookup: Tuple["TransferTable", List[Route]], here: Stop, there: Stop) -> List[Route]:
+        table, table_routes = lookup
+        network = table_routes[0]._network if table_routes else None
+        if here._network is not network or there._network is not network:
+            return self.__plan_trip(here, there)  # the stops and the table are of different networks
+        origins = [table.index(route.id) for route in here.routes]
+        destinations = [table.index(route.id) for route in there.routes]
+        return [table_routes[r] for r in table.path(origins, destinations)]
+
+    def __plan_trip(self, here: Stop, there: Stop) -> List[Route]:
+        """
+        Breadth-first search over routes, one level per transfer. Routes serving the starting stop form the first
+        level, and the search stops at the first level that reaches a route serving the destination, so the trip
+        returned has the fewest possible transfers. Each route is expanded at most once, using transfers(), or the
+        network's transfer arrays when both stops belong to the same Network.
+        """
+        network = here._network
+        if network is not None and network is there._network:
+            return [network.routes[route] for route in network.trip(here._index, there._index)]
+
+        destinations = there.routes
+        # Fast path, the stops share a route and no transfers are needed
+        for route in here.routes:
+            if route in destinations:
+                return [route]
+
+        previous: Dict[Route, Optional[Route]] = {route: None for route in here.routes}
+        frontier = list(here.routes)
+        while frontier:
+            next_frontier = []
+            for route in frontier:
+                for connection in self.transfers(route):
+                    if connection in previous:
+                        continue
+                    previous[connection] = route
+                    if connection in destinations:
+                        trip = [connection]
+                        while previous[trip[-1]] is not None:
+                            trip.append(previous[trip[-1]])
+                        trip.reverse()
+                        return trip
+                    next_frontier.append(connection)
+            frontier = next_frontier
         return []
 
 
+class TransferTable:
+    """
+    All-pairs minimum transfer table over routes, indexed by dense route ids (routes sorted by id).
+    transfers[a, b] is the number of transfers needed to get from route a to route b (UNREACHABLE if there is no
+    trip) and next_hop[a, b] is the route to take after a on the way to b. Paths are recovered by following
+    next_hop, so a lookup costs one table read plus one read per route in the trip.
+    Requires NumPy.
+    """
+    UNREACHABLE = 255
+    __slots__ = ("route_ids", "transfers", "next_hop", "build_seconds", "_indexes")
+
+    def __init__(self, route_ids: List[str], transfers, next_hop, build_seconds: float = 0.0):
+        self.route_ids = route_ids
+        self.transfers = transfers
+        self.next_hop = next_hop
+        self.build_seconds = build_seconds
+        self._indexes = {route_id: index for index, route_id in enumerate(route_ids)}
+
+    def __str__(self):
+        return f"{len(self.route_ids)} routes, {self.nbytes / 1024:.1f} KiB, built in {self.build_seconds * 1000:.1f} ms"
+
+    @property
+    def nbytes(self) -> int:
+        return self.transfers.nbytes + self.next_hop.nbytes
+
+    @classmethod
+    def build(cls, route_service: RouteService, network: Optional[Network] = None) -> "TransferTable":
+        """
+        One breadth-first search per destination route over the route_service.transfers() graph, or the graph of
+        network when one is given. Discovering a route from its parent during the search for b records the parent
+        as that route's next hop towards b.
+        """
+        import numpy
+
+        started = time.perf_counter()
+        if network is None:
+            routes, transfers = route_service.routes, route_service.transfers
+        else:
+            routes, transfers = network.routes, lambda route: network.transfers(route._index)
+        routes = sorted(routes, key=lambda r: str(r.id))
+        if len(routes) > numpy.iinfo(numpy.int16).max:
+            raise RouteServiceException(f"Too many routes for a transfer table ({len(routes)})")
+        indexes = {route: index for index, route in enumerate(routes)}
+        adjacency = [[indexes[connection] for connection in transfers(route)] for route in routes]
+
+        # Built with one row per destination, then transposed so rows are origins
+        transfers = numpy.full((len(routes), len(routes)), cls.UNREACHABLE, dtype=numpy.uint8)
+        next_hop = numpy.full((len(routes), len(routes)), -1, dtype=numpy.int16)
+        for destination in range(len(routes)):
+            depths = [cls.UNREACHABLE] * len(routes)
+            parents = [-1] * len(routes)
+            depths[destination] = 0
+            parents[destination] = destination
+            frontier = [destination]
+            depth = 0
+            while frontier and depth < cls.UNREACHABLE - 1:
+                depth += 1
+                next_frontier = []
+                for route in frontier:
+                    for connection in adjacency[route]:
+                        if parents[connection] == -1:
+                            parents[connection] = route
+                            depths[connection] = depth
+                            next_frontier.append(connection)
+                frontier = next_frontier
+            transfers[destination] = depths
+            next_hop[destination] = parents
+        transfers = numpy.ascontiguousarray(transfers.T)
+        next_hop = numpy.ascontiguousarray(next_hop.T)
+        return cls([str(route.id) for route in routes], transfers, next_hop, time.perf_counter() - started)
+
+    def index(self, route_id: Union[int, str]) -> int:
+        return self._indexes[str(route_id)]
+
+    def path(self, origins: List[int], destinations: List[int]) -> List[int]:
+        """
+        The dense ids of the routes of the trip with the fewest transfers from any origin route to any destination
+        route, or an empty list if there is none.
+        """
+        if not origins or not destinations:
+            return []
+        candidates = self.transfers[origins][:, destinations]
+        best = int(candidates.argmin())
+        origin, destination = origins[best // len(destinations)], destinations[best % len(destinations)]
+        if self.transfers[origin, destination] == self.UNREACHABLE:
+            return []
+        path = [origin]
+        while path[-1] != destination:
+            path.append(int(self.next_hop[path[-1], destination]))
+        return path
+
+    def save(self, path: str):
+        import numpy
+
+        with open(path, "wb") as table_file:
+            numpy.savez(
+                table_file, route_ids=numpy.array(self.route_ids, dtype=str), transfers=self.transfers,
+                next_hop=self.next_hop, build_seconds=numpy.array(self.build_seconds)
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "TransferTable":
+        """
+        A table saved by save(). A file that cannot be read, or is truncated or corrupt, raises RouteServiceException.
+        """
+        import numpy
+        import zipfile
+
+        try:
+            with numpy.load(path, allow_pickle=False) as table_file:
+                return cls(
+                    [str(route_id) for route_id in table_file["route_ids"]], table_file["transfers"], table_file["next_hop"],
+                    float(table_file["build_seconds"])
+                )
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+            raise RouteServiceException(f"Unable to load the transfer table from {path} ({e})")
+
+
 class RouteServiceException(Exception):
     pass
 
@@ -117,10 +937,245 @@ class RouteServiceJsonException(RouteServiceException):
     pass
 
 
+class JSONAPIStream:
+    """
+    Decodes a JSON:API document incrementally from chunks of UTF-8 bytes. Iterating yields the elements of the
+    primary ("data") array as soon as each has arrived, so memory is bounded by one element and one chunk rather
+    than the whole document. The document's other top level members are decoded whole, and are available from
+    members once iteration completes. Malformed documents raise ValueError, a missing primary array KeyError.
+    """
+    _whitespace = " \t\n\r"
+    # Characters that may continue a number, which is only complete once something else follows it
+    _number = "0123456789.eE+-"
+
+    def __init__(self, chunks: Iterable[bytes], primary: str = "data"):
+        import codecs
+        import json
+
+        self.members: Dict[str, object] = {}
+        self._primary = primary
+        self._chunks = iter(chunks)
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._position = 0
+        self._exhausted = False
+
+    def __iter__(self) -> Iterator[dict]:
+        if self._next() != "{":
+            raise ValueError("Expected a JSON object")
+        self._position += 1
+        if self._next() == "}":
+            self._position += 1
+        else:
+            while True:
+                key = self._value()
+                if not isinstance(key, str) or self._next() != ":":
+                    raise ValueError(f"Expected an object member at {self._position}")
+                self._position += 1
+                if key == self._primary and self._next() == "[":
+                    self._position += 1
+                    self.members[key] = None
+                    if self._next() == "]":
+                        self._position += 1
+                    else:
+                        while True:
+                            yield self._value()
+                            separator = self._next()
+                            self._position += 1
+                            if separator == "]":
+                                break
+                            elif separator != ",":
+                                raise ValueError(f"Expected ',' or ']' at {self._position - 1}")
+                else:
+                    self.members[key] = self._value()
+                separator = self._next()
+                self._position += 1
+                if separator == "}":
+                    break
+                elif separator != ",":
+                    raise ValueError(f"Expected ',' or '}}' at {self._position - 1}")
+        if self._next():
+            raise ValueError(f"Unexpected data after the document at {self._position}")
+        if self._primary not in self.members:
+            raise KeyError(self._primary)
+        elif self.members[self._primary] is not None:
+            raise ValueError(f"{self._primary} is not an array")
+
+    def _more(self) -> bool:
+        if self._exhausted:
+            return False
+        # Drop what has been decoded before growing the buffer
+        self._buffer = self._buffer[self._position:]
+        self._position = 0
+        try:
+            self._buffer += self._text.decode(next(self._chunks))
+        except StopIteration:
+            self._buffer += self._text.decode(b"", final=True)
+            self._exhausted = True
+        return True
+
+    def _next(self) -> str:
+        """
+        Skip whitespace, returning the next character ("" at the end of the document) without consuming it.
+        """
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in self._whitespace:
+                self._position += 1
+            if self._position < len(self._buffer) or not self._more():
+                return self._buffer[self._position:self._position + 1]
+
+    def _value(self):
+        """
+        Decode the value at the current position, reading more of the document until it is complete. A value is only
+        complete once something follows it (or the document ends), and a number once something that cannot continue
+        it does, so a number is never cut short at a chunk boundary.
+        """
+        self._next()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+                number = isinstance(value, (int, float)) and not isinstance(value, bool)
+                if self._exhausted or (end < len(self._buffer) and not (number and self._buffer[end] in self._number)):
+                    self._position = end
+                    return value
+            except ValueError:  # json.JSONDecodeError, the value is incomplete (or malformed)
+                if self._exhausted:
+                    raise
+            self._more()
+
+
+class EventStream:
+    """
+    Server-sent events (text/event-stream) decoded incrementally from chunks of UTF-8 bytes. Iterating yields each
+    event as (event, data) as soon as the blank line ending it has arrived; comments (keep-alives) are skipped. The
+    reconnection delay the server last asked for (its retry field, in seconds) and last event id are kept in retry
+    and last_id.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.retry: Optional[float] = None
+        self.last_id: Optional[str] = None
+        self._chunks = chunks
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        import codecs
+
+        text = codecs.getincrementaldecoder("utf-8")()
+        buffer, event, data = "", "", []
+        for chunk in self._chunks:
+            buffer += text.decode(chunk)
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                line = line[:-1] if line.endswith("\r") else line
+                if not line:
+                    if data:
+                        yield event or "message", "\n".join(data)
+                    event, data = "", []
+                    continue
+                field, _, value = line.partition(":")
+                value = value[1:] if value.startswith(" ") else value
+                if field == "event":
+                    event = value
+                elif field == "data":
+                    data.append(value)
+                elif field == "id":
+                    self.last_id = value
+                elif field == "retry" and value.isdigit():
+                    self.retry = int(value) / 1000
+
+
 ###
 # MBTA Specific implementations
 ###
-class MBTARoute(Route):
+class MBTAResource:
+    """
+    Parsing shared by MBTA routes and stops. Members of the JSON:API resource and its attributes are copied to the
+    slots of the same name. Resources requested with a sparse fieldset (lean loading) are parsed with a details
+    callback and leave what was not sent unset (and listed in _missing); the first access of an unset attribute calls
+    details(resource), which is expected to fill in the rest (see MBTARouteService) through _update().
+    """
+    __slots__ = ()
+    _resource_type = "resource"
+    _members: Tuple[str, ...] = ("relationships", "links")
+    _attributes: Tuple[str, ...] = ()
+    # Attributes always present, lean or not
+    _required_attributes: Tuple[str, ...] = ()
+    # Relationships that depend on the request the resource came from rather than on the resource, left out of digest()
+    _request_relationships: Tuple[str, ...] = ()
+
+    def _update(self, json_source: dict, partial: bool = False):
+        attributes = json_source["attributes"]
+        missing = []
+        for member in self._members:
+            if not partial or member in json_source:
+                setattr(self, member, json_source[member])
+            elif member in self._missing:
+                missing.append(member)
+        for attribute in self._attributes:
+            if not partial or attribute in attributes or attribute in self._required_attributes:
+                setattr(self, attribute, attributes[attribute])
+            elif attribute in self._missing:
+                missing.append(attribute)
+        self._missing = tuple(missing)
+        if not missing:
+            self._details = None
+
+    def __getattr__(self, name: str):
+        # Only called for unset slots, which are attributes left out of a lean response
+        if name != "_details" and self._details is not None and (name in self._members or name in self._attributes):
+            self._details(self)
+            return object.__getattribute__(self, name)
+        raise AttributeError(f"'{self.__class__.__name__}' object has no attribute '{name}'")
+
+    @property
+    def lean(self) -> bool:
+        return self._details is not None
+
+    def digest(self, lean: bool = False) -> str:
+        """
+        A hash of the resource's JSON (as_json()), or with lean of its id and the attributes lean loading requests, for
+        telling whether a resource changed between loads.
+        """
+        import hashlib
+        import json
+
+        resource = self.as_json()
+        relationships = resource.get("relationships")
+        if isinstance(relationships, dict) and any(name in relationships for name in self._request_relationships):
+            resource["relationships"] = {name: value for name, value in relationships.items() if name not in self._request_relationships}
+        if lean:
+            attributes = resource["attributes"]
+            resource = {"id": self.id, "attributes": {a: attributes[a] for a in self._required_attributes if a in attributes}}
+        return hashlib.sha1(json.dumps(resource, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+    def as_json(self) -> dict:
+        """
+        The JSON:API resource this was parsed from (less the attributes that are not kept, or not loaded yet).
+        """
+        resource = {"type": self._resource_type, "id": self.id, "attributes": {}}
+        for member in self._members:
+            if member not in self._missing:
+                resource[member] = getattr(self, member)
+        for attribute in self._attributes:
+            if attribute not in self._missing:
+                resource["attributes"][attribute] = getattr(self, attribute)
+        return resource
+
+    def copy(self) -> "MBTAResource":
+        """
+        A resource with the same id and content (and details callback) that is not part of any network.
+        """
+        resource = object.__new__(self.__class__)
+        super(MBTAResource, resource).__init__(self.id)
+        resource._details, resource._missing = self._details, self._missing
+        for name in self._members + self._attributes:
+            if name not in self._missing:
+                setattr(resource, name, getattr(self, name))
+        return resource
+
+
+class MBTARoute(MBTAResource, Route):
     """
     {
       "type": "string",
@@ -145,28 +1200,24 @@ class MBTARoute(Route):
       }
     }
     """
-    __slots__ = ("type", "relationships", "links", "short_name", "long_name", "fare_class", "direction_names", "direction_destinations", "description", "color")
 
-    def __init__(self, json_source):
-        super(MBTARoute, self).__init__(json_source["id"])
+    __slots__ = ("type", "relationships", "links", "short_name", "long_name", "fare_class", "direction_names", "direction_destinations", "description", "color", "_details", "_missing")
+    _resource_type = "route"
+    _attributes = ("type", "short_name", "long_name", "fare_class", "direction_names", "direction_destinations", "description", "color")
+    _required_attributes = ("long_name",)
+    lean_fields = ",".join(_required_attributes)
 
-        self.type = json_source["type"]
-        self.relationships = json_source["relationships"]
-        self.links = json_source["links"]
-        self.type = json_source["attributes"]["type"]
-        self.short_name = json_source["attributes"]["short_name"]
-        self.long_name = json_source["attributes"]["long_name"]
-        self.fare_class = json_source["attributes"]["fare_class"]
-        self.direction_names = json_source["attributes"]["direction_names"]
-        self.direction_destinations = json_source["attributes"]["direction_destinations"]
-        self.description = json_source["attributes"]["description"]
-        self.color = json_source["attributes"]["color"]
+    def __init__(self, json_source, details: Optional[Callable[["MBTARoute"], None]] = None):
+        super(MBTARoute, self).__init__(json_source["id"])
+        self._details = details
+        self._missing = self._members + self._attributes
+        self._update(json_source, partial=details is not None)
 
     def __str__(self):
         return self.long_name
 
 
-class MBTAStop(Stop):
+class MBTAStop(MBTAResource, Stop):
     """
     {
       "type": "string",
@@ -204,29 +1255,25 @@ class MBTAStop(Stop):
 
     __slots__ = (
         "type", "relationships", "links", "address", "at_street", "description", "longitude", "location_type",
-        "latitude", "municipality", "name", "platform_name", "platform_code", "vehicle_type", "wheelchair_boarding"
+        "latitude", "municipality", "name", "platform_name", "platform_code", "vehicle_type", "wheelchair_boarding",
+        "_details", "_missing"
     )
+    _resource_type = "stop"
+    _members = ("type", "relationships", "links")
+    _attributes = (
+        "address", "at_street", "description", "longitude", "location_type", "latitude", "municipality", "name",
+        "platform_name", "platform_code", "vehicle_type", "wheelchair_boarding"
+    )
+    _required_attributes = ("name",)
+    # Included with the stops of several routes, naming the one each copy was sent for
+    _request_relationships = ("route",)
+    lean_fields = ",".join(_required_attributes)
 
-    def __init__(self, json_source):
+    def __init__(self, json_source, details: Optional[Callable[["MBTAStop"], None]] = None):
         super(MBTAStop, self).__init__(json_source["id"])
-        self.type = json_source["type"]
-        self.relationships = json_source["relationships"]
-        self.links = json_source["links"]
-
-        self.address = json_source["attributes"]["address"]
-        self.at_street = json_source["attributes"]["at_street"]
-        self.description = json_source["attributes"]["description"]
-        self.longitude = json_source["attributes"]["longitude"]
-        self.location_type = json_source["attributes"]["location_type"]
-        self.latitude = json_source["attributes"]["latitude"]
-        self.municipality = json_source["attributes"]["municipality"]
-        self.name = json_source["attributes"]["name"]
-        self.platform_name = json_source["attributes"]["platform_name"]
-        self.platform_code = json_source["attributes"]["platform_code"]
-        self.vehicle_type = json_source["attributes"]["vehicle_type"]
-        self.wheelchair_boarding = json_source["attributes"]["wheelchair_boarding"]
-
-        self.routes = set()
+        self._details = details
+        self._missing = self._members + self._attributes
+        self._update(json_source, partial=details is not None)
 
     def __str__(self):
         return self.name
@@ -260,112 +1307,2101 @@ class RouteTypes(Enum):
     MONORAIL = 12
 
 
+class NetworkSnapshot:
+    """
+    A loaded network saved in a compact, versioned binary format, for starting without network I/O. The file is
+      magic (8 bytes), format version and header length (unsigned 32 bit little endian), the header (UTF-8 JSON)
+    followed by the sections listed in the header, each at an offset from the end of the header:
+      - the CSR arrays of the Network (signed 32 bit little endian), its precomputed indexes included
+      - "names", the string table of the route ids, route names (str()), stop ids and stop names, separated by NUL
+      - "resources", the JSON:API resources (as_json()) of the routes then the stops, UTF-8 JSON back to back, and
+        "resource_offsets", the byte offset of each in resources and of its end (signed 32 bit little endian)
+    Loading is a single read (or map): the arrays are copied out in bulk and the names split in one go. A resource is
+    decoded from the file's bytes only when the network first needs its object (see network()).
+    """
+    magic = b"RTSNAPSH"
+    version = 1
+    _prefix = struct.Struct("<8sII")
+    __slots__ = (
+        "key", "created", "validators", "arrays", "route_ids", "stop_ids", "route_labels", "stop_labels",
+        "_resources", "_resource_offsets", "_route_indexes"
+    )
+
+    def __init__(self, key: str, created: float, validators: dict, arrays: Dict[str, array.array], names: List[str],
+                 resources: memoryview, resource_offsets: array.array):
+        routes = len(arrays["route_stop_offsets"]) - 1
+        stops = len(arrays["stop_route_offsets"]) - 1
+        if routes < 0 or stops < 0 or len(names) != 2 * (routes + stops) or len(resource_offsets) != routes + stops + 1:
+            raise ValueError("Inconsistent network snapshot")
+        self.key = key
+        self.created = created
+        self.validators = validators
+        self.arrays = arrays
+        self.route_ids, self.route_labels = names[:routes], names[routes:2 * routes]
+        self.stop_ids, self.stop_labels = names[2 * routes:2 * routes + stops], names[2 * routes + stops:]
+        self._resources = resources
+        self._resource_offsets = resource_offsets
+        self._route_indexes: Optional[Dict[str, int]] = None
+
+    @classmethod
+    def dumps(cls, network: Network, key: str, validators: dict, created: Optional[float] = None) -> bytes:
+        """
+        The snapshot of network, whose routes and stops are MBTA resources (with as_json()).
+        """
+        import json
+
+        names = [str(route.id) for route in network.routes] + list(network.route_labels)
+        names += [str(stop.id) for stop in network.stops] + list(network.stop_labels)
+        if any("\0" in name for name in names):
+            raise ValueError("Route and stop ids and names can not contain NUL")
+        resources = [
+            json.dumps(resource.as_json(), separators=(",", ":")).encode("utf-8")
+            for resource in itertools.chain(network.routes, network.stops)
+        ]
+        resource_offsets = array.array("i", [0])
+        resource_offsets.extend(itertools.accumulate(len(resource) for resource in resources))
+
+        sections = [(name, getattr(network, name)) for name in Network._arrays] + [("resource_offsets", resource_offsets)]
+        body = []
+        for _, section in sections:
+            if sys.byteorder != "little":
+                section = array.array(section.typecode, section)
+                section.byteswap()
+            body.append(section.tobytes())
+        body.append("\0".join(names).encode("utf-8"))
+        body.append(b"".join(resources))
+        header, position = {}, 0
+        for name, data in zip([name for name, _ in sections] + ["names", "resources"], body):
+            header[name] = [position, len(data)]
+            position += len(data)
+        header = json.dumps({
+            "key": key, "created": time.time() if created is None else created, "validators": validators,
+            "sections": header
+        }, separators=(",", ":")).encode("utf-8")
+        return b"".join([cls._prefix.pack(cls.magic, cls.version, len(header)), header] + body)
+
+    @classmethod
+    def loads(cls, data: bytes) -> "NetworkSnapshot":
+        """
+        The snapshot saved in data, raising ValueError if it is not one (of this version).
+        """
+        import json
+
+        if len(data) < cls._prefix.size:
+            raise ValueError("Truncated network snapshot")
+        magic, version, header_length = cls._prefix.unpack_from(data)
+        if magic != cls.magic or version != cls.version:
+            raise ValueError("Not a network snapshot (of this version)")
+        view = memoryview(data)
+        start = cls._prefix.size + header_length
+        try:
+            header = json.loads(bytes(view[cls._prefix.size:start]))
+            sections = {}
+            for name, (offset, length) in header["sections"].items():
+                if start + offset + length > len(data):
+                    raise ValueError(f"Truncated network snapshot section {name}")
+                sections[name] = view[start + offset:start + offset + length]
+            arrays = {}
+            for name in Network._arrays + ("resource_offsets",):
+                arrays[name] = array.array("i")
+                arrays[name].frombytes(sections[name])
+                if sys.byteorder != "little":
+                    arrays[name].byteswap()
+            names = str(sections["names"], "utf-8").split("\0") if len(sections["names"]) else []
+            resource_offsets = arrays.pop("resource_offsets")
+            if resource_offsets and resource_offsets[-1] != len(sections["resources"]):
+                raise ValueError("Inconsistent network snapshot resources")
+            return cls(
+                header["key"], float(header["created"]), dict(header["validators"]), arrays, names,
+                sections["resources"], resource_offsets
+            )
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Malformed network snapshot header ({e!r})")
+
+    def __resource(self, index: int) -> dict:
+        import json
+        return json.loads(bytes(self._resources[self._resource_offsets[index]:self._resource_offsets[index + 1]]))
+
+    def route_json(self, index: int) -> dict:
+        return self.__resource(index)
+
+    def stop_json(self, index: int) -> dict:
+        return self.__resource(len(self.route_ids) + index)
+
+    def route_stops(self, route_id: str) -> List[int]:
+        """
+        The dense ids of the stops of the route with route_id, raising KeyError if there is no such route.
+        """
+        if self._route_indexes is None:
+            self._route_indexes = {route_id: index for index, route_id in enumerate(self.route_ids)}
+        index = self._route_indexes[route_id]
+        offsets = self.arrays["route_stop_offsets"]
+        return list(self.arrays["route_stop_indices"][offsets[index]:offsets[index + 1]])
+
+    def network(self, route: Callable[[dict], Route], stop: Callable[[dict], Stop]) -> Network:
+        """
+        The network saved, its routes and stops made from their JSON:API resources by route() and stop() as used.
+        """
+        return Network.restore(
+            self.arrays, self.route_ids, self.stop_ids, self.route_labels, self.stop_labels,
+            lambda index: route(self.route_json(index)), lambda index: stop(self.stop_json(index))
+        )
+
+
+class NetworkCache:
+    """
+    Networks saved on disk so a service can start without any network I/O. Each network is a NetworkSnapshot in
+    directory (by default under the XDG cache directory) named for the base URL and route types it was loaded with.
+    Networks older than ttl seconds are treated as missing.
+    """
+    _logger = _Logger("RouteService.Cache")
+
+    def __init__(self, directory: Optional[str] = None, ttl: float = 24 * 60 * 60):
+        if directory is None:
+            directory = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "routes-and-stops")
+        self.directory = directory
+        self.ttl = ttl
+
+    def path(self, key: str) -> str:
+        import hashlib
+        return os.path.join(self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest()[:32] + ".snapshot")
+
+    def read(self, key: str, expired: bool = False) -> Optional[NetworkSnapshot]:
+        """
+        The cached network for key, or None if there is none or (unless expired is True) it is older than ttl.
+        """
+        try:
+            with open(self.path(key), "rb") as cache_file:
+                snapshot = NetworkSnapshot.loads(self.__map(cache_file))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self._logger.warning(f"Ignoring unreadable network cache ({e})")
+            return None
+        if snapshot.key != key:
+            return None
+        if not expired and not self.fresh(snapshot):
+            return None
+        return snapshot
+
+    @staticmethod
+    def __map(cache_file) -> Union[bytes, "mmap.mmap"]:
+        """
+        The contents of cache_file, mapped into memory so only the parts used are read from disk. Windows can not
+        replace a mapped file, and the snapshot is used for as long as its network is, so there it is read instead.
+        """
+        if os.name != "nt":
+            import mmap
+            try:
+                return mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):  # empty files, and file systems that can not map
+                pass
+        return cache_file.read()
+
+    def fresh(self, snapshot: NetworkSnapshot) -> bool:
+        return time.time() - snapshot.created <= self.ttl
+
+    def write(self, key: str, network: Network, validators: dict):
+        """
+        Replace the cached network for key. The file is written under a temporary name and renamed into place, so a
+        reader never sees a partial file.
+        """
+        data = NetworkSnapshot.dumps(network, key, validators)
+        os.makedirs(self.directory, exist_ok=True)
+        _replace_file(self.path(key), data)
+
+    def clear(self, key: Optional[str] = None):
+        """
+        Remove the cached network for key, or every cached network if no key is given.
+        """
+        if key is not None:
+            paths = [self.path(key)]
+        elif os.path.isdir(self.directory):
+            # .json files are networks cached by earlier versions
+            paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith((".snapshot", ".json", ".tmp"))]
+        else:
+            paths = []
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class NetworkChanges:
+    """
+    What a refresh() (or streamed update) changed: the ids of the routes added, changed (whose stops were requested
+    again, or which were updated) and removed, of the stops added or updated by streamed updates, and of the stops no
+    route serves any longer.
+    """
+    __slots__ = ("added", "changed", "removed", "changed_stops", "removed_stops")
+
+    def __init__(
+            self, added: Iterable = (), changed: Iterable = (), removed: Iterable = (), removed_stops: Iterable = (),
+            changed_stops: Iterable = ()
+    ):
+        self.added: List[Union[int, str]] = list(added)
+        self.changed: List[Union[int, str]] = list(changed)
+        self.removed: List[Union[int, str]] = list(removed)
+        self.changed_stops: List[Union[int, str]] = list(changed_stops)
+        self.removed_stops: List[Union[int, str]] = list(removed_stops)
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed or self.changed_stops or self.removed_stops)
+
+    def __str__(self):
+        return (
+            f"{len(self.added)} routes added, {len(self.changed)} changed and {len(self.removed)} removed, "
+            f"{len(self.changed_stops)} stops added or changed and {len(self.removed_stops)} removed"
+        )
+
+
+class _NoPhase:
+    """
+    The phase of a service without timings, timing nothing.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_unused_args):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+class _Phase:
+    __slots__ = ("timings", "name", "started", "nested")
+
+    def __init__(self, timings: "PhaseTimings", name: str):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.nested = 0.0
+        self.timings._stack().append(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *_unused_args):
+        elapsed = time.perf_counter() - self.started
+        stack = self.timings._stack()
+        stack.pop()
+        if stack:
+            stack[-1].nested += elapsed
+        self.timings.add(self.name, elapsed - self.nested, elapsed)
+
+
+class PhaseTimings:
+    """
+    Where the time of a service's loads and queries goes, by phase: waiting for HTTP responses and reading them
+    ("http"), retry backoff ("backoff"), JSON decoding ("decode"), making routes and stops from their resources
+    ("construct"), assembling the network ("assemble"), reading and writing the cache ("cache") and planning trips
+    ("plan"). Phases nest, and a phase's seconds leave out the phases nested in it, so they add up to the time of the
+    outermost phase ("load" includes waiting for workers and whatever was not in another phase). Phases run by
+    concurrent workers add up to more than the wall-clock time. Pass one to MBTARouteService to time it, a service
+    without one times nothing.
+    """
+    phases = ("load", "refresh", "http", "backoff", "decode", "construct", "assemble", "cache", "plan")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # [calls, seconds, inclusive seconds] by phase
+        self._phases: Dict[str, List[float]] = {}
+
+    def _stack(self) -> List[_Phase]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def phase(self, name: str) -> _Phase:
+        """
+        A context manager timing its block as a call of phase name.
+        """
+        return _Phase(self, name)
+
+    def iterate(self, name: str, iterable: Iterable) -> Iterator:
+        """
+        The items of iterable, producing each timed as a call of phase name.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add(self, name: str, seconds: float, inclusive: Optional[float] = None):
+        """
+        Count a call of phase name taking seconds, for time measured outside of phase() (e.g. by coroutines, whose
+        phases would interleave).
+        """
+        with self._lock:
+            totals = self._phases.get(name)
+            if totals is None:
+                totals = self._phases[name] = [0, 0.0, 0.0]
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += seconds if inclusive is None else inclusive
+
+    def reset(self):
+        with self._lock:
+            self._phases = {}
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        The calls, seconds and inclusive_seconds (counting nested phases) of every phase timed, in phases order.
+        """
+        with self._lock:
+            phases = {name: list(totals) for name, totals in self._phases.items()}
+        order = {name: index for index, name in enumerate(self.phases)}
+        return {
+            name: {"calls": int(calls), "seconds": seconds, "inclusive_seconds": inclusive}
+            for name, (calls, seconds, inclusive) in sorted(phases.items(), key=lambda item: (order.get(item[0], len(order)), item[0]))
+        }
+
+    def __str__(self):
+        stats = self.stats()
+        total = sum(phase["seconds"] for phase in stats.values())
+        lines = [f"{'phase':<10} {'calls':>8} {'seconds':>10} {'share':>7} {'mean ms':>10} {'incl. s':>10}"]
+        for name, phase in stats.items():
+            lines.append(
+                f"{name:<10} {phase['calls']:>8} {phase['seconds']:>10.4f} {phase['seconds'] / total if total else 0:>7.1%} "
+                f"{phase['seconds'] / phase['calls'] * 1000:>10.3f} {phase['inclusive_seconds']:>10.4f}"
+            )
+        lines.append(f"{'total':<10} {sum(phase['calls'] for phase in stats.values()):>8} {total:>10.4f}")
+        return "\n".join(lines)
+
+
+class _Metric:
+    __slots__ = ("name", "help", "labels", "_lock", "_values")
+
+    def __init__(self, registry: "MetricsRegistry", name: str, help_text: str, labels: Sequence[str]):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = registry._lock
+        self._values: dict = {}
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _samples(self) -> Iterator[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        """
+        (name, ((label, value), ...), value) of every sample, as exported.
+        """
+        raise NotImplementedError
+
+
+class MetricCounter(_Metric):
+    """
+    A counter of a MetricsRegistry, one value for every combination of its label values.
+    """
+    __slots__ = ()
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels: object):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: object) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> Iterator[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        for key, value in sorted(self._values.items()):
+            yield self.name, tuple(zip(self.labels, key)), value
+
+
+class MetricHistogram(_Metric):
+    """
+    A histogram of a MetricsRegistry: the number of observations up to each of its bucket bounds, their count and
+    sum, for every combination of its label values.
+    """
+    __slots__ = ("buckets",)
+    type = "histogram"
+    # The Prometheus client's default buckets, in seconds
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, registry: "MetricsRegistry", name: str, help_text: str, labels: Sequence[str], buckets: Sequence[float] = default_buckets):
+        super().__init__(registry, name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: object):
+        key = self._key(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            observations = self._values.get(key)
+            if observations is None:
+                # The observations in each bucket (not cumulative) and above the last, and their sum
+                observations = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            observations[0][bucket] += 1
+            observations[1] += value
+
+    def count(self, **labels: object) -> int:
+        observations = self._values.get(self._key(labels))
+        return 0 if observations is None else sum(observations[0])
+
+    def sum(self, **labels: object) -> float:
+        observations = self._values.get(self._key(labels))
+        return 0.0 if observations is None else observations[1]
+
+    def _samples(self) -> Iterator[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        for key, (buckets, total) in sorted(self._values.items()):
+            labels = tuple(zip(self.labels, key))
+            cumulative = 0
+            for bound, observations in zip(self.buckets + (math.inf,), buckets):
+                cumulative += observations
+                yield f"{self.name}_bucket", labels + (("le", "+Inf" if bound == math.inf else repr(float(bound))),), cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms of a service, exported in the Prometheus text format by render() (served by RouteServer
+    at /metrics) or write(). counter() and histogram() return the metric of that name, registering it first, so
+    services sharing a registry share their metrics. Pass one to MBTARouteService to record:
+      route_service_http_request_duration_seconds{endpoint,status} - time to the response (retries included)
+      route_service_http_retries_total{endpoint,reason} - retried requests, by status (e.g. 429) or error
+      route_service_http_backoff_seconds_total - time spent waiting to retry
+      route_service_http_received_bytes_total{endpoint} - response body bytes
+      route_service_load_duration_seconds{kind} - loads and refreshes
+      route_service_cache_requests_total{result} - network cache hit, miss, expired (revalidated) or bypass
+      route_service_lookups_total{kind,result} - stop() and route() hits and misses
+      route_service_trip_duration_seconds - trip() and trips(), per trip
+    and to RouteServer route_service_server_request_duration_seconds{op}.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, _Metric] = {}
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str] = ()) -> MetricCounter:
+        return self.__register(MetricCounter, name, help_text, labels)
+
+    def histogram(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = MetricHistogram.default_buckets) -> MetricHistogram:
+        return self.__register(MetricHistogram, name, help_text, labels, buckets)
+
+    def __register(self, metric_type: type, name: str, help_text: str, labels: Sequence[str], *args) -> _Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_type(self, name, help_text, labels, *args)
+        if type(metric) is not metric_type or metric.labels != tuple(labels):
+            raise ValueError(f"{name} is already registered as another metric")
+        return metric
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """
+        Every metric in the Prometheus text exposition format (version 0.0.4).
+        """
+        lines = []
+        with self._lock:
+            for name, metric in sorted(self._metrics.items()):
+                lines.append(f"# HELP {name} {self.__escape(metric.help)}")
+                lines.append(f"# TYPE {name} {metric.type}")
+                for sample, labels, value in metric._samples():
+                    if labels:
+                        sample += "{" + ",".join(f'{label}="{self.__escape(label_value, quote=True)}"' for label, label_value in labels) + "}"
+                    lines.append(f"{sample} {value!r}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def __escape(text: str, quote: bool = False) -> str:
+        text = text.replace("\\", "\\\\").replace("\n", "\\n")
+        return text.replace('"', '\\"') if quote else text
+
+    def write(self, path: str):
+        """
+        Write render() to path, replacing it at once so a collector reading it (e.g. node_exporter's textfile
+        collector) never sees part of it.
+        """
+        _replace_file(path, self.render().encode("utf-8"))
+
+
+class _ServiceMetrics:
+    """
+    The metrics an MBTARouteService records in its registry.
+    """
+    # Trips take microseconds to milliseconds
+    trip_buckets = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+    def __init__(self, registry: MetricsRegistry):
+        self.http_duration = registry.histogram("route_service_http_request_duration_seconds", "Time until the API responded, retries included", ("endpoint", "status"))
+        self.http_retries = registry.counter("route_service_http_retries_total", "Requests retried, by response status or error", ("endpoint", "reason"))
+        self.http_backoff = registry.counter("route_service_http_backoff_seconds_total", "Time spent waiting to retry requests")
+        self.http_bytes = registry.counter("route_service_http_received_bytes_total", "Response body bytes received", ("endpoint",))
+        self.load_duration = registry.histogram("route_service_load_duration_seconds", "Network loads and refreshes", ("kind",), (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+        self.cache = registry.counter("route_service_cache_requests_total", "Network cache hits, misses, expired networks revalidated and bypasses", ("result",))
+        self.lookups = registry.counter("route_service_lookups_total", "Stop and route lookups, by whether one was found", ("kind", "result"))
+        self.trip_duration = registry.histogram("route_service_trip_duration_seconds", "Trips planned", (), self.trip_buckets)
+
+
 class MBTARouteService(RouteService):
-    _logger = logging.Logger("RouteService.MBTA")
+    _logger = _Logger("RouteService.MBTA")
 
     base_url = "https://api-v3.mbta.com"
     route_path = "/routes"
     stop_path = "/stops"
-
-    def __init__(self, api_key: Optional[str] = None, route_types: List[RouteTypes] = None):
-        self._session = requests.Session()
-        _adapter = HTTPAdapter(max_retries=Retry(
-            total=5,
-            backoff_factor=2.0,  # {backoff_factor} * (2 ** ({number of total retries} - 1))
-            allowed_methods=frozenset(["GET"]),
-            respect_retry_after_header=True,
-            status_forcelist=frozenset({429}),
-        ))
-        self._session.mount("http://", _adapter)
-        self._session.mount("https://", _adapter)
-        # Set the headers for the entire session
-        if api_key is not None:
-            self._session.headers = {"x-api-key": api_key}
+    # Retries of rate limited (429) requests
+    retries = 5
+    backoff_factor = 2.0  # {backoff_factor} * (2 ** ({number of total retries} - 1))
+    # Responses are decoded as they are received, this many bytes at a time
+    chunk_size = 64 * 1024
+    # Attributes left out by lean loading are requested for up to this many routes or stops at a time
+    details_batch = 100
+    # Streamed updates (see subscribe()) reconnect after this many seconds without an event or keep-alive
+    stream_timeout = 5 * 60
+
+    def __init__(
+            self, api_key: Optional[str] = None, route_types: List[RouteTypes] = None, workers: int = 8, bulk: int = 0,
+            cache: Optional[NetworkCache] = None, lean: bool = False, timings: Optional[PhaseTimings] = None,
+            metrics: Optional[MetricsRegistry] = None
+    ):
+        self._api_key = api_key
+        self._cache = cache
+        # Where the time of loads and queries goes, nothing is timed without it
+        self.timings = timings
+        # Requests, loads, lookups and trips are recorded in metrics, if given
+        self.metrics = metrics
+        self._metrics = None if metrics is None else _ServiceMetrics(metrics)
+        # Only request the attributes needed for planning, the rest are requested when first used
+        self._lean = lean
+        self.__details_lock = threading.Lock()
+        # Held by load() and refresh() while they replace the network, readers never take it
+        self.__refresh_lock = threading.RLock()
+        self.__lean_routes: Dict[Union[int, str], MBTARoute] = {}
+        self.__lean_stops: Dict[Union[int, str], MBTAStop] = {}
+        # Stops are requested concurrently, one worker thread (and session) per in flight request. The worker threads
+        # are started by the first load and kept, with their sessions and connections, until close()
+        self._workers = max(1, workers)
+        self.__executor = None
+        # Stops are requested for up to this many routes per request, 0 or 1 requests them one route at a time
+        self._bulk = bulk
+        # Every thread, the loading thread included, has its own session, made when it first sends a request
+        self._local = threading.local()
+        self.__sessions: List["requests.Session"] = []
+        self.__sessions_lock = threading.Lock()
 
         if route_types is None:
             self._route_types = []
         else:
             self._route_types = route_types
-        self.__routes: Optional[Dict[Union[int, str], MBTARoute]] = None
-        self.__stops: Optional[Dict[Union[int, str], MBTAStop]] = None
+        # Everything loaded is in the network, replaced as a whole (one assignment) by every load and refresh
+        self.__network: Optional[Network] = None
+        # The cached network being revalidated by a load, and the validators of the responses of the last load
+        self.__previous: Optional[NetworkSnapshot] = None
+        self.__validators: Dict[str, Dict[str, str]] = {}
+        # The validators sent by the requests of a load or refresh, by URL
+        self.__revalidated: Dict[str, Dict[str, str]] = {}
 
     @property
-    def routes(self) -> Set[MBTARoute]:
-        if self.__routes is None:
-            self.__get_routes_and_stops()
-        return set(self.__routes.values())
+    def loaded(self) -> bool:
+        return self.__network is not None
 
     @property
-    def stops(self) -> Set[MBTAStop]:
-        if self.__stops is None:
-            self.__get_routes_and_stops()
-        return set(self.__stops.values())
+    def network(self) -> Network:
+        if self.__network is None:
+            self._load()
+        return self.__network
+
+    @property
+    def routes(self) -> FrozenSet[MBTARoute]:
+        return self.network.route_set
+
+    @property
+    def stops(self) -> FrozenSet[MBTAStop]:
+        return self.network.stop_set
 
     def route(self, route: Union[int, str, None] = None) -> Optional[MBTARoute]:
-        if self.routes:
-            return self.__routes.get(str(route).casefold(), None)  # allow case-insensitive matching
-        else:
-            return None
+        found = self.network.route(route)  # by id, or case-insensitive name
+        if self._metrics is not None:
+            self._metrics.lookups.inc(kind="route", result="miss" if found is None else "hit")
+        return found
 
     def stop(self, stop: Union[int, str, None] = None) -> Optional[MBTAStop]:
-        if self.stops:
-            return self.__stops.get(str(stop).casefold(), None)  # allow case-insensitive matching
+        found = self.network.stop(stop)  # by id, or case-insensitive name
+        if self._metrics is not None:
+            self._metrics.lookups.inc(kind="stop", result="miss" if found is None else "hit")
+        return found
+
+    @property
+    def connecting_stops(self) -> Set[MBTAStop]:
+        return set(self.network.connecting_stops())
+
+    @property
+    def stop_index(self) -> NameIndex:
+        return self.network.stop_index
+
+    def stop_candidates(self, name: str, k: int = 5, threshold: float = 0.5) -> List[Tuple[MBTAStop, float]]:
+        return self.network.fuzzy_index.search(name, k, threshold)
+
+    def trip(self, here: MBTAStop, there: MBTAStop) -> List[MBTARoute]:
+        if self.timings is None and self._metrics is None:
+            return super(MBTARouteService, self).trip(*self.__same_network(here, there))
+        started = time.perf_counter()
+        with self._phase("plan"):
+            trip = super(MBTARouteService, self).trip(*self.__same_network(here, there))
+        if self._metrics is not None:
+            self._metrics.trip_duration.observe(time.perf_counter() - started)
+        return trip
+
+    def trips(self, pairs: Iterable[Tuple[MBTAStop, MBTAStop]], origins: int = 1024) -> Iterator[List[MBTARoute]]:
+        trips = super(MBTARouteService, self).trips((self.__same_network(here, there) for here, there in pairs), origins)
+        if self.timings is not None:
+            trips = self.timings.iterate("plan", trips)
+        return trips if self._metrics is None else self.__observed_trips(trips)
+
+    def __observed_trips(self, trips: Iterator[List[MBTARoute]]) -> Iterator[List[MBTARoute]]:
+        while True:
+            started = time.perf_counter()
+            trip = next(trips, None)
+            if trip is None:
+                return
+            self._metrics.trip_duration.observe(time.perf_counter() - started)
+            yield trip
+
+    def _phase(self, name: str):
+        """
+        A context manager timing its block as phase name of the service's timings, if it has any.
+        """
+        timings = self.timings
+        return _NO_PHASE if timings is None else timings.phase(name)
+
+    def __same_network(self, here: MBTAStop, there: MBTAStop) -> Tuple[MBTAStop, MBTAStop]:
+        """
+        Stops of one network are planned on that network, even if it has been replaced since. Stops of different
+        networks, looked up on either side of a refresh, are both planned on the current network.
+        """
+        if isinstance(here, Stop) and isinstance(there, Stop) and (here._network is not there._network or here._network is None):
+            network = self.network
+            here_index, there_index = network.stop_ids.get(here.id), network.stop_ids.get(there.id)
+            if here_index is not None and there_index is not None:
+                return network.stops[here_index], network.stops[there_index]
+        return here, there
+
+    def transfers(self, route: MBTARoute) -> Dict[MBTARoute, Set[MBTAStop]]:
+        network = self.network
+        if route._network is not network:
+            index = network.route_ids.get(route.id)
+            if index is None:
+                return {}
+            route = network.routes[index]
+        return network.transfers(route._index)
+
+    def _new_session(self) -> "requests.Session":
+        """
+        Sessions are not shared between threads, each worker builds its own with the same retry behavior.
+        """
+        import requests
+        from requests.adapters import HTTPAdapter, Retry
+
+        import urllib.parse
+
+        timings, metrics = self.timings, self._metrics
+
+        class InstrumentedRetry(Retry):
+            def increment(self, method=None, url=None, response=None, error=None, *args, **kwargs):
+                retry = super().increment(method, url, response, error, *args, **kwargs)  # raises once exhausted
+                redirect = error is None and response is not None and response.get_redirect_location()
+                if metrics is not None and not redirect:
+                    reason = str(response.status) if response is not None and error is None else type(error).__name__
+                    metrics.http_retries.inc(endpoint=urllib.parse.urlsplit(url or "").path, reason=reason)
+                return retry
+
+            def sleep(self, response=None):
+                started = time.perf_counter()
+                with _NO_PHASE if timings is None else timings.phase("backoff"):
+                    super().sleep(response)
+                if metrics is not None:
+                    metrics.http_backoff.inc(time.perf_counter() - started)
+
+        session = requests.Session()
+        _adapter = HTTPAdapter(max_retries=InstrumentedRetry(
+            total=self.retries,
+            backoff_factor=self.backoff_factor,
+            allowed_methods=frozenset(["GET"]),
+            respect_retry_after_header=True,
+            status_forcelist=frozenset({429}),
+        ))
+        session.mount("http://", _adapter)
+        session.mount("https://", _adapter)
+        # Set the headers for the entire session
+        if self._api_key is not None:
+            session.headers = {"x-api-key": self._api_key}
+        return session
+
+    def __request(self, session: "requests.Session", url: str, **kwargs) -> "requests.Response":
+        """
+        session.get(url, stream=True, ...), timed as phase http and recorded in the request duration metric.
+        """
+        import urllib.parse
+
+        started = time.perf_counter()
+        with self._phase("http"):
+            response = session.get(url, stream=True, **kwargs)
+        if self._metrics is not None:
+            self._metrics.http_duration.observe(time.perf_counter() - started, endpoint=urllib.parse.urlsplit(url).path, status=response.status_code)
+        return response
+
+    def _worker_session(self) -> "requests.Session":
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = self._new_session()
+            with self.__sessions_lock:
+                self.__sessions.append(session)
+        return session
+
+    def close(self):
+        """
+        Stop the worker threads and close the connections of every session. A service used again afterwards starts
+        new ones.
+        """
+        with self.__sessions_lock:
+            executor, self.__executor = self.__executor, None
+            sessions, self.__sessions = self.__sessions, []
+            self._local = threading.local()
+        if executor is not None:
+            executor.shutdown(wait=True)
+        for session in sessions:
+            session.close()
+
+    def __enter__(self) -> "MBTARouteService":
+        return self
+
+    def __exit__(self, *_unused_args):
+        self.close()
+
+    @property
+    def cache_key(self) -> str:
+        route_types = ",".join(str(t.value) for t in sorted(set(self._route_types), key=lambda t: t.value))
+        return f"{self.base_url} {route_types}{' lean' if self._lean else ''}"
+
+    def _route(self, json_source: dict) -> MBTARoute:
+        return MBTARoute(json_source, self.__load_details if self._lean else None)
+
+    def _stop(self, json_source: dict) -> MBTAStop:
+        return MBTAStop(json_source, self.__load_details if self._lean else None)
+
+    def __load_details(self, resource: MBTAResource):
+        """
+        Request the attributes a lean load left out, for resource and up to details_batch - 1 other routes or stops
+        that are still missing theirs.
+        """
+        import requests
+
+        with self.__details_lock:
+            if not resource.lean:
+                return
+            lean_resources = self.__lean_routes if isinstance(resource, MBTARoute) else self.__lean_stops
+            batch = {resource.id: resource}
+            for other in lean_resources.values():
+                if len(batch) >= self.details_batch:
+                    break
+                batch.setdefault(other.id, other)
+            path = self.route_path if isinstance(resource, MBTARoute) else self.stop_path
+            params = {"filter[id]": ",".join(str(resource_id) for resource_id in batch)}
+            try:
+                session = self._worker_session()
+                with self.__request(session, f"{self.base_url}{path}", params=params) as response:
+                    self._logger.info(response.request.url)
+                    response.raise_for_status()
+                    with self._phase("construct"):
+                        for element in self.__data(response, session):
+                            if element["id"] in batch:
+                                batch[element["id"]]._update(element, partial=True)
+            except (KeyError, TypeError, ValueError) as e:
+                self._logger.warning(f"Received malformed JSON from {path} request")
+                raise RouteServiceJsonException(e)
+            except (requests.exceptions.RequestException, OSError) as e:
+                self._logger.warning(e)
+                raise RouteServiceHttpException(e)
+            # Whatever was not sent is not requested again
+            for batch_resource in batch.values():
+                batch_resource._details = None
+                lean_resources.pop(batch_resource.id, None)
+
+    def _load(self):
+        self.load()
+
+    def load(self, use_cache: bool = True):
+        """
+        (Re)load the network, from the cache when one is configured and holds a fresh copy. Otherwise the network is
+        requested from the API and, with a cache, saved for next time.
+        """
+        with self.__refresh_lock, self._phase("load"):
+            started = time.perf_counter()
+            self.__load(use_cache)
+            if self._metrics is not None:
+                self._metrics.load_duration.observe(time.perf_counter() - started, kind="load")
+
+    def __load(self, use_cache: bool):
+        previous = None
+        if self._cache is not None:
+            # An expired network is not used as is, but still revalidates its responses with the API
+            with self._phase("cache"):
+                previous = self._cache.read(self.cache_key, expired=True)
+            fresh = previous is not None and self._cache.fresh(previous)
+            if self._metrics is not None:
+                result = "miss" if previous is None else "bypass" if not use_cache else "hit" if fresh else "expired"
+                self._metrics.cache.inc(result=result)
+            if fresh and use_cache:
+                with self._phase("cache"):
+                    self.__restore(previous)
+                self._logger.info(f"Loaded network from {self._cache.path(self.cache_key)}")
+                return
+        self.__previous = previous
+        self.__revalidated = {} if previous is None else previous.validators
+        try:
+            self.__get_routes_and_stops()
+        finally:
+            self.__previous, self.__revalidated = None, {}
+        self.__write_cache()
+
+    def refresh(self) -> NetworkChanges:
+        """
+        Bring the loaded network up to date, requesting only what changed. The route list is requested again (and
+        revalidated, so an unchanged list costs an empty 304 response) and each route compared with the loaded one by
+        its digest(). Stops are requested only for the routes that are new or changed, the other routes keep the
+        stops they have, and stops no route serves any longer are dropped. A change to the stops of a route that is
+        itself unchanged is only picked up by load(). The network is replaced, not modified, so routes and stops
+        already handed out stay consistent with the network they came from, and queries are not blocked, they keep
+        using the network they started with. A service that has not loaded its network yet loads it.
+        """
+        with self.__refresh_lock, self._phase("refresh"):
+            started = time.perf_counter()
+            changes = self.__refresh()
+            if self._metrics is not None:
+                self._metrics.load_duration.observe(time.perf_counter() - started, kind="refresh")
+            return changes
+
+    def __refresh(self) -> NetworkChanges:
+        if self.__network is None:
+            self.load()
+            return NetworkChanges(added=self.__network.route_ids)
+        network = self.__network
+        self.__revalidated = dict(self.__validators)
+        try:
+            routes = self.__get_routes(lambda: None)
+            if routes is None:
+                return NetworkChanges()
+            loaded = {route.id: route for route in network.routes}
+            changed = [
+                route for route in routes
+                if route.id not in loaded or loaded[route.id].digest(self._lean) != route.digest(self._lean)
+            ]
+            route_stops = dict(zip((route.id for route in changed), self.__get_route_stops(changed)))
+        finally:
+            self.__revalidated = {}
+        route_ids = set(route.id for route in routes)
+        changes = NetworkChanges(
+            added=[route.id for route in changed if route.id not in loaded],
+            changed=[route.id for route in changed if route.id in loaded],
+            removed=[route_id for route_id in loaded if route_id not in route_ids]
+        )
+        if changes:
+            with self._phase("assemble"):
+                patched = network.patch(routes, route_stops, MBTAStop.copy)
+                changes.removed_stops = [stop_id for stop_id in network.stop_ids if stop_id not in patched.stop_ids]
+                self.__install(patched)
+            self.__write_cache()
+        self._logger.info(f"Refreshed network, {changes}")
+        return changes
+
+    def subscribe(self) -> "NetworkSubscription":
+        """
+        Apply the API's streamed updates of the routes and their stops to the network as they happen, until the
+        subscription returned is stopped (see NetworkSubscription).
+        """
+        return NetworkSubscription(self).start()
+
+    def _stream(self, resource: type, route_ids: Iterable[Union[int, str]] = ()) -> "requests.Response":
+        """
+        The open text/event-stream response streaming updates of the routes (of the route types), or of the stops of
+        the routes with route_ids, with the routes of each stop included.
+        """
+        import requests
+
+        if resource is MBTARoute:
+            path = self.route_path
+            params = self.__fields({"filter[type]": ",".join(str(t.value) for t in self._route_types)}, MBTARoute)
         else:
-            return None
+            path, params = self.stop_path, {"filter[route]": ",".join(str(route_id) for route_id in route_ids), "include": "route"}
+        response = self._worker_session().get(
+            f"{self.base_url}{path}", params=params, headers={"Accept": "text/event-stream", "Accept-Encoding": "identity"},
+            stream=True, timeout=(self.stream_timeout, self.stream_timeout)
+        )
+        self._logger.info(response.request.url)
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            response.close()
+            self._logger.warning(e)
+            raise RouteServiceHttpException(e)
+        return response
+
+    def _apply_events(self, events: List[Tuple[type, str, object]]) -> NetworkChanges:
+        """
+        Apply streamed events (resource type, event, decoded data) to the network at once, in order. Each is "reset"
+        with every resource, "add" or "update" with one, or "remove" with a resource identifier. Routes that are new
+        to the network have their stops requested. Stops are removed from every route when they are removed (or left
+        out of a reset). A reset names every stop of each route it mentions, so those routes are left with exactly the
+        stops naming them. A stop added or updated with a list of routes is on exactly those of the routes streamed,
+        one naming a single route is added to it, keeping its other routes until a reset or load(). The network is
+        replaced like refresh() does, but not cached.
+        """
+        with self.__refresh_lock:
+            network = self.network
+            routes: Dict[Union[int, str], MBTARoute] = {route.id: route for route in network.routes}
+            # The stop ids of the routes whose stops changed, the stops sent and the new routes, as they are applied
+            members: Dict[Union[int, str], Dict[Union[int, str], None]] = {}
+            stops: Dict[Union[int, str], MBTAStop] = {}
+            new_routes: Dict[Union[int, str], None] = {}
+            updated: Set[Union[int, str]] = set()
+
+            def route_members(route_id) -> Dict[Union[int, str], None]:
+                if route_id not in members:
+                    index = network.route_ids.get(route_id)
+                    members[route_id] = dict.fromkeys(() if index is None else (stop.id for stop in network.route_stops(index)))
+                return members[route_id]
+
+            def stop_routes(stop_id) -> Set[Union[int, str]]:
+                index = network.stop_ids.get(stop_id)
+                loaded = set(() if index is None else (route.id for route in network.stop_routes(index)))
+                return set(route_id for route_id in loaded | set(members) if route_id in routes and stop_id in route_members(route_id))
+
+            def remove_stop(stop_id):
+                for route_id in stop_routes(stop_id):
+                    route_members(route_id).pop(stop_id, None)
+                stops.pop(stop_id, None)
+
+            def remove_route(route_id):
+                routes.pop(route_id, None)
+                members.pop(route_id, None)
+                new_routes.pop(route_id, None)
+
+            try:
+                for resource, event, data in events:
+                    if event == "reset":
+                        sent = data
+                    elif event in ("add", "update"):
+                        sent = [data]
+                    elif event == "remove":
+                        sent = []
+                    else:
+                        continue
+                    if resource is MBTARoute:
+                        sent = [self._route(route) for route in sent]
+                        if event == "reset":
+                            for route_id in set(routes) - set(route.id for route in sent):
+                                remove_route(route_id)
+                        elif event == "remove":
+                            remove_route(data["id"])
+                        for route in sent:
+                            if route.id not in routes or route.id in new_routes:
+                                new_routes[route.id] = None
+                            elif routes[route.id].digest(self._lean) != route.digest(self._lean):
+                                updated.add(route.id)
+                            routes[route.id] = route
+                    else:
+                        # Each stop's route relationship, a list of routes, one route or None
+                        related = [stop.get("relationships", {}).get("route", {}).get("data") for stop in sent]
+                        sent_routes = [
+                            [route["id"] for route in (relationship if isinstance(relationship, list) else [relationship] if relationship else [])]
+                            for relationship in related
+                        ]
+                        if event == "reset":
+                            sent_ids = set(stop["id"] for stop in sent)
+                            for stop_id in (set(network.stop_ids) | set(stops)) - sent_ids:
+                                remove_stop(stop_id)
+                            for route_id in set(itertools.chain.from_iterable(sent_routes)) & set(routes):
+                                members[route_id] = {}
+                        elif event == "remove":
+                            remove_stop(data["id"])
+                        for stop, stop_related, route_ids in zip(sent, related, sent_routes):
+                            stops[stop["id"]] = self._stop(stop)
+                            left = set() if event == "reset" else stop_routes(stop["id"]) - set(route_ids)
+                            if isinstance(stop_related, list):
+                                for route_id in left:
+                                    route_members(route_id).pop(stop["id"], None)
+                            elif left:
+                                self._logger.debug(f"Stop {stop['id']} was sent for {route_ids}, keeping it on {sorted(left, key=str)}")
+                            for route_id in route_ids:
+                                if route_id in routes:
+                                    route_members(route_id)[stop["id"]] = None
+            except (KeyError, TypeError, AttributeError) as e:
+                self._logger.warning("Received malformed JSON from a streamed update")
+                raise RouteServiceJsonException(e)
+
+            fetched = [routes[route_id] for route_id in new_routes]
+            for route, route_stops in zip(fetched, self.__get_route_stops(fetched)):
+                members[route.id] = dict.fromkeys(stop.id for stop in route_stops)
+                for stop in route_stops:
+                    stops.setdefault(stop.id, stop)
+            changed = set(updated)
+            for route_id, stop_ids in members.items():
+                index = network.route_ids.get(route_id)
+                if index is not None and set(stop.id for stop in network.route_stops(index)) != set(stop_ids):
+                    changed.add(route_id)
+
+            def stop(stop_id) -> MBTAStop:
+                if stop_id not in stops:
+                    stops[stop_id] = network.stops[network.stop_ids[stop_id]].copy()
+                return stops[stop_id]
+
+            route_stops = {route_id: [stop(stop_id) for stop_id in stop_ids] for route_id, stop_ids in members.items() if route_id in routes}
+            changes = NetworkChanges(
+                added=new_routes, changed=[route_id for route_id in routes if route_id in changed],
+                removed=[route_id for route_id in network.route_ids if route_id not in routes],
+                changed_stops=[
+                    stop_id for stop_id, stop in stops.items()
+                    if stop_id not in network.stop_ids or network.stops[network.stop_ids[stop_id]].digest(self._lean) != stop.digest(self._lean)
+                ]
+            )
+            if not changes:
+                return changes
+            patched = network.patch(
+                [route.copy() if route._network is not None else route for route in routes.values()], route_stops,
+                MBTAStop.copy, stops.values()
+            )
+            changes.changed_stops = [stop_id for stop_id in changes.changed_stops if stop_id in patched.stop_ids]
+            changes.removed_stops = [stop_id for stop_id in network.stop_ids if stop_id not in patched.stop_ids]
+            self.__install(patched)
+            self._logger.info(f"Applied streamed updates, {changes}")
+            return changes
+
+    def __write_cache(self):
+        if self._cache is not None:
+            try:
+                with self._phase("cache"):
+                    self._cache.write(self.cache_key, self.__network, self.__validators)
+            except OSError as e:
+                self._logger.warning(f"Unable to cache the network ({e})")
+
+    def __restore(self, snapshot: NetworkSnapshot):
+        """
+        Use the network saved in snapshot. Its routes and stops are only parsed when they are first used, so a lean
+        service registers them for details then.
+        """
+        self.__validators = dict(snapshot.validators)
+        with self.__details_lock:
+            self.__lean_routes, self.__lean_stops = {}, {}
+        self.__network = snapshot.network(self.__restored(self._route), self.__restored(self._stop))
+
+    def __restored(self, factory: Callable[[dict], MBTAResource]) -> Callable[[dict], MBTAResource]:
+        def restore(json_source: dict) -> MBTAResource:
+            resource = factory(json_source)
+            if resource.lean:
+                with self.__details_lock:
+                    lean_resources = self.__lean_routes if isinstance(resource, MBTARoute) else self.__lean_stops
+                    lean_resources[resource.id] = resource
+            return resource
+        return restore
+
+    def __get(self, session: "requests.Session", path: str, params: Dict[str, str]) -> "requests.Response":
+        """
+        GET path, revalidating the response saved by the previous load of the network: its ETag and Last-Modified
+        validators are sent as If-None-Match and If-Modified-Since, so an unchanged resource costs an empty 304 (Not
+        Modified) response. Validators of successful responses are kept for the next load.
+        """
+        import requests
+
+        url = requests.Request("GET", f"{self.base_url}{path}", params=params).prepare().url
+        validators = self.__revalidated.get(url, {})
+        headers = {}
+        if "etag" in validators:
+            headers["If-None-Match"] = validators["etag"]
+        if "last_modified" in validators:
+            headers["If-Modified-Since"] = validators["last_modified"]
+        response = self.__request(session, url, headers=headers)
+        if response.status_code == 304:
+            response.content  # reading the empty body returns the connection to the pool, closing would drop it
+            self.__validators[url] = validators
+        elif response.ok:
+            validators = {}
+            if "ETag" in response.headers:
+                validators["etag"] = response.headers["ETag"]
+            if "Last-Modified" in response.headers:
+                validators["last_modified"] = response.headers["Last-Modified"]
+            if validators:
+                self.__validators[url] = validators
+        return response
+
+    def __fields(self, params: Dict[str, str], resource: type, relationships: Tuple[str, ...] = ()) -> Dict[str, str]:
+        """
+        Limit a lean load to the attributes needed for planning, and the relationships read from the response, with
+        a sparse fieldset (which leaves out every relationship it does not name).
+        """
+        if self._lean:
+            params = dict(params, **{f"fields[{resource._resource_type}]": ",".join((resource.lean_fields,) + relationships)})
+        return params
+
+    def __data(self, response: "requests.Response", session: "requests.Session") -> Iterator[dict]:
+        """
+        The elements of a response's data array, decoded once and as they arrive, followed by those of the pages after
+        it (requested with session) when the response is paginated, linking to the next page from links.next. A
+        paginated response is not revalidated by the next load, its first page being unmodified says nothing about
+        the pages after it.
+        """
+        import json
+        import urllib.parse
+
+        debug = self._logger.isEnabledFor(DEBUG)
+        timings, metrics = self.timings, self._metrics
+        page = response
+        try:
+            while True:
+                chunks = page.iter_content(chunk_size=self.chunk_size)
+                if metrics is not None:
+                    chunks = self.__counted(chunks, urllib.parse.urlsplit(page.url).path)
+                stream = JSONAPIStream(chunks if timings is None else timings.iterate("http", chunks))
+                for element in stream if timings is None else timings.iterate("decode", stream):
+                    if debug:
+                        self._logger.debug(json.dumps(element, indent=2))
+                    yield element
+                links = stream.members.get("links")
+                next_page = links.get("next") if isinstance(links, dict) else None
+                if not next_page:
+                    return
+                self.__validators.pop(response.request.url, None)
+                if page is not response:
+                    page.close()
+                page = self.__request(session, urllib.parse.urljoin(page.url, next_page))
+                self._logger.info(page.request.url)
+                page.raise_for_status()
+        finally:
+            if page is not response:
+                page.close()
+
+    def __counted(self, chunks: Iterator[bytes], endpoint: str) -> Iterator[bytes]:
+        received = self._metrics.http_bytes
+        for chunk in chunks:
+            received.inc(len(chunk), endpoint=endpoint)
+            yield chunk
+
+    def __unmodified_stops(self, route: MBTARoute) -> List[MBTAStop]:
+        """
+        The stops of route as of the previous load (or, refreshing, as loaded), for a stop request that was not
+        modified since.
+        """
+        with self._phase("construct"):
+            if self.__previous is not None:
+                return [self._stop(self.__previous.stop_json(stop)) for stop in self.__previous.route_stops(route.id)]
+            loaded = None if self.__network is None else self.__network.route(route.id)
+            if loaded is None or loaded.id != route.id:
+                raise KeyError(f"No previous stops of {route.id}")
+            return [stop.copy() for stop in loaded.stops]
 
     def __get_routes_and_stops(self):
+        def unmodified() -> List[MBTARoute]:
+            if self.__previous is None:
+                raise KeyError("No previous routes")
+            with self._phase("construct"):
+                return [self._route(self.__previous.route_json(index)) for index in range(len(self.__previous.route_ids))]
+
+        self.__validators = {}
+        routes = self.__get_routes(unmodified)
+        self._assemble(routes, self.__get_route_stops(routes))
+
+    def __get_routes(self, unmodified: Callable[[], Optional[List[MBTARoute]]]) -> Optional[List[MBTARoute]]:
+        """
+        The routes of the route types, or unmodified() if they were not modified since the validators sent.
+        """
+        import requests
+
         route_type_parameters = ",".join(str(t.value) for t in self._route_types)
-        self.__routes = {}
-        self.__stops = {}
+        session = self._worker_session()
         try:
-            with self._session.get(f"{self.base_url}{self.route_path}", params={"filter[type]": route_type_parameters}) as response:
+            with self.__get(session, self.route_path, self.__fields({"filter[type]": route_type_parameters}, MBTARoute)) as response:
                 self._logger.info(response.request.url)
                 response.raise_for_status()
-                self._logger.debug(json.dumps(response.json(), indent=2))
-                for route in response.json()["data"]:
-                    mbta_route = MBTARoute(route)
-                    self.__routes[mbta_route.id] = mbta_route
-                    self.__routes[str(mbta_route).casefold()] = mbta_route
-                    try:
-                        with self._session.get(f"{self.base_url}{self.stop_path}", params={"filter[route]": mbta_route.id}) as stop_response:
-                            self._logger.info(stop_response.request.url)
-                            stop_response.raise_for_status()
-                            self._logger.debug(json.dumps(stop_response.json(), indent=2))
-                            for stop in stop_response.json()["data"]:
-                                try:
-                                    mbta_stop = self.__stops[stop["id"]]
-                                except KeyError:
-                                    mbta_stop = MBTAStop(stop)
-                                    self.__stops[mbta_stop.id] = mbta_stop
-                                    self.__stops[str(mbta_stop).casefold()] = mbta_stop
-                                mbta_route.stops.add(mbta_stop)
-                                mbta_stop.routes.add(mbta_route)
-                    except KeyError as e:
-                        self._logger.warning("Received malformed JSON from stop request")
-                        raise RouteServiceJsonException(e)
-        except requests.exceptions.HTTPError as e:
+                if response.status_code == 304:
+                    return unmodified()
+                with self._phase("construct"):
+                    return [self._route(route) for route in self.__data(response, session)]
+        except (KeyError, TypeError, ValueError) as e:
+            self._logger.warning("Received malformed JSON from route request")
+            raise RouteServiceJsonException(e)
+        except (requests.exceptions.RequestException, OSError) as e:  # HTTP errors, retries exhausted, connections lost
             self._logger.warning(e)
             raise RouteServiceHttpException(e)
-        except KeyError as e:
-            self._logger.warning("Received malformed JSON from route request")
+
+    def __get_route_stops(self, routes: List[MBTARoute]) -> List[List[MBTAStop]]:
+        if self._bulk > 1:
+            batches = [routes[index:index + self._bulk] for index in range(0, len(routes), self._bulk)]
+            return [stops for batch_stops in self.__map(self.__get_bulk_stops, batches) for stops in batch_stops]
+        return self.__map(self.__get_stops, routes)
+
+    def _assemble(self, routes: List[MBTARoute], route_stops: List[List[MBTAStop]]):
+        """
+        Link parsed routes with the stops parsed for each of them (route_stops[i] belong to routes[i]) and index the
+        result. Shared by every loader, so the network does not depend on how or in what order it was fetched.
+        """
+        # Stops served by several routes are parsed once per route, the network keeps the first copy seen
+        with self._phase("assemble"):
+            self.__install(Network(routes, route_stops))
+
+    def __install(self, network: Network):
+        """
+        Replace the network, and the transfer table if one is used, with network and its table (rebuilt only if the
+        routes or their transfers changed), both built before either is replaced. Queries reading them in between find
+        they do not match and plan without the table.
+        """
+        lookup, previous = self._transfer_lookup, self.__network
+        if lookup is not None:
+            table = lookup[0]
+            if previous is None or previous.route_ids != network.route_ids or any(
+                    getattr(previous, name) != getattr(network, name) for name in ("transfer_offsets", "transfer_routes")
+            ):
+                table = TransferTable.build(self, network)  # otherwise the routes and how they connect are unchanged
+            lookup = self._table_lookup(table, network.routes)
+        with self.__details_lock:
+            self.__lean_routes = {route.id: route for route in network.routes if route.lean}
+            self.__lean_stops = {stop.id: stop for stop in network.stops if stop.lean}
+        self.__network = network
+        if lookup is not None:
+            self._transfer_lookup = lookup
+
+    def __map(self, request: Callable, items: list) -> list:
+        """
+        Call request(session, item) for every item, concurrently when there are workers to do so. Requests complete in
+        any order, but results are returned in item order so the graph is assembled deterministically. The worker
+        threads, and so their sessions, are those of every other call.
+        """
+        import concurrent.futures
+
+        if self._workers == 1 or len(items) < 2:
+            return [request(self._worker_session, item) for item in items]
+        with self.__sessions_lock:
+            if self.__executor is None:
+                self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="MBTARouteService")
+            executor = self.__executor
+        futures = [executor.submit(request, self._worker_session, item) for item in items]
+        try:
+            return [future.result() for future in futures]
+        except RouteServiceException:
+            for future in futures:
+                future.cancel()
+            concurrent.futures.wait(futures)  # none still running once the failure is raised
+            raise
+
+    def __get_bulk_stops(self, session: Callable[[], "requests.Session"], routes: List[MBTARoute]) -> List[List[MBTAStop]]:
+        """
+        Request the stops of several routes at once, rebuilding route membership from each stop's route relationship
+        (only populated with include=route, the included routes trimmed to their type). A stop the response repeats,
+        once for each of its routes, is only parsed the first time. If the request fails or a stop lacks the
+        relationship the batch is requested again one route at a time, as is any route the response left empty.
+        """
+        import requests
+
+        route_stops: Dict[Union[int, str], List[MBTAStop]] = {route.id: [] for route in routes}
+        parsed: Dict[str, MBTAStop] = {}
+        params = self.__fields({"filter[route]": ",".join(str(route.id) for route in routes), "include": "route", "fields[route]": "type"}, MBTAStop, MBTAStop._request_relationships)
+        try:
+            with self.__get(session(), self.stop_path, params) as stop_response:
+                self._logger.info(stop_response.request.url)
+                stop_response.raise_for_status()
+                if stop_response.status_code == 304:
+                    return [self.__unmodified_stops(route) for route in routes]
+                with self._phase("construct"):
+                    for stop in self.__data(stop_response, session()):
+                        related = stop["relationships"]["route"]["data"]
+                        mbta_stop = parsed.get(stop["id"])
+                        if mbta_stop is None:
+                            mbta_stop = parsed[stop["id"]] = self._stop(stop)
+                        for route in related if isinstance(related, list) else [related]:
+                            if route["id"] in route_stops:
+                                route_stops[route["id"]].append(mbta_stop)
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+            self._logger.warning(f"Bulk stop request failed, requesting stops one route at a time ({e!r})")
+            return [self.__get_stops(session, route) for route in routes]
+        return [route_stops[route.id] or self.__get_stops(session, route) for route in routes]
+
+    def __get_stops(self, session: Callable[[], "requests.Session"], route: MBTARoute) -> List[MBTAStop]:
+        import requests
+
+        try:
+            with self.__get(session(), self.stop_path, self.__fields({"filter[route]": route.id}, MBTAStop)) as stop_response:
+                self._logger.info(stop_response.request.url)
+                stop_response.raise_for_status()
+                if stop_response.status_code == 304:
+                    return self.__unmodified_stops(route)
+                with self._phase("construct"):
+                    return [self._stop(stop) for stop in self.__data(stop_response, session())]
+        except (KeyError, TypeError, ValueError) as e:
+            self._logger.warning("Received malformed JSON from stop request")
+            raise RouteServiceJsonException(e)
+        except (requests.exceptions.RequestException, OSError) as e:
+            self._logger.warning(e)
+            raise RouteServiceHttpException(e)
+
+
+class AsyncMBTARouteService(MBTARouteService):
+    """
+    MBTARouteService for asyncio applications. Routes and stops are fetched on the event loop with aiohttp, at most
+    `workers` requests at a time, and are parsed and assembled by the same code as the blocking service.
+    The network is loaded with `await load()`, the awaitable trip(), stop() and route() load it on first use. The
+    synchronous properties (routes, stops, ...) raise RouteServiceException until it has been loaded. refresh() and
+    subscribe() (and so NetworkRefresher and NetworkSubscription) would block the event loop and are not supported,
+    `await load(reload=True)` brings the network up to date instead.
+    """
+    _logger = _Logger("RouteService.MBTA.Async")
+
+    def __init__(
+            self, api_key: Optional[str] = None, route_types: List[RouteTypes] = None, workers: int = 8,
+            timings: Optional[PhaseTimings] = None, metrics: Optional[MetricsRegistry] = None
+    ):
+        super(AsyncMBTARouteService, self).__init__(api_key, route_types=route_types, workers=workers, timings=timings, metrics=metrics)
+        self.__lock = None
+
+    def _load(self):
+        raise RouteServiceException("The network has not been loaded, use 'await load()' first")
+
+    async def load(self, reload: bool = False):
+        """
+        Load the network, unless it has been loaded already and reload is not set. Unlike MBTARouteService.load()
+        there is no cache (and so no use_cache), the network is always requested from the API.
+        """
+        import asyncio
+        import aiohttp
+
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+        async with self.__lock:
+            if self.loaded and not reload:
+                return
+            started = time.perf_counter()
+            route_type_parameters = ",".join(str(t.value) for t in self._route_types)
+            headers = {} if self._api_key is None else {"x-api-key": self._api_key}
+            semaphore = asyncio.Semaphore(self._workers)
+            async with aiohttp.ClientSession(headers=headers, connector=aiohttp.TCPConnector(limit=self._workers)) as session:
+                try:
+                    data = await self.__get_data(session, semaphore, self.route_path, {"filter[type]": route_type_parameters})
+                    with self._phase("construct"):
+                        routes = [MBTARoute(route) for route in data]
+                except (KeyError, TypeError) as e:
+                    self._logger.warning("Received malformed JSON from route request")
+                    raise RouteServiceJsonException(e)
+                route_stops = await asyncio.gather(*(self.__get_stops(session, semaphore, route) for route in routes))
+            self._assemble(routes, list(route_stops))
+            if self._metrics is not None:
+                self._metrics.load_duration.observe(time.perf_counter() - started, kind="load")
+
+    def refresh(self) -> NetworkChanges:
+        raise RouteServiceException("refresh() is not supported asynchronously, use 'await load(reload=True)'")
+
+    def subscribe(self) -> "NetworkSubscription":
+        raise RouteServiceException("subscribe() is not supported asynchronously, use 'await load(reload=True)'")
+
+    async def route(self, route: Union[int, str, None] = None) -> Optional[MBTARoute]:
+        await self.load()
+        return super(AsyncMBTARouteService, self).route(route)
+
+    async def stop(self, stop: Union[int, str, None] = None) -> Optional[MBTAStop]:
+        await self.load()
+        return super(AsyncMBTARouteService, self).stop(stop)
+
+    async def trip(self, here: MBTAStop, there: MBTAStop) -> List[MBTARoute]:
+        await self.load()
+        return super(AsyncMBTARouteService, self).trip(here, there)
+
+    async def __get_stops(self, session, semaphore, route: MBTARoute) -> List[MBTAStop]:
+        try:
+            data = await self.__get_data(session, semaphore, self.stop_path, {"filter[route]": route.id})
+            with self._phase("construct"):
+                return [MBTAStop(stop) for stop in data]
+        except (KeyError, TypeError) as e:
+            self._logger.warning("Received malformed JSON from stop request")
             raise RouteServiceJsonException(e)
 
+    async def __get_data(self, session, semaphore, path: str, params: Dict[str, str]) -> List[dict]:
+        """
+        The data array of a collection, and of the pages after it (links.next) when the response is paginated.
+        """
+        import urllib.parse
+
+        url = f"{self.base_url}{path}"
+        body = await self.__get_json(session, semaphore, url, params)
+        data = list(body["data"])
+        links = body.get("links")
+        while isinstance(links, dict) and links.get("next"):
+            url = urllib.parse.urljoin(url, links["next"])
+            body = await self.__get_json(session, semaphore, url)
+            data.extend(body["data"])
+            links = body.get("links")
+        return data
+
+    async def __get_json(self, session, semaphore, url: str, params: Optional[Dict[str, str]] = None) -> dict:
+        """
+        GET and decode one response. Rate limited (429) requests are retried like the blocking service's Retry
+        policy: up to `retries` times, honoring Retry-After or backing off exponentially. The semaphore is not held
+        while waiting to retry. Coroutines interleave, so their phases are timed as they end rather than nested.
+        """
+        import asyncio
+        import json
+        import urllib.parse
+        import aiohttp
+
+        timings, metrics = self.timings, self._metrics
+        endpoint = urllib.parse.urlsplit(url).path
+        for attempt in range(self.retries + 1):
+            async with semaphore:
+                try:
+                    started = time.perf_counter()
+                    if attempt == 0:
+                        requested = started
+                    async with session.get(url, params=params) as response:
+                        self._logger.info(response.url)
+                        if response.status == 429 and attempt < self.retries:
+                            delay = self.__retry_after(response.headers.get("Retry-After"), attempt)
+                            if metrics is not None:
+                                metrics.http_retries.inc(endpoint=endpoint, reason="429")
+                        else:
+                            if metrics is not None:
+                                metrics.http_duration.observe(time.perf_counter() - requested, endpoint=endpoint, status=response.status)
+                            response.raise_for_status()
+                            content = await response.read()
+                            if metrics is not None:
+                                metrics.http_bytes.inc(len(content), endpoint=endpoint)
+                            if timings is not None:
+                                timings.add("http", time.perf_counter() - started)
+                                started = time.perf_counter()
+                            body = json.loads(content)
+                            if timings is not None:
+                                timings.add("decode", time.perf_counter() - started)
+                            if self._logger.isEnabledFor(DEBUG):
+                                self._logger.debug(json.dumps(body, indent=2))
+                            return body
+                except aiohttp.ClientError as e:
+                    self._logger.warning(e)
+                    raise RouteServiceHttpException(e)
+                except ValueError as e:
+                    self._logger.warning(f"Received malformed JSON from {url}")
+                    raise RouteServiceJsonException(e)
+            if timings is not None:
+                timings.add("http", time.perf_counter() - started)
+            started = time.perf_counter()
+            await asyncio.sleep(delay)
+            if timings is not None:
+                timings.add("backoff", time.perf_counter() - started)
+            if metrics is not None:
+                metrics.http_backoff.inc(time.perf_counter() - started)
+
+    def __retry_after(self, retry_after: Optional[str], attempt: int) -> float:
+        if retry_after is not None:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                import email.utils
+                try:
+                    return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        return 0.0 if attempt == 0 else self.backoff_factor * (2 ** attempt)
+
+
+class NetworkRefresher:
+    """
+    Keeps the network of a long running service up to date from a daemon thread: refresh() is called every interval
+    seconds, or load() (skipping the cache) instead once reload_interval seconds have passed since the last, to also
+    pick up what refresh() does not look for. Queries are not blocked, each new network is swapped in once complete.
+    Failures are logged and retried at the next interval.
+    """
+    _logger = _Logger("RouteService.Refresher")
+
+    def __init__(self, route_service: MBTARouteService, interval: float = 15 * 60, reload_interval: Optional[float] = None):
+        if isinstance(route_service, AsyncMBTARouteService):
+            raise RouteServiceException("An AsyncMBTARouteService is not refreshed from a thread, use 'await load(reload=True)'")
+        self.route_service = route_service
+        self.interval = interval
+        self.reload_interval = reload_interval
+        # Refreshes and reloads attempted, what the last refresh changed (None after a reload) and why it failed
+        self.refreshes = 0
+        self.changes: Optional[NetworkChanges] = None
+        self.error: Optional[RouteServiceException] = None
+        self.__stopped = threading.Event()
+        self.__thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "NetworkRefresher":
+        return self.start()
+
+    def __exit__(self, *_unused_args):
+        self.stop()
+
+    def start(self) -> "NetworkRefresher":
+        if self.__thread is None:
+            self.__stopped.clear()
+            self.__thread = threading.Thread(target=self.__run, name="NetworkRefresher", daemon=True)
+            self.__thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+        """
+        Stop refreshing, waiting up to timeout seconds for a refresh in progress to finish.
+        """
+        self.__stopped.set()
+        thread, self.__thread = self.__thread, None
+        if thread is not None:
+            thread.join(timeout)
+
+    def __run(self):
+        reloaded = time.monotonic()
+        while not self.__stopped.wait(self.interval):
+            try:
+                if self.reload_interval is not None and time.monotonic() - reloaded >= self.reload_interval:
+                    self.route_service.load(use_cache=False)
+                    reloaded, self.changes = time.monotonic(), None
+                else:
+                    self.changes = self.route_service.refresh()
+                self.error = None
+            except RouteServiceException as e:
+                self._logger.warning(f"Unable to refresh the network ({e})")
+                self.error = e
+            except Exception as e:  # whatever went wrong, the next refresh is still attempted
+                self._logger.exception(f"Unable to refresh the network ({e!r})")
+                self.error = RouteServiceException(e)
+            self.refreshes += 1
+
+
+class NetworkSubscription:
+    """
+    Applies the API's streamed updates to a service's network (see MBTARouteService.subscribe()). One daemon thread
+    follows the route stream and another the stop stream of those routes (restarted when routes are added or
+    removed), each sending what it receives to a third that applies it. Events arriving within batch_interval seconds
+    of each other are applied together, replacing the network once. A stream that fails or ends is reconnected after
+    a delay, doubling from backoff (or the delay the server asked for) up to max_backoff seconds until an event is
+    received again; the API starts every stream with a reset, so nothing missed in between is lost.
+    """
+    _logger = _Logger("RouteService.Subscription")
+    backoff = 1.0
+    max_backoff = 60.0
+    batch_interval = 0.1
+
+    def __init__(self, route_service: MBTARouteService):
+        self.route_service = route_service
+        # Connections made, events received and applied, what the last batch changed and why the last failure happened
+        self.connections = 0
+        self.events = 0
+        self.applied = 0
+        self.changes: Optional[NetworkChanges] = None
+        self.error: Optional[Exception] = None
+        self.__stopped = threading.Event()
+        self.__threads: List[threading.Thread] = []
+        self.__queue = None
+        self.__lock = threading.Lock()
+        self.__responses: Dict[type, "requests.Response"] = {}
+        self.__restarted: Set[type] = set()
+
+    def __enter__(self) -> "NetworkSubscription":
+        return self.start()
+
+    def __exit__(self, *_unused_args):
+        self.stop()
+
+    def start(self) -> "NetworkSubscription":
+        import queue
+
+        if not self.__threads:
+            self.route_service.network  # noqa, loads the network, the streams bring it up to date
+            self.__stopped.clear()
+            self.__queue = queue.Queue()
+            self.__threads = [
+                threading.Thread(target=self.__listen, args=(MBTARoute,), name="NetworkSubscription.routes", daemon=True),
+                threading.Thread(target=self.__listen, args=(MBTAStop,), name="NetworkSubscription.stops", daemon=True),
+                threading.Thread(target=self.__apply, name="NetworkSubscription", daemon=True),
+            ]
+            for thread in self.__threads:
+                thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+        """
+        Stop following the streams, waiting up to timeout seconds for updates being applied.
+        """
+        self.__stopped.set()
+        if not self.__threads:
+            return
+        self.__queue.put(None)
+        with self.__lock:
+            responses = list(self.__responses.values())
+        for response in responses:
+            self.__interrupt(response)
+        threads, self.__threads = self.__threads, []
+        for thread in threads:
+            thread.join(timeout)
+
+    def __restart(self, resource: type):
+        with self.__lock:
+            response = self.__responses.get(resource)
+            self.__restarted.add(resource)
+        if response is not None:
+            self.__interrupt(response)
+
+    @staticmethod
+    def __interrupt(response: "requests.Response"):
+        # Closing a response waits for the read blocked on it in the listening thread, shutting its connection down
+        # (through a duplicate of its socket) ends that read instead, and the listener closes the response
+        import socket
+
+        try:
+            with socket.socket(fileno=os.dup(response.raw.fileno())) as connection:
+                connection.shutdown(socket.SHUT_RDWR)
+        except (OSError, ValueError):
+            pass
+
+    def __listen(self, resource: type):
+        import http.client
+        import json
+        import requests
+        import urllib3
+
+        attempt, retry = 0, None
+        while not self.__stopped.is_set():
+            with self.__lock:
+                self.__restarted.discard(resource)
+            try:
+                with self.route_service._stream(resource, self.route_service.network.route_ids) as response:
+                    with self.__lock:
+                        self.__responses[resource] = response
+                    if self.__stopped.is_set():
+                        break
+                    self.connections += 1
+                    # Whatever has arrived, iter_content() would wait for a full chunk (or the end of an unchunked
+                    # stream). urllib3 1.26 has no read1(), but the http.client response it reads from does (and the
+                    # stream is requested unencoded, so there is nothing for urllib3 to decode), raising its own
+                    # HTTPExceptions
+                    read1 = getattr(response.raw, "read1", None) or response.raw._fp.read1
+                    stream = EventStream(iter(lambda: read1(64 * 1024), b""))
+                    for event, data in stream:
+                        attempt, retry = 0, stream.retry
+                        try:
+                            self.__queue.put((resource, event, json.loads(data)))
+                        except ValueError:
+                            self._logger.warning(f"Received malformed JSON in a streamed {event}")
+            except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, http.client.HTTPException,
+                    RouteServiceException, OSError, ValueError) as e:
+                if not self.__stopped.is_set() and resource not in self.__restarted:
+                    self._logger.warning(f"Update stream failed ({e})")
+                    self.error = e
+            finally:
+                with self.__lock:
+                    self.__responses.pop(resource, None)
+                    restarted = resource in self.__restarted
+            if not restarted:
+                self.__stopped.wait(self._backoff(attempt, retry))
+                attempt += 1
+
+    def _backoff(self, attempt: int, retry: Optional[float]) -> float:
+        """
+        Seconds to wait before reconnecting a stream that failed attempt times in a row since its last event, starting
+        from the delay the server asked for (retry) if it did.
+        """
+        return min(self.max_backoff, (retry or self.backoff) * 2 ** attempt)
+
+    def __apply(self):
+        import queue
+
+        while True:
+            update = self.__queue.get()
+            if update is None:
+                return
+            batch = [update]
+            deadline = time.monotonic() + self.batch_interval
+            while update is not None and time.monotonic() < deadline:
+                try:
+                    update = self.__queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if update is not None:
+                    batch.append(update)
+            if self.__stopped.is_set():
+                return
+            try:
+                self.changes = self.route_service._apply_events(batch)
+                self.applied += 1
+                if self.changes.added or self.changes.removed:
+                    self.__restart(MBTAStop)  # to follow the stops of the routes now in the network
+            except RouteServiceException as e:
+                self._logger.warning(f"Unable to apply streamed updates ({e})")
+                self.error = e
+            self.events += len(batch)
+
+
+###
+# Query Daemon
+###
+class RemoteRoute(Route):
+    """
+    A route of a RouteServer's network, as seen by a RouteClient: its id and name.
+    """
+    __slots__ = ("name",)
+
+    def __init__(self, route_id: Union[int, str], name: str):
+        super(RemoteRoute, self).__init__(route_id)
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class RemoteStop(Stop):
+    """
+    A stop of a RouteServer's network, as seen by a RouteClient: its id and name.
+    """
+    __slots__ = ("name",)
+
+    def __init__(self, stop_id: Union[int, str], name: str):
+        super(RemoteStop, self).__init__(stop_id)
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+def _address(address: str) -> Tuple[Optional[str], Union[int, str]]:
+    """
+    (host, port) for "host:port" or "port" (on localhost), or (None, path) for a Unix socket path (containing "/").
+    """
+    if "/" in address:
+        return None, address
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+class RouteServer:
+    """
+    Serves a RouteService, loaded once and kept warm, to RouteClients over a TCP or Unix socket. Requests and responses
+    are JSON objects, one per line, answered in order; a client may send any number of requests before reading the
+    responses (pipelining). A request's "id", if any, is returned with its response. Routes and stops are sent as
+    compact [id, name] pairs. The operations are:
+      {"op": "trip", "start": stop, "destination": stop} -> {"trip": [route, ...]}, [] if there is none, or an error if
+        either stop is not found
+      {"op": "stop", "key": id or name} and {"op": "route", ...} -> {"stop": stop} or {"route": route}, or null
+      {"op": "candidates", "name": name, "k": 5} -> {"candidates": [[id, name, similarity], ...]}
+      {"op": "stop_names"} -> {"stop_names": [name, ...]}, sorted (ignoring case), for completion
+      {"op": "network"} -> {"routes": [[id, name, [stop, ...]], ...], "stops": [[id, name], ...]}, stops by position
+    Failures are answered with {"error": message}. Requests are answered on the event loop, one at a time.
+    A connection starting with an HTTP GET of /metrics is answered with the metrics (by default those of the service)
+    in the Prometheus text format, so the daemon can be scraped at its own address.
+    """
+    _logger = _Logger("RouteService.Server")
+    default_address = "127.0.0.1:8765"
+    # Responses are only flushed (awaited) once this much is waiting to be sent
+    write_buffer = 64 * 1024
+    operations = ("trip", "stop", "route", "candidates", "stop_names", "network")
+    # Requests take microseconds, the network (op) tens of milliseconds
+    request_buckets = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01, 0.05, 0.25, 1.0)
+
+    def __init__(self, route_service: RouteService, address: str = default_address, metrics: Optional[MetricsRegistry] = None):
+        self.route_service = route_service
+        self.address = address
+        self.metrics = metrics if metrics is not None else getattr(route_service, "metrics", None)
+        self._requests = None if self.metrics is None else self.metrics.histogram(
+            "route_service_server_request_duration_seconds", "Requests answered by the daemon, by operation", ("op",), self.request_buckets
+        )
+        self.ready = threading.Event()  # set once listening, when address is the one bound (port 0 is assigned one)
+        self._loop = None
+        self._stopped = None
+
+    def run(self):
+        """
+        Serve until shutdown(), loading the network first so no request waits for it.
+        """
+        import asyncio
+
+        self.route_service.routes  # noqa, loads the network
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        import asyncio
+
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        host, port = _address(self.address)
+        if host is None:
+            server = await asyncio.start_unix_server(self._handle, path=port)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+            host, port = server.sockets[0].getsockname()[:2]
+            self.address = f"{host}:{port}"
+        self._logger.info(f"Serving on {self.address}")
+        self.ready.set()
+        try:
+            async with server:
+                await self._stopped.wait()
+        finally:
+            self._loop = None
+
+    def shutdown(self):
+        """
+        Stop serving, from any thread.
+        """
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._stopped.set)
+            except RuntimeError:
+                pass  # The loop closed as we were stopping it
+
+    async def _handle(self, reader, writer):
+        try:
+            line = await reader.readline()
+            if line.startswith(b"GET "):
+                await self._handle_http(line, reader, writer)
+                return
+            while line:
+                writer.write(self.answer(line))
+                if writer.transport.get_write_buffer_size() > self.write_buffer:
+                    await writer.drain()
+                line = await reader.readline()
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_http(self, request_line: bytes, reader, writer):
+        """
+        Answer an HTTP GET of /metrics, and nothing else, closing the connection after the response.
+        """
+        while (await reader.readline()).strip():
+            pass  # the headers
+        path = request_line.split()[1].split(b"?")[0] if len(request_line.split()) > 1 else b""
+        if path == b"/metrics" and self.metrics is not None:
+            status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", self.metrics.render().encode("utf-8")
+        else:
+            status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii") + body
+        )
+        await writer.drain()
+
+    def answer(self, line: bytes) -> bytes:
+        """
+        The response line to a request line.
+        """
+        import json
+
+        request = {}
+        started = time.perf_counter()
+        try:
+            request = json.loads(line)
+            response = self.__answer(request)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:  # malformed requests
+            response = {"error": f"Malformed request ({e!r})"}
+        except RouteServiceException as e:
+            response = {"error": str(e)}
+        if isinstance(request, dict) and "id" in request:
+            response["id"] = request["id"]
+        answer = json.dumps(response, separators=(",", ":")).encode("utf-8") + b"\n"
+        if self._requests is not None:
+            op = request.get("op") if isinstance(request, dict) else None
+            self._requests.observe(time.perf_counter() - started, op=op if op in self.operations else "unknown")
+        return answer
+
+    def __answer(self, request: dict) -> dict:
+        route_service, op = self.route_service, request["op"]
+        if op == "trip":
+            here, there = route_service.stop(request["start"]), route_service.stop(request["destination"])
+            if here is None or there is None:
+                return {"error": f'Unable to find the stop "{request["start"] if here is None else request["destination"]}"'}
+            return {"trip": [[route.id, str(route)] for route in route_service.trip(here, there)]}
+        elif op == "stop" or op == "route":
+            found = route_service.stop(request["key"]) if op == "stop" else route_service.route(request["key"])
+            return {op: None if found is None else [found.id, str(found)]}
+        elif op == "candidates":
+            candidates = route_service.stop_candidates(str(request["name"]), int(request.get("k", 5)))
+            return {"candidates": [[stop.id, str(stop), similarity] for stop, similarity in candidates]}
+        elif op == "stop_names":
+            return {"stop_names": route_service.stop_index.names}
+        elif op == "network":
+            stops = sorted(route_service.stops, key=lambda s: str(s.id))
+            positions = {stop: position for position, stop in enumerate(stops)}
+            return {
+                "routes": [[route.id, str(route), [positions[stop] for stop in route.stops]] for route in route_service.routes],
+                "stops": [[stop.id, str(stop)] for stop in stops],
+            }
+        raise ValueError(f"Unknown operation {op!r}")
+
+
+class RouteClient(RouteService):
+    """
+    The RouteService of a RouteServer, so programs (and the command line) can use a warm daemon in place of loading
+    the network themselves. Trips, stop and route lookups and fuzzy searches are answered by the server; routes, stops
+    and what depends on them download the server's network the first time they are used. trips() pipelines its
+    requests, keeping up to window of them in flight.
+    """
+    window = 256
+
+    def __init__(self, address: str = RouteServer.default_address, timeout: Optional[float] = None):
+        self.address = address
+        self.timeout = timeout
+        self._socket = None
+        self._file = None
+        self.__network: Optional[Network] = None
+        self.__stop_index: Optional[NameIndex] = None
+        self.__stops: Dict[Union[int, str, None], Stop] = {}
+
+    def __enter__(self) -> "RouteClient":
+        return self
+
+    def __exit__(self, *_unused_args):
+        self.close()
+
+    def close(self):
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+            self._socket = self._file = None
+
+    def __connect(self):
+        import socket
+
+        if self._socket is None:
+            host, port = _address(self.address)
+            try:
+                if host is None:
+                    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self._socket.settimeout(self.timeout)
+                    self._socket.connect(port)
+                else:
+                    self._socket = socket.create_connection((host, port), timeout=self.timeout)
+                    self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError as e:
+                self._socket = None
+                raise RouteServiceException(f"Unable to connect to {self.address} ({e})")
+            self._file = self._socket.makefile("rb")
+
+    def _requests(self, requests: Iterable[dict]) -> Iterator[dict]:
+        """
+        The responses to requests, in order, sending up to window requests before reading their responses. An error
+        response raises RouteServiceException once the rest of its batch has been read.
+        """
+        import json
+
+        self.__connect()
+        requests = iter(requests)
+        try:
+            while True:
+                batch = list(itertools.islice(requests, self.window))
+                if not batch:
+                    return
+                self._socket.sendall(b"".join(json.dumps(r, separators=(",", ":")).encode("utf-8") + b"\n" for r in batch))
+                # Every response of the batch is read before any is returned or an error raised, so none is left to be
+                # read in place of the response to a later request
+                lines = [self._file.readline() for _ in batch]
+                if not lines[-1]:
+                    raise ConnectionError("Connection closed by the server")
+                responses = [json.loads(line) for line in lines]
+                for response in responses:
+                    if "error" in response:
+                        raise RouteServiceException(response["error"])
+                yield from responses
+        except OSError as e:
+            self.close()
+            raise RouteServiceException(f"Lost the connection to {self.address} ({e})")
+
+    def _request(self, request: dict) -> dict:
+        return next(self._requests([request]))
+
+    @property
+    def network(self) -> Network:
+        if self.__network is None:
+            network = self._request({"op": "network"})
+            stops = [RemoteStop(stop_id, name) for stop_id, name in network["stops"]]
+            routes = [RemoteRoute(route_id, name) for route_id, name, _ in network["routes"]]
+            self.__network = Network(routes, [[stops[stop] for stop in members] for _, _, members in network["routes"]])
+        return self.__network
+
+    @property
+    def routes(self) -> FrozenSet[Route]:
+        return self.network.route_set
+
+    @property
+    def stops(self) -> FrozenSet[Stop]:
+        return self.network.stop_set
+
+    @property
+    def connecting_stops(self) -> Set[Stop]:
+        return set(self.network.connecting_stops())
+
+    def route(self, route: Union[int, str, None] = None) -> Optional[Route]:
+        found = self._request({"op": "route", "key": route})["route"]
+        return None if found is None else RemoteRoute(*found)
+
+    def stop(self, stop: Union[int, str, None] = None) -> Optional[Stop]:
+        # Scripts look up the same few stops over and over. Only stops found are kept, as the server may refresh its
+        # network and add them later, while trip() of a stop removed since it was kept raises RouteServiceException
+        found = self.__stops.get(stop)
+        if found is None:
+            if len(self.__stops) >= self.window * 64:
+                self.__stops.clear()
+            found = self._request({"op": "stop", "key": stop})["stop"]
+            if found is None:
+                return None
+            found = self.__stops[stop] = RemoteStop(*found)
+        return found
+
+    def trip(self, here: Stop, there: Stop) -> List[Route]:
+        return next(self.trips([(here, there)]))
+
+    def trips(self, pairs: Iterable[Tuple[Stop, Stop]], origins: int = 1024) -> Iterator[List[Route]]:
+        pairs = iter(pairs)
+        while True:
+            batch = list(itertools.islice(pairs, self.window))
+            if not batch:
+                return
+            # Every response of the batch is read before the first is yielded, so the caller may use the client too
+            responses = iter(list(self._requests(
+                {"op": "trip", "start": here.id, "destination": there.id}
+                for here, there in batch if isinstance(here, Stop) and isinstance(there, Stop)
+            )))
+            for here, there in batch:
+                if isinstance(here, Stop) and isinstance(there, Stop):
+                    yield [RemoteRoute(*route) for route in next(responses)["trip"]]
+                else:
+                    yield []
+
+    def stop_candidates(self, name: str, k: int = 5, threshold: float = 0.5) -> List[Tuple[Stop, float]]:
+        candidates = self._request({"op": "candidates", "name": name, "k": k})["candidates"]
+        return [(RemoteStop(stop_id, stop_name), similarity) for stop_id, stop_name, similarity in candidates if similarity >= threshold]
+
+    @property
+    def stop_index(self) -> NameIndex:
+        if self.__stop_index is None:
+            self.__stop_index = NameIndex(self._request({"op": "stop_names"})["stop_names"])
+        return self.__stop_index
+
 
 ###
 # TUI Client Implementation
 ###
-def list_stops(route_service: RouteService, *_unused_args):
+def list_stops(route_service: RouteService, prefix: Optional[str] = None, *_unused_args):
+    prefix = (prefix or "").strip()
     try:
-        if route_service.stops:
-            stop_label_size = max(len(str(stop)) for stop in route_service.stops) + 4
+        names = route_service.stop_index.complete(prefix)
+        if names:
+            stop_label_size = max(len(name) for name in names) + 4
             stops_per_line = 120 // stop_label_size
             print("Stops:")
-            for index, stop in enumerate(route_service.stops):
-                output = f'{str(stop): >{stop_label_size}}'
+            for index, name in enumerate(names):
+                output = f'{name: >{stop_label_size}}'
                 if index % stops_per_line < stops_per_line - 1:
                     print(output, end="")
                 else:
                     print(output)
+        elif prefix:
+            print(f'No known stops starting with "{prefix}"')
         else:
             print(f"No known stops")
     except RouteServiceException as e:
@@ -373,6 +3409,107 @@ def list_stops(route_service: RouteService, *_unused_args):
     print()
 
 
+def find_stop(route_service: RouteService, name: str) -> Optional[Stop]:
+    """
+    The stop called name, or None after telling the user which stops have the most similar names.
+    """
+    stop = route_service.stop(name)
+    if stop is None:
+        print(f'Unable to find the stop "{name}"')
+        suggestions = route_service.stop_index.suggest(name)
+        if suggestions:
+            print(f"Did you mean: {', '.join(suggestions)}?")
+    return stop
+
+
+def search_stops(route_service: RouteService, name: Optional[str] = None, *_unused_args):
+    """
+    List the stops with names most like name, tolerating typos and abbreviations.
+    """
+    if not name:
+        print("No stop name to search for")
+        return
+    try:
+        candidates = route_service.stop_candidates(name.strip(), 10)
+        if candidates:
+            print(f'Stops like "{name.strip()}":')
+            for stop, similarity in candidates:
+                print(f"  {stop} ({similarity:.2f})")
+        else:
+            print(f'No stops like "{name.strip()}"')
+    except RouteServiceException as e:
+        print(e)
+
+
+def batch_trips(route_service: RouteService, source: Optional[str] = None, *_unused_args, output=None):
+    """
+    Plan the trip for every pair of stops read from the file named source (or standard input, if source is None or
+    "-"), writing one JSON line per pair as they are planned. Each line read is either CSV, a starting stop and a
+    destination stop (a "start,destination" header is skipped), or JSON, a list of two stops or an object with start
+    and destination members.
+    """
+    import csv
+    import json
+
+    output = sys.stdout if output is None else output
+    stream = sys.stdin if source is None or source == "-" else open(source, newline="", encoding="utf-8")
+    rows = collections.deque()  # the stop names (or error) of the pair waiting for its trip
+
+    def pairs() -> Iterator[Tuple[Optional[Stop], Optional[Stop]]]:
+        for line_number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                if line[0] in "[{":
+                    pair = json.loads(line)
+                    start, destination = (pair["start"], pair["destination"]) if isinstance(pair, dict) else pair
+                else:
+                    start, destination = next(csv.reader([line]))
+                    if line_number == 1 and (start.strip().casefold(), destination.strip().casefold()) == ("start", "destination"):
+                        continue
+                start, destination = str(start).strip(), str(destination).strip()
+            except (KeyError, TypeError, ValueError) as e:  # JSONDecodeError and bad unpacking are ValueErrors
+                rows.append((None, None, f"line {line_number}: expected a starting and a destination stop ({e})"))
+                yield None, None
+                continue
+            here, there = route_service.stop(start), route_service.stop(destination)
+            error = None
+            if here is None or there is None:
+                error = f'Unable to find the stop "{start if here is None else destination}"'
+            rows.append((start, destination, error))
+            yield here, there
+
+    try:
+        for trip in route_service.trips(pairs()):
+            start, destination, error = rows.popleft()
+            result = {"start": start, "destination": destination}
+            if error is None:
+                result["trip"] = [str(route) for route in trip]
+            else:
+                result["error"] = error
+            output.write(json.dumps(result) + "\n")
+    except RouteServiceException as e:
+        print(e)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def stop_completer(route_service: RouteService) -> Callable[[str, int], Optional[str]]:
+    """
+    A readline completer for stop names. Readline asks for the matches one state at a time, so the matches are
+    looked up once, for state 0, and then handed out from the list.
+    """
+    matches: List[str] = []
+
+    def complete(text: str, state: int) -> Optional[str]:
+        if state == 0:
+            matches[:] = route_service.stop_index.complete(text)
+        return matches[state] if state < len(matches) else None
+    return complete
+
+
 def one(route_service: RouteService, *_unused_args):
     """
     Question 1
@@ -417,7 +3554,7 @@ def two(route_service: RouteService, *_unused_args):
             print(f"Route with the Fewest Stops: {sorted_routes[0]} ({len(sorted_routes[0].stops)})")
             print(f"Route with the Most Stops: {sorted_routes[-1]} ({len(sorted_routes[-1].stops)})")
             print("Stops with Multiple Routes:")
-            for stop in (s for s in route_service.stops if len(s.routes) >= 2):
+            for stop in route_service.connecting_stops:
                 print(f"  {stop}: {', '.join(str(r) for r in stop.routes)}")
     except RouteServiceException as e:
         print(e)
@@ -442,36 +3579,49 @@ def three(route_service: RouteService, start: Optional[str] = None, destination:
         if start is not None and destination is not None:
             start = start.strip()
             destination = destination.strip()
-            starting_stop = route_service.stop(start)
-            destination_stop = route_service.stop(destination)
-            if starting_stop is None:
-                print(f'Unable to find the stop "{start}"')
-            elif destination_stop is None:
-                print(f'Unable to find the stop "{destination}"')
-            else:
+            starting_stop = find_stop(route_service, start)
+            destination_stop = find_stop(route_service, destination) if starting_stop is not None else None
+            if starting_stop is not None and destination_stop is not None:
                 trip = route_service.trip(starting_stop, destination_stop)
                 print(f"{start} to {destination} -> {', '.join(str(t) for t in trip)}")
-        while start != "" and interactive:  # This explicit check allows the first iteration
-            start = input("Enter the starting stop: ").strip()  # trim white space from input
-            if start == "list":
-                list_stops(route_service)
-            elif start != "":
-                starting_stop = route_service.stop(start)
-                if starting_stop is None:
-                    print(f'Unable to find the stop "{start}"')
-                else:
-                    destination = input("Enter the destination stop: ").strip()  # trim white space from input
-                    if destination != "":
-                        destination_stop = route_service.stop(destination)
-                        if destination_stop is None:
-                            print(f'Unable to find the stop "{destination}"')
-                        else:
-                            trip = route_service.trip(starting_stop, destination_stop)
-                            print(f"{start} to {destination} -> {', '.join(str(t) for t in trip)}")
+        if interactive:
+            readline = _complete_stops(route_service)
+            try:
+                while start != "":  # This explicit check allows the first iteration
+                    start = input("Enter the starting stop: ").strip()  # trim white space from input
+                    if start == "list" or start.startswith("list "):
+                        list_stops(route_service, start[len("list"):].strip())
+                    elif start != "":
+                        starting_stop = find_stop(route_service, start)
+                        if starting_stop is not None:
+                            destination = input("Enter the destination stop: ").strip()  # trim white space from input
+                            if destination != "":
+                                destination_stop = find_stop(route_service, destination)
+                                if destination_stop is not None:
+                                    trip = route_service.trip(starting_stop, destination_stop)
+                                    print(f"{start} to {destination} -> {', '.join(str(t) for t in trip)}")
+            finally:
+                if readline is not None:
+                    readline.set_completer(None)
     except RouteServiceException as e:
         print(e)
 
 
+def _complete_stops(route_service: RouteService):
+    """
+    Complete stop names with tab while reading input, where readline is available. Returns the readline module so the
+    completer can be removed afterwards, or None.
+    """
+    try:
+        import readline
+    except ImportError:  # not every platform has readline
+        return None
+    readline.set_completer(stop_completer(route_service))
+    readline.set_completer_delims("")  # stop names have spaces, complete the whole line
+    readline.parse_and_bind("tab: complete")
+    return readline
+
+
 def main():
     ###
     # Parse command line arguments
@@ -483,6 +3633,22 @@ def main():
     argument_parser.add_argument('-a', '--api-key', help='specify an API Key directly, this will override the environment value for MBTA_API_KEY (if set)')
     argument_parser.add_argument('-v', '--verbose', default=0, dest='verbosity', action='count', help='be more verbose with output')
     argument_parser.add_argument('-i', '--interactive', default=False, action="store_true", help='interactive solution for question three')
+    argument_parser.add_argument('--base-url', default=MBTARouteService.base_url, metavar="URL", help='request the network from the API at URL, e.g. a local stand-in (default: %(default)s)')
+    argument_parser.add_argument('-w', '--workers', default=8, type=int, help='number of concurrent requests used to load stops (default: %(default)s)')
+    argument_parser.add_argument('--bulk', default=0, type=int, metavar="ROUTES", help='request the stops of up to ROUTES routes per request')
+    argument_parser.add_argument('--lean', default=False, action="store_true", help='only request the route and stop attributes needed to plan trips')
+    argument_parser.add_argument('--no-cache', default=False, action="store_true", help='neither read nor write the network cache')
+    argument_parser.add_argument('--refresh-cache', default=False, action="store_true", help='reload the network from the API and update the network cache')
+    argument_parser.add_argument('--clear-cache', default=False, action="store_true", help='remove every cached network')
+    argument_parser.add_argument('--cache-ttl', default=24 * 60 * 60, type=float, metavar="SECONDS", help='use cached networks up to SECONDS old (default: %(default)s)')
+    argument_parser.add_argument('-p', '--precompute', default=False, action="store_true", help='answer trips from a precomputed transfer table (requires numpy)')
+    argument_parser.add_argument('--transfer-table', metavar="FILE", help='load the precomputed transfer table from FILE, building and saving it if FILE does not exist')
+    argument_parser.add_argument('--serve', nargs="?", const=RouteServer.default_address, metavar="ADDRESS", help='load the network once and answer queries from clients at ADDRESS, [HOST:]PORT or a Unix socket path (default: %(const)s)')
+    argument_parser.add_argument('--refresh-interval', type=float, metavar="SECONDS", help='while serving (or interactive), refresh the network from the API every SECONDS in the background')
+    argument_parser.add_argument('--reload-interval', default=24 * 60 * 60, type=float, metavar="SECONDS", help='with --refresh-interval, reload the whole network (picking up stop changes refreshes miss) every SECONDS instead (default: %(default)s)')
+    argument_parser.add_argument('--timings', default=False, action="store_true", help='time loading and planning by phase (HTTP, backoff, decoding, ...), printing a summary to standard error at exit')
+    argument_parser.add_argument('--metrics', metavar="FILE", help='record request, cache, lookup and trip metrics, writing them to FILE in the Prometheus text format at exit (served at /metrics while serving in any case)')
+    argument_parser.add_argument('--connect', nargs="?", const=RouteServer.default_address, metavar="ADDRESS", help='answer from the server at ADDRESS (see --serve) instead of loading the network (default: %(const)s)')
 
     route_group = argument_parser.add_argument_group("route types")
     for route_type in RouteTypes:
@@ -493,7 +3659,9 @@ def main():
     other_functions = argument_parser.add_mutually_exclusive_group()
     other_functions.add_argument("-1", "--one", dest="func", action="store_const", const=one, help="solution for question one")
     other_functions.add_argument("-2", "--two", dest="func", action="store_const", const=two, help="solution for question two")
-    other_functions.add_argument('-l', '--list-stops', dest="func", action="store_const", const=list_stops, help='list the stops in this collection of routes')
+    other_functions.add_argument('-l', '--list-stops', dest="func", action="store_const", const=list_stops, help='list the stops in this collection of routes, or those starting with the start argument')
+    other_functions.add_argument('-f', '--find-stops', dest="func", action="store_const", const=search_stops, help='list the stops with names most like the start argument, allowing for typos')
+    other_functions.add_argument('-b', '--batch', dest="func", action="store_const", const=batch_trips, help='plan the trips between the pairs of stops in the file named by the start argument (default: standard input), as CSV or JSON Lines, writing JSON Lines')
 
     argument_parser.set_defaults(func=three)
     argument_parser.add_argument("start", nargs="?", metavar="INITIAL_STOP", help='initial stop')
@@ -502,10 +3670,13 @@ def main():
     parsed_arguments = argument_parser.parse_args()
 
     ###
-    # Configure Logging
+    # Configure Logging, when asked to be verbose. Otherwise logging is only imported if there is a warning, which
+    # logging's last resort handler prints as it is
     ###
-    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s', datefmt='%a, %d %b %Y %H:%M:%S')
-    logging.getLogger().setLevel(logging.WARNING - parsed_arguments.verbosity * 10)
+    if parsed_arguments.verbosity:
+        import logging
+        logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s', datefmt='%a, %d %b %Y %H:%M:%S')
+        logging.getLogger().setLevel(logging.WARNING - parsed_arguments.verbosity * 10)
 
     if parsed_arguments.route_types:
         route_types = parsed_arguments.route_types
@@ -516,11 +3687,69 @@ def main():
         api_key = parsed_arguments.api_key
     elif "MBTA_API_KEY" in os.environ:
         api_key = os.environ.get("MBTA_API_KEY")
-    route_service = MBTARouteService(api_key, route_types=route_types)
+    if parsed_arguments.connect is not None:
+        with RouteClient(parsed_arguments.connect) as route_client:
+            parsed_arguments.func(route_client, parsed_arguments.start, parsed_arguments.destination, parsed_arguments.interactive)
+        return
+    if parsed_arguments.clear_cache:
+        NetworkCache().clear()
+    cache = None if parsed_arguments.no_cache else NetworkCache(ttl=parsed_arguments.cache_ttl)
+    timings = PhaseTimings() if parsed_arguments.timings else None
+    metrics = MetricsRegistry() if parsed_arguments.metrics is not None or parsed_arguments.serve is not None else None
+    route_service = MBTARouteService(
+        api_key, route_types=route_types, workers=parsed_arguments.workers, bulk=parsed_arguments.bulk, cache=cache,
+        lean=parsed_arguments.lean, timings=timings, metrics=metrics
+    )
+    route_service.base_url = parsed_arguments.base_url
+    if parsed_arguments.refresh_cache:
+        try:
+            route_service.load(use_cache=False)
+        except RouteServiceException as e:
+            print(e)
+    if parsed_arguments.precompute or parsed_arguments.transfer_table is not None:
+        # Reported on stderr, stdout being the answers (JSON Lines with -b)
+        try:
+            table = None
+            if parsed_arguments.transfer_table is not None and os.path.exists(parsed_arguments.transfer_table):
+                try:
+                    table = route_service.precompute(TransferTable.load(parsed_arguments.transfer_table))
+                except RouteServiceException as e:
+                    print(f"Rebuilding the transfer table: {e}", file=sys.stderr)
+            if table is None:
+                table = route_service.precompute()
+                if parsed_arguments.transfer_table is not None:
+                    table.save(parsed_arguments.transfer_table)
+            print(f"Transfer table: {table}", file=sys.stderr)
+        except RouteServiceException as e:
+            print(e, file=sys.stderr)
     ###
     # Execute
     ###
-    parsed_arguments.func(route_service, parsed_arguments.start, parsed_arguments.destination, parsed_arguments.interactive)
+    refresher = None
+    if parsed_arguments.refresh_interval is not None:
+        refresher = NetworkRefresher(route_service, parsed_arguments.refresh_interval, parsed_arguments.reload_interval).start()
+    try:
+        if parsed_arguments.serve is not None:
+            print(f"Serving on {parsed_arguments.serve}")
+            try:
+                RouteServer(route_service, parsed_arguments.serve).run()
+            except RouteServiceException as e:
+                print(e)
+            except KeyboardInterrupt:
+                pass
+            return
+        parsed_arguments.func(route_service, parsed_arguments.start, parsed_arguments.destination, parsed_arguments.interactive)
+    finally:
+        if refresher is not None:
+            refresher.stop(0)
+        route_service.close()
+        if timings is not None:
+            print(timings, file=sys.stderr)
+        if parsed_arguments.metrics is not None:
+            try:
+                metrics.write(parsed_arguments.metrics)
+            except OSError as e:
+                print(f"Unable to write metrics ({e})", file=sys.stderr)
 
 
 if __name__ == "__main__":
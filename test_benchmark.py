@@ -0,0 +1,78 @@
+import copy
+import unittest
+
+import benchmark
+import route_service
+
+
+class TestSyntheticNetwork(unittest.TestCase):
+    def test_topologies(self):
+        for topology in benchmark.TOPOLOGIES:
+            routes, route_stops = benchmark.synthetic_network(200, 6, 0.3, topology, seed=1)
+            self.assertEqual(200, len(routes), f"Wrong number of {topology} routes")
+            for stops in route_stops:
+                self.assertEqual(6, len(set(stop["id"] for stop in stops)), f"A {topology} route has the wrong number of stops")
+            service = benchmark.build(routes, route_stops)
+            network = service.network
+            self.assertGreater(len(network.connecting_stops()), 0, f"No {topology} route shares a stop")
+            self.assertLess(len(network.stops), 200 * 6, f"Shared {topology} stops were duplicated")
+            first, last = network.stops[0], network.stops[-1]
+            self.assertTrue(service.trip(first, last), f"The {topology} network is not connected")
+            self.assertEqual(routes, benchmark.synthetic_network(200, 6, 0.3, topology, seed=1)[0], f"The {topology} network is not reproducible")
+
+    def test_unknown_topology(self):
+        with self.assertRaises(ValueError):
+            benchmark.synthetic_network(topology="ring")
+
+    def test_generic_network(self):
+        routes, route_stops = benchmark.synthetic_network(50, 5, 0.5, "grid")
+        stops = benchmark.generic_network(routes, route_stops)
+        service = benchmark.build(routes, route_stops)
+        here, there = service.network.stops[0], service.network.stops[-1]
+        generic_trip = route_service.RouteService().trip(stops[here.id], stops[there.id])
+        self.assertEqual(len(service.trip(here, there)), len(generic_trip), "Engines planned trips with different transfers")
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run(self):
+        report = benchmark.run(30, 5, 0.5, "radial", trips=20, lookups=10, repeat=1, table_limit=10)
+        self.assertEqual(30, report["network"]["routes"], "Network summary is wrong")
+        results = report["results"]
+        for name in ("load.total", "lookup.stop.name", "lookup.route.id", "statistics.two", "trip.network", "trip.batch", "trip.generic"):
+            self.assertGreater(results[name]["mean_us"], 0, f"{name} was not timed")
+        self.assertEqual(20, results["trip.network"]["count"], "Wrong number of trips")
+        self.assertEqual(0, results["trip.network"]["unreachable"], "Trips in a connected network were not found")
+        self.assertEqual(0, results["trip.generic"]["disagreements"], "Engines disagree")
+        self.assertIn("skipped", results["trip.table"], "Transfer table over the limit was built")
+        self.assertIn("disagreements", benchmark.run(30, 5, trips=5, lookups=5, repeat=1, engines=["network", "table"])["results"]["trip.table"])
+
+    def test_summarize(self):
+        summary = benchmark.summarize([0.001, 0.003, 0.002, 0.004])
+        self.assertEqual(4, summary["count"], "Wrong count")
+        self.assertAlmostEqual(2500, summary["mean_us"], msg="Wrong mean")
+        self.assertAlmostEqual(2000, summary["p50_us"], msg="Wrong median")
+        self.assertAlmostEqual(4000, summary["p99_us"], msg="Wrong 99th percentile")
+        self.assertNotIn("p50_us", benchmark.summarize([0.01], 10), "Aggregated samples have percentiles")
+
+    def test_regressions(self):
+        report = {"runs": [{"parameters": {"topology": "grid", "routes": 10}, "results": {"trip.network": {"mean_us": 10.0}, "trip.table": {"skipped": ""}}}]}
+        baseline = copy.deepcopy(report)
+        self.assertListEqual([], benchmark.regressions(report, baseline), "Unchanged run was a regression")
+        report["runs"][0]["results"]["trip.network"]["mean_us"] = 12.0
+        self.assertListEqual([], benchmark.regressions(report, baseline), "Slowdown within the tolerance was a regression")
+        report["runs"][0]["results"]["trip.network"]["mean_us"] = 20.0
+        self.assertEqual(1, len(benchmark.regressions(report, baseline)), "Slowdown was not a regression")
+        baseline["runs"][0]["parameters"]["routes"] = 20
+        self.assertListEqual([], benchmark.regressions(report, baseline), "Runs with different parameters were compared")
+
+    def test_run_load(self):
+        report = benchmark.run_load(20, 5, repeat=1, workers=4)
+        results = report["results"]
+        for scenario in ("cold", "refresh", "refresh_changed", "revalidate", "cached"):
+            self.assertGreater(results[f"load.{scenario}"]["mean_us"], 0, f"{scenario} load was not timed")
+        self.assertEqual(21, results["load.cold"]["200"], "Expected one route request and one stop request per route")
+        self.assertEqual(1, results["load.refresh"]["304"], "Unchanged route list was not revalidated")
+        self.assertEqual(0, results["load.revalidate"].get("200", 0), "Unchanged responses were downloaded again")
+        self.assertEqual(0, results["load.cached"]["requests"], "Fresh cached network made requests")
+        paginated = benchmark.run_load(20, 5, repeat=1, page_size=8, workers=4)["results"]
+        self.assertEqual(3 + 20, paginated["load.cold"]["200"], "Pages were not requested")
@@ -0,0 +1,109 @@
+import os
+import tempfile
+import unittest
+
+import benchmark
+import fake_mbta
+import route_service
+
+
+class TestFakeMBTAServer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.routes, self.route_stops = benchmark.synthetic_network(30, 6, 0.5, "grid", seed=2)
+        self.expected = benchmark.build(self.routes, self.route_stops).network
+
+    def route_service(self, server, **kwargs):
+        service = route_service.MBTARouteService(route_types=[route_service.RouteTypes.BUS], **kwargs)
+        service.base_url = server.base_url
+        service.backoff_factor = 0.1
+        return service
+
+    def assertNetworkEqual(self, network, message):
+        self.assertSetEqual(set(self.expected.route_ids), set(network.route_ids), f"{message}: wrong routes")
+        for route in self.expected.routes:
+            self.assertSetEqual(
+                set(stop.id for stop in route.stops), set(stop.id for stop in network.route(route.id).stops),
+                f"{message}: wrong stops of {route.id}"
+            )
+
+    def test_load(self):
+        with fake_mbta.FakeMBTAServer(self.routes, self.route_stops) as server:
+            service = self.route_service(server, workers=4)
+            self.assertNetworkEqual(service.network, "Loaded network differs")
+        self.assertEqual(31, server.stats["200"], "Expected one route request and one stop request per route")
+
+    def test_pagination(self):
+        for kwargs in ({}, {"bulk": 4}, {"lean": True}):
+            with fake_mbta.FakeMBTAServer(self.routes, self.route_stops, page_size=4) as server:
+                service = self.route_service(server, workers=4, **kwargs)
+                self.assertNetworkEqual(service.network, f"Paginated network differs ({kwargs})")
+            self.assertGreater(server.stats["requests"], 31 if not kwargs.get("bulk") else 9, f"Pages were not requested ({kwargs})")
+
+    def test_rate_limit(self):
+        with fake_mbta.FakeMBTAServer(self.routes[:8], self.route_stops[:8], rate_limit=5) as server:
+            service = self.route_service(server, workers=2)
+            self.assertEqual(8, len(service.network.routes), "Rate limited load failed")
+        self.assertGreater(server.stats["429"], 0, "No request was rate limited")
+        self.assertEqual(9, server.stats["200"], "Rate limited requests were not retried")
+
+    def test_refresh(self):
+        with fake_mbta.FakeMBTAServer(self.routes, self.route_stops) as server:
+            service = self.route_service(server, workers=4)
+            service.load()
+            before = dict(server.stats)
+            self.assertFalse(service.refresh(), "Unchanged network changed")
+            self.assertEqual(1, server.stats["304"] - before.get("304", 0), "Route list was not revalidated")
+            changed = [dict(self.routes[0], attributes=dict(self.routes[0]["attributes"], long_name="Changed"))] + self.routes[1:]
+            server.update(changed, self.route_stops)
+            changes = service.refresh()
+        self.assertListEqual([self.routes[0]["id"]], list(changes.changed), "Changed route was not refreshed")
+        self.assertEqual("Changed", service.route(self.routes[0]["id"]).long_name, "Changed route was not updated")
+
+    def test_connection_reuse(self):
+        with fake_mbta.FakeMBTAServer(self.routes, self.route_stops) as server:
+            with self.route_service(server, workers=4) as service:
+                service.load()
+                connections = server.stats["connections"]
+                changed = [dict(route, attributes=dict(route["attributes"], long_name="Changed")) for route in self.routes[:4]] + self.routes[4:]
+                server.update(changed, self.route_stops)
+                self.assertEqual(4, len(service.refresh().changed), "Changed routes were not refreshed")
+                self.assertEqual(connections, server.stats["connections"], "Refresh did not reuse the connections of the load")
+            service.load(use_cache=False)
+            self.assertNetworkEqual(service.network, "Network loaded after close() differs")
+            service.close()
+
+    def test_revalidate(self):
+        with tempfile.TemporaryDirectory() as directory, fake_mbta.FakeMBTAServer(self.routes, self.route_stops) as server:
+            cache = route_service.NetworkCache(directory, ttl=0)
+            self.route_service(server, cache=cache).load()
+            before = dict(server.stats)
+            service = self.route_service(server, cache=cache, workers=1)
+            service.load()
+            self.assertNetworkEqual(service.network, "Revalidated network differs")
+        self.assertEqual(31, server.stats["304"], "Unchanged responses were not revalidated")
+        self.assertEqual(1, server.stats["connections"] - before["connections"], "Revalidation did not reuse its connection")
+
+    def test_async_pagination(self):
+        import asyncio
+
+        with fake_mbta.FakeMBTAServer(self.routes, self.route_stops, page_size=4) as server:
+            service = route_service.AsyncMBTARouteService(route_types=[route_service.RouteTypes.BUS], workers=4)
+            service.base_url = server.base_url
+            asyncio.run(service.load())
+        self.assertNetworkEqual(service.network, "Paginated network loaded asynchronously differs")
+
+    def test_not_found(self):
+        with fake_mbta.FakeMBTAServer(self.routes, self.route_stops) as server:
+            service = self.route_service(server)
+            service.route_path = "/missing"
+            with self.assertRaises(route_service.RouteServiceHttpException):
+                service.load()
+
+    def test_fixtures(self):
+        with fake_mbta.FakeMBTAServer(self.routes, self.route_stops) as server:
+            routes, route_stops = fake_mbta.record(self.route_service(server))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "network.json")
+            fake_mbta.save_fixtures(path, routes, route_stops)
+            with fake_mbta.FakeMBTAServer(*fake_mbta.load_fixtures(path)) as server:
+                self.assertNetworkEqual(self.route_service(server).network, "Recorded network differs")
@@ -18,11 +18,25 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import contextlib
 import copy
+import io
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
+import urllib.parse
 
 import responses
 
+import fake_mbta
 import route_service
 
 RED_ROUTE = {
@@ -2023,12 +2037,357 @@ RED_STOP_RESPONSE = {
 }
 
 
+def link(route: route_service.Route, stop: route_service.Stop):
+    route.stops.add(stop)
+    stop.routes.add(route)
+
+
+def mesh_network(route_count: int, stops_per_route: int):
+    """
+    Routes are laid out in a ring and every route shares its last stop with the next route and its first stop with
+    every route ten positions ahead, giving a densely connected network similar to a city bus system.
+    """
+    routes = [route_service.Route(f"route-{r}") for r in range(route_count)]
+    stops = [[route_service.Stop(f"stop-{r}-{s}") for s in range(stops_per_route)] for r in range(route_count)]
+    for index, route in enumerate(routes):
+        for stop in stops[index]:
+            link(route, stop)
+        link(routes[(index + 1) % route_count], stops[index][-1])
+        link(routes[(index + 10) % route_count], stops[index][0])
+    return routes, stops
+
+
+class StaticRouteService(route_service.RouteService):
+    def __init__(self, routes):
+        self._routes = set(routes)
+
+    @property
+    def routes(self):
+        return self._routes
+
+    @property
+    def stops(self):
+        return set(s for r in self._routes for s in r.stops)
+
+    def stop(self, stop=None):
+        return next((s for s in self.stops if s.id == stop), None)
+
+    def route(self, route=None):
+        return next((r for r in self._routes if r.id == route), None)
+
+
+class TestRouteService(unittest.TestCase):
+    def setUp(self) -> None:
+        self.route_service = route_service.RouteService()
+
+    def test_trip_shared_route(self):
+        routes, stops = mesh_network(3, 4)
+        trip = self.route_service.trip(stops[0][1], stops[0][2])
+        self.assertListEqual([routes[0]], trip, "Stops on the same route should not require a transfer")
+
+    def test_trip_same_stop(self):
+        routes, stops = mesh_network(3, 4)
+        trip = self.route_service.trip(stops[1][1], stops[1][1])
+        self.assertListEqual([routes[1]], trip, "A stop should be reachable from itself")
+
+    def test_trip_fewest_transfers(self):
+        routes, stops = mesh_network(200, 10)
+        trip = self.route_service.trip(stops[0][1], stops[21][1])
+        # 0 -> 10 -> 20 -> 21, two "ten ahead" connections and a single step
+        self.assertEqual(4, len(trip), f"Expected a trip with 3 transfers, got {trip}")
+        self.assertEqual(routes[0], trip[0], "Trip should start on the starting stop's route")
+        self.assertEqual(routes[21], trip[-1], "Trip should end on the destination stop's route")
+        for first, second in zip(trip, trip[1:]):
+            self.assertTrue(first.stops & second.stops, f"{first} and {second} do not share a stop")
+
+    def test_trip_disconnected(self):
+        routes, stops = mesh_network(3, 4)
+        island_route = route_service.Route("island")
+        island_stop = route_service.Stop("island-stop")
+        link(island_route, island_stop)
+        self.assertListEqual([], self.route_service.trip(stops[0][1], island_stop), "Trip exists")
+
+    def test_trip_not_stops(self):
+        self.assertListEqual([], self.route_service.trip("here", "there"), "Trip exists")
+
+    def test_trips(self):
+        routes, stops = mesh_network(60, 5)
+        island_stop = route_service.Stop("island-stop")
+        link(route_service.Route("island"), island_stop)
+        pairs = [(stops[here][1], stops[there][s]) for here in (0, 5, 33, 0) for there in (1, 21, 47, 59) for s in (0, 4)]
+        pairs += [(stops[3][3], island_stop), ("here", "there")]
+        expected = [self.route_service.trip(here, there) for here, there in pairs]
+        self.assertListEqual(expected, list(self.route_service.trips(pairs)), "Batch trips differ from single trips")
+        self.assertListEqual(expected, list(self.route_service.trips(pairs, origins=1)), "Evicted searches changed the trips")
+
+    def test_trips_streamed(self):
+        routes, stops = mesh_network(20, 4)
+        endless = ((stops[i % 20][0], stops[(i * 7) % 20][3]) for i in itertools.count())
+        trips = list(itertools.islice(self.route_service.trips(endless), 50))
+        self.assertEqual(50, len(trips), "Trips were not yielded as the pairs were read")
+
+    def test_batch(self):
+        routes, stops = mesh_network(20, 4)
+        service = StaticRouteService(routes)
+        lines = ["start,destination", "stop-0-1,stop-2-3", '["stop-0-1", "stop-5-2"]', '{"start": "stop-4-0", "destination": "stop-4-2"}', "stop-0-1,nowhere", "stop-0-1", ""]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "pairs.csv")
+            with open(path, "w") as pairs:
+                pairs.write("\n".join(lines))
+            output = io.StringIO()
+            route_service.batch_trips(service, path, output=output)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(5, len(results), "Expected one result per pair")
+        self.assertListEqual([str(r) for r in service.trip(stops[0][1], stops[2][3])], results[0]["trip"], "CSV pair has the wrong trip")
+        self.assertListEqual([str(r) for r in service.trip(stops[0][1], stops[5][2])], results[1]["trip"], "JSON list pair has the wrong trip")
+        self.assertListEqual(["route-4"], results[2]["trip"], "JSON object pair has the wrong trip")
+        self.assertEqual('Unable to find the stop "nowhere"', results[3]["error"], "Unknown stop was not reported")
+        self.assertIn("line 6", results[4]["error"], "Malformed line was not reported")
+
+
+class TestNetwork(unittest.TestCase):
+    def setUp(self) -> None:
+        self.routes, self.stops = mesh_network(60, 5)
+        self.unbound_trips = {}
+        self.route_service = route_service.RouteService()
+        for here, there in ((0, 1), (0, 21), (5, 47), (59, 0), (33, 33)):
+            self.unbound_trips[(here, there)] = [r.id for r in self.route_service.trip(self.stops[here][1], self.stops[there][2])]
+        self.members = {route.id: set(stop.id for stop in route.stops) for route in self.routes}
+        self.network = route_service.Network(self.routes, [list(route.stops) for route in self.routes])
+
+    def test_membership(self):
+        for route in self.routes:
+            self.assertIs(self.network, route._network, f"{route} was not bound to the network")
+            self.assertSetEqual(self.members[route.id], set(stop.id for stop in route.stops), f"{route} has the wrong stops")
+            self.assertEqual(len(self.members[route.id]), len(route.stops), f"{route} has the wrong number of stops")
+            for stop in route.stops:
+                self.assertIn(route, stop.routes, f"{stop} does not list {route}")
+                self.assertIn(stop, route.stops, f"{route} does not contain {stop}")
+        self.assertNotIn(self.stops[1][1], self.routes[0].stops, "Route contains a stop it does not serve")
+        self.assertNotIn(route_service.Stop("stop-1-1"), self.routes[0].stops, "Route contains a stop it does not serve")
+        self.assertIn(route_service.Stop("stop-0-1"), self.routes[0].stops, "Route does not contain an equal stop")
+        self.assertSetEqual({self.stops[0][-1]}, self.routes[0].stops & self.routes[1].stops, "Views do not intersect like sets")
+        self.assertEqual(len(set(s for r in self.routes for s in self.members[r.id])), len(self.network.stops), "Stops were not merged")
+
+    def test_lookup(self):
+        self.assertIs(self.routes[7], self.network.route("route-7"), "Route ID does not index the route")
+        self.assertIs(self.routes[7], self.network.route("ROUTE-7"), "Route name does not index the route ignoring case")
+        self.assertIs(self.stops[7][2], self.network.stop("stop-7-2"), "Stop ID does not index the stop")
+        self.assertIsNone(self.network.route("route-60"), "Unknown route ID indexed a route")
+        self.assertIsNone(self.network.stop(None), "None indexed a stop")
+        self.assertIs(self.network.route_set, self.network.route_set, "Route set is not computed once")
+        self.assertSetEqual(set(self.routes), self.network.route_set, "Route set does not hold the routes")
+
+    def test_transfers(self):
+        for route in self.routes:
+            expected = self.route_service.transfers(route)
+            self.assertDictEqual(expected, self.network.transfers(route._index), f"{route} has the wrong transfers")
+
+    def test_connecting_stops(self):
+        expected = set(stop for stop in self.network.stops if len(stop.routes) >= 2)
+        self.assertSetEqual(expected, set(self.network.connecting_stops()), "Unexpected connecting stops")
+
+    def test_trips(self):
+        pairs = [(self.stops[here][1], self.stops[there][2]) for here, there in self.unbound_trips] * 2
+        pairs.append((self.stops[0][0], route_service.Stop("stop-0-0")))  # an equal stop outside the network
+        expected = [self.route_service.trip(here, there) for here, there in pairs]
+        self.assertListEqual(expected, list(self.route_service.trips(pairs)), "Batch trips differ from single trips")
+
+    def test_trip(self):
+        for (here, there), expected in self.unbound_trips.items():
+            trip = self.route_service.trip(self.stops[here][1], self.stops[there][2])
+            self.assertEqual(len(expected), len(trip), f"Network trip {trip} is not as short as {expected}")
+            self.assertEqual(self.routes[here], trip[0], "Trip should start on the starting stop's route")
+            self.assertEqual(self.routes[there], trip[-1], "Trip should end on the destination stop's route")
+            for first, second in zip(trip, trip[1:]):
+                self.assertTrue(first.stops & second.stops, f"{first} and {second} do not share a stop")
+
+    def test_patch(self):
+        routes = [route_service.Route(route.id) for route in self.routes[1:]] + [route_service.Route("route-60")]
+        shared = route_service.Stop("stop-6-1")
+        route_stops = {"route-5": [], "route-60": [route_service.Stop("stop-60-0"), shared]}
+        patched = self.network.patch(routes, route_stops, lambda stop: route_service.Stop(stop.id))
+        self.assertIsNone(patched.stop("stop-0-1"), "Stop no route serves was kept")
+        self.assertIsNone(patched.stop("stop-5-1"), "Stop no route serves was kept")
+        self.assertEqual({"route-10"}, set(route.id for route in patched.stop("stop-0-0").routes), "Stop lost a route still serving it")
+        self.assertEqual(0, len(patched.route("route-5").stops), "Changed route kept its stops")
+        self.assertIs(shared, patched.stop("stop-6-1"), "Changed route's stop was not used")
+        self.assertEqual({"route-6", "route-60"}, set(route.id for route in shared.routes), "Membership was not patched")
+        self.assertFalse(set(map(id, patched.stops)) & set(map(id, self.network.stops)), "Stops were shared between networks")
+        for route in self.routes:
+            self.assertIs(self.network, route._network, "Patching changed the network")
+            self.assertSetEqual(self.members[route.id], set(stop.id for stop in route.stops), f"Patching changed {route}")
+        trip = self.route_service.trip(patched.stop("stop-60-0"), patched.stop("stop-7-2"))
+        self.assertListEqual(["route-60", "route-6", "route-7"], [route.id for route in trip], "Patched network trip is wrong")
+
+
+class TestNameIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.routes, self.stops = mesh_network(2000, 6)  # 12,000 stops
+        self.network = route_service.Network(self.routes, [list(route.stops) for route in self.routes])
+        self.route_service = StaticRouteService(self.routes)
+
+    def test_complete(self):
+        index = self.network.stop_index
+        self.assertEqual(12000, len(index), "Not every stop name was indexed")
+        self.assertListEqual([f"stop-1999-{s}" for s in range(6)], index.complete("STOP-1999"), "Prefix does not complete ignoring case")
+        self.assertListEqual(["stop-1-0", "stop-1-1"], index.complete("stop-1", 2), "Completions were not limited")
+        self.assertListEqual([], index.complete("station"), "Unknown prefix completed")
+        self.assertIs(index, self.network.stop_index, "Stop index is not built once")
+
+    def test_complete_prefixes(self):  # benchmark.py times completions
+        index = self.network.stop_index
+        for prefix in [f"stop-{r}" for r in range(0, 2000, 97)] + ["stop-", "stop-1999-5", "stop-19999"]:
+            expected = [name for name in index.names if name.startswith(prefix)][:20]
+            self.assertListEqual(expected, index.complete(prefix, 20), f"Wrong completions of {prefix}")
+
+    def test_suggest(self):
+        index = self.network.stop_index
+        self.assertListEqual(["stop-12-0", "stop-12-1"], index.suggest("Stop-12-9", 2), "Suggestions do not share the longest prefix")
+        self.assertListEqual([], index.suggest("xyz"), "Unrelated text has suggestions")
+
+    def test_completer(self):
+        complete = route_service.stop_completer(self.route_service)
+        self.assertEqual("stop-77-0", complete("stop-77-", 0), "First completion is not the first match")
+        self.assertEqual("stop-77-5", complete("stop-77-", 5), "Last completion is not the last match")
+        self.assertIsNone(complete("stop-77-", 6), "Completion did not end after the matches")
+
+    def test_did_you_mean(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            route_service.three(self.route_service, "stop-5-9", "stop-6-1")
+        self.assertIn('Unable to find the stop "stop-5-9"', output.getvalue())
+        self.assertIn("Did you mean: stop-5-0, stop-5-1", output.getvalue())
+
+
+class TestFuzzyIndex(unittest.TestCase):
+    NAMES = [
+        "Harvard Square", "Park Street", "Kendall/MIT", "Central Square", "Washington St @ Elm St", "Washington St opp Elm St",
+        "Main St @ Park St", "Kenmore", "Harvard Ave @ Brighton Ave", "Arlington"
+    ]
+
+    def setUp(self) -> None:
+        self.stops = [route_service.Stop(name) for name in self.NAMES]
+        self.index = route_service.FuzzyIndex(self.stops)
+
+    def names(self, candidates):
+        return [str(stop) for stop, _ in candidates]
+
+    def test_variants(self):
+        self.assertEqual("Harvard Square", self.names(self.index.search("Harvard Sq", 1))[0], "Abbreviation was not matched")
+        self.assertEqual("Park Street", self.names(self.index.search("Park St", 1))[0], "Abbreviation was not matched")
+        self.assertEqual("Kendall/MIT", self.names(self.index.search("kendall mit", 1))[0], "Punctuation was not ignored")
+        self.assertEqual("Arlington", self.names(self.index.search("Arlingtn", 1))[0], "Typo was not tolerated")
+
+    def test_ranking(self):
+        candidates = self.index.search("Kendall/MIT", 3)
+        self.assertEqual(1.0, candidates[0][1], "An exact match is not perfectly similar")
+        self.assertListEqual(sorted((score for _, score in candidates), reverse=True), [score for _, score in candidates], "Candidates are not ranked")
+
+    def test_limits(self):
+        self.assertLessEqual(len(self.index.search("Washington St", 1)), 1, "Candidates were not limited to k")
+        self.assertListEqual([], self.index.search("Quincy Adams"), "Dissimilar names were returned")
+        self.assertListEqual([], self.index.search(""), "An empty name was matched")
+        for _, score in self.index.search("Harvard", 10, threshold=0.4):
+            self.assertGreaterEqual(score, 0.4, "A candidate below the threshold was returned")
+
+    def test_same_name(self):
+        stops = [route_service.Stop("Main St @ Elm St"), route_service.Stop("main st @ elm st")]
+        candidates = route_service.FuzzyIndex(stops).search("Main St at Elm", 5)
+        self.assertSetEqual(set(stops), set(stop for stop, _ in candidates), "Stops sharing a name were not both returned")
+
+    def test_stop_candidates(self):
+        routes, stops = mesh_network(2000, 6)
+        network = route_service.Network(routes, [list(route.stops) for route in routes])
+        self.assertEqual(stops[1234][5], network.fuzzy_index.search("stop 1234 5", 1)[0][0], "Stop was not found by a variant of its name")
+        self.assertIs(network.fuzzy_index, network.fuzzy_index, "Fuzzy index is not built once")
+        self.assertEqual(stops[7][3], StaticRouteService(routes[:20]).stop_candidates("stop-7_3", 1)[0][0], "Default candidates are wrong")
+
+
+class TestTransferTable(unittest.TestCase):
+    def setUp(self) -> None:
+        self.routes, self.stops = mesh_network(60, 5)
+        self.planner = StaticRouteService(self.routes)
+        self.route_service = StaticRouteService(self.routes)
+        self.table = self.route_service.precompute()
+
+    def test_table_shape(self):
+        self.assertEqual(60, len(self.table.route_ids), "Unexpected number of routes in the table")
+        self.assertEqual("uint8", str(self.table.transfers.dtype), "Unexpected transfer count type")
+        self.assertEqual("int16", str(self.table.next_hop.dtype), "Unexpected next hop type")
+        self.assertEqual(2 * 60 * 60 + 60 * 60, self.table.nbytes, "Unexpected table size")
+
+    def test_trip_matches_search(self):
+        for here, there in ((0, 1), (0, 21), (5, 47), (59, 0), (33, 33)):
+            planned = self.planner.trip(self.stops[here][1], self.stops[there][2])
+            looked_up = self.route_service.trip(self.stops[here][1], self.stops[there][2])
+            self.assertEqual(len(planned), len(looked_up), f"Table trip {looked_up} is not as short as {planned}")
+            self.assertEqual(self.routes[here], looked_up[0], "Trip should start on the starting stop's route")
+            self.assertEqual(self.routes[there], looked_up[-1], "Trip should end on the destination stop's route")
+            for first, second in zip(looked_up, looked_up[1:]):
+                self.assertTrue(first.stops & second.stops, f"{first} and {second} do not share a stop")
+
+    def test_trips(self):
+        pairs = [(self.stops[here][1], self.stops[there][2]) for here in (0, 5, 33) for there in (1, 21, 47, 59)]
+        expected = [self.route_service.trip(here, there) for here, there in pairs]
+        self.assertListEqual(expected, list(self.route_service.trips(pairs)), "Batch trips differ from table trips")
+
+    def test_trip_disconnected(self):
+        island_route = route_service.Route("island")
+        island_stop = route_service.Stop("island-stop")
+        link(island_route, island_stop)
+        service = StaticRouteService(self.routes + [island_route])
+        service.precompute()
+        self.assertListEqual([], service.trip(self.stops[0][1], island_stop), "Trip exists")
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "table.npz")
+            self.table.save(path)
+            loaded = route_service.TransferTable.load(path)
+        self.assertListEqual(self.table.route_ids, loaded.route_ids, "Route ids were not restored")
+        self.assertTrue((self.table.transfers == loaded.transfers).all(), "Transfer counts were not restored")
+        self.assertTrue((self.table.next_hop == loaded.next_hop).all(), "Next hops were not restored")
+        service = StaticRouteService(self.routes)
+        service.precompute(loaded)
+        self.assertEqual(4, len(service.trip(self.stops[0][1], self.stops[21][1])), "Loaded table produced the wrong trip")
+
+    def test_load_corrupt(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "table.npz")
+            self.table.save(path)
+            with open(path, "r+b") as table_file:
+                table_file.truncate(os.path.getsize(path) // 2)
+            self.assertRaises(route_service.RouteServiceException, route_service.TransferTable.load, path)
+            with open(path, "wb") as table_file:
+                table_file.write(b"not a table")
+            self.assertRaises(route_service.RouteServiceException, route_service.TransferTable.load, path)
+
+    def test_mismatched_table(self):
+        service = StaticRouteService(self.routes[:-1])
+        self.assertRaises(route_service.RouteServiceException, service.precompute, self.table)
+
+
 class TestMBTARouteService(unittest.TestCase):
     def setUp(self) -> None:
         self.route_service = route_service.MBTARouteService()
         self.route_path = f"{self.route_service.base_url}{self.route_service.route_path}"
         self.stop_path = f"{self.route_service.base_url}{self.route_service.stop_path}"
 
+    def add_network(self, response: responses.RequestsMock, *routes_and_stops):
+        """
+        Register the route response and one stop response per route for (route, stop response) pairs.
+        """
+        route_response = copy.deepcopy(ROUTE_RESPONSE)
+        route_response["data"].extend(route for route, _ in routes_and_stops)
+        response.add(responses.GET, self.route_path, json=route_response)
+        for route, stop_response in routes_and_stops:
+            response.add(
+                responses.GET, self.stop_path,
+                match=[responses.matchers.query_param_matcher({"filter[route]": route["id"]})],
+                json=stop_response
+            )
+
     def test_routes_no_routes(self):
         with responses.RequestsMock() as response:
             response.add(responses.GET, self.route_path, json=ROUTE_RESPONSE)
@@ -2083,6 +2442,195 @@ class TestMBTARouteService(unittest.TestCase):
             self.assertEqual(expected_route, self.route_service.route(expected_route.id), "Route ID does not index the expected route")
             self.assertEqual(expected_route, self.route_service.route(str(expected_route)), "Route string does not index the expected route")
 
+    def test_views_per_load(self):
+        with responses.RequestsMock() as response:
+            self.add_network(response, (RED_ROUTE, RED_STOP_RESPONSE))
+            routes, stops = self.route_service.routes, self.route_service.stops
+            self.assertIs(routes, self.route_service.routes, "Routes are rebuilt on every call")
+            self.assertIs(stops, self.route_service.stops, "Stops are rebuilt on every call")
+            self.assertIsInstance(routes, frozenset, "Routes can be modified")
+            self.route_service.load(use_cache=False)
+            self.assertIsNot(routes, self.route_service.routes, "Reloading kept the old routes")
+            self.assertEqual(routes, self.route_service.routes, "Reloading changed the routes")
+
+    def test_refresh(self):
+        with responses.RequestsMock() as response:
+            self.add_network(response, (RED_ROUTE, RED_STOP_RESPONSE), (GREEN_B_ROUTE, GREEN_B_STOP_RESPONSE), (MATTAPAN_ROUTE, MATTAPAN_STOP_RESPONSE))
+            red = self.route_service.route("Red")
+        green_b = copy.deepcopy(GREEN_B_ROUTE)
+        green_b["attributes"]["long_name"] = "Green Line B Branch"
+        green_b_stops = copy.deepcopy(GREEN_B_STOP_RESPONSE)
+        green_b_stops["data"] = green_b_stops["data"][:3] + [dict(green_b_stops["data"][3], id="place-new")]
+        with responses.RequestsMock() as response:
+            route_response = copy.deepcopy(ROUTE_RESPONSE)
+            route_response["data"].extend([RED_ROUTE, green_b])
+            response.add(responses.GET, self.route_path, json=route_response)
+            response.add(
+                responses.GET, self.stop_path, json=green_b_stops,
+                match=[responses.matchers.query_param_matcher({"filter[route]": "Green-B"})]
+            )
+            changes = self.route_service.refresh()
+        self.assertListEqual([], changes.added, "No route was added")
+        self.assertListEqual(["Green-B"], changes.changed, "Changed route was not found")
+        self.assertListEqual(["Mattapan"], changes.removed, "Removed route was not found")
+        expected_removed = (
+            set(stop["id"] for stop in GREEN_B_STOP_RESPONSE["data"][3:] + MATTAPAN_STOP_RESPONSE["data"])
+            - set(stop["id"] for stop in RED_STOP_RESPONSE["data"])
+        )
+        self.assertSetEqual(expected_removed, set(changes.removed_stops), "Stops without routes were not removed")
+        self.assertEqual("Green Line B Branch", str(self.route_service.route("Green-B")), "Changed route was not updated")
+        self.assertIsNone(self.route_service.stop("place-matt"), "Removed route's stop was kept")
+        self.assertEqual(1, len(self.route_service.stop("place-asmnl").routes), "Stop kept a removed route")
+        self.assertEqual(len(RED_STOP_RESPONSE["data"]), len(self.route_service.route("Red").stops), "Unchanged route lost stops")
+        self.assertEqual(len(RED_STOP_RESPONSE["data"]), len(red.stops), "Routes handed out were changed")
+        self.assertIn(MATTAPAN_ROUTE["id"], set(red._network.route_ids), "Old network was changed")
+        trip = self.route_service.trip(self.route_service.stop("Ashmont"), self.route_service.stop("place-new"))
+        self.assertListEqual(["Red", "Green-B"], [route.id for route in trip], "Refreshed network trip is wrong")
+
+    def test_refresh_added(self):
+        with responses.RequestsMock() as response:
+            response.add(responses.GET, self.route_path, json=ROUTE_RESPONSE)
+            self.assertEqual(0, len(self.route_service.refresh().added), "Refresh did not load the network")
+        with responses.RequestsMock() as response:
+            self.add_network(response, (MATTAPAN_ROUTE, MATTAPAN_STOP_RESPONSE))
+            changes = self.route_service.refresh()
+        self.assertListEqual(["Mattapan"], changes.added, "Added route was not found")
+        self.assertEqual(len(MATTAPAN_STOP_RESPONSE["data"]), len(self.route_service.stops), "Added route's stops were not loaded")
+
+    def test_refresh_not_modified(self):
+        route_response = copy.deepcopy(ROUTE_RESPONSE)
+        route_response["data"].append(RED_ROUTE)
+        with responses.RequestsMock() as response:
+            response.add(responses.GET, self.route_path, json=route_response, headers={"ETag": '"routes-1"'})
+            response.add(responses.GET, self.stop_path, json=RED_STOP_RESPONSE)
+            network = self.route_service.network
+        with responses.RequestsMock() as response:
+            response.add(
+                responses.GET, self.route_path, status=304, match=[responses.matchers.header_matcher({"If-None-Match": '"routes-1"'})]
+            )
+            changes = self.route_service.refresh()
+        self.assertFalse(changes, "Unmodified routes changed the network")
+        self.assertIs(network, self.route_service.network, "Unmodified routes replaced the network")
+
+    def alternating_network(self, response: responses.RequestsMock):
+        """
+        Register a route list that alternates between two versions of the network on every request: Red and Green-B,
+        then Red, a renamed Green-B serving fewer stops and Mattapan.
+        """
+        green_b = copy.deepcopy(GREEN_B_ROUTE)
+        green_b["attributes"]["long_name"] = "Green Line B Branch"
+        green_b_stops = copy.deepcopy(GREEN_B_STOP_RESPONSE)
+        green_b_stops["data"] = green_b_stops["data"][:5]
+        versions = [
+            ([RED_ROUTE, GREEN_B_ROUTE], {"Red": RED_STOP_RESPONSE, "Green-B": GREEN_B_STOP_RESPONSE}),
+            ([RED_ROUTE, green_b, MATTAPAN_ROUTE], {"Red": RED_STOP_RESPONSE, "Green-B": green_b_stops, "Mattapan": MATTAPAN_STOP_RESPONSE}),
+        ]
+        requests = itertools.count()
+        current = [versions[0]]
+
+        def routes(_request):
+            current[0] = versions[next(requests) % 2]
+            return 200, {}, json.dumps(dict(ROUTE_RESPONSE, data=current[0][0]))
+
+        def stops(request):
+            query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(request.url).query))
+            return 200, {}, json.dumps(current[0][1][query["filter[route]"]])
+
+        response.add_callback(responses.GET, self.route_path, callback=routes)
+        response.add_callback(responses.GET, self.stop_path, callback=stops)
+
+    def test_refresh_concurrent_queries(self):
+        errors, latencies, stopped = [], [], threading.Event()
+
+        def query():
+            while not stopped.is_set():
+                started = time.perf_counter()
+                try:
+                    trip = self.route_service.trip(self.route_service.stop("place-asmnl"), self.route_service.stop("place-armnl"))
+                    if [route.id for route in trip] != ["Red", "Green-B"]:
+                        errors.append(trip)
+                except Exception as e:
+                    errors.append(e)
+                latencies.append(time.perf_counter() - started)
+
+        with responses.RequestsMock() as response:
+            self.alternating_network(response)
+            self.route_service.load()
+            readers = [threading.Thread(target=query) for _ in range(4)]
+            for reader in readers:
+                reader.start()
+            try:
+                for _ in range(20):
+                    self.assertTrue(self.route_service.refresh(), "Refresh did not change the network")
+            finally:
+                stopped.set()
+                for reader in readers:
+                    reader.join(10)
+        self.assertListEqual([], errors[:5], "Queries failed during refreshes")
+        latencies.sort()
+        self.assertLess(latencies[int(len(latencies) * 0.99)], 0.1, "Queries were blocked by refreshes")
+
+    def test_refresh_in_flight(self):
+        with responses.RequestsMock() as response:
+            self.alternating_network(response)
+            here, there = self.route_service.stop("Ashmont"), self.route_service.stop("Boylston")
+            self.route_service.refresh()
+            new_here, new_there = self.route_service.stop("Ashmont"), self.route_service.stop("Boylston")
+        self.assertIsNot(here._network, new_here._network, "Refresh did not replace the network")
+        trip = self.route_service.trip(here, there)
+        self.assertEqual("Green Line B", str(trip[-1]), "Stops of the old network were not planned on it")
+        self.assertIs(here._network, trip[-1]._network, "Stops of the old network were not planned on it")
+        trip = self.route_service.trip(here, new_there)
+        self.assertEqual("Green Line B Branch", str(trip[-1]), "Stops of different networks were not planned on the current one")
+        self.assertListEqual(
+            ["Red", "Green-B"], [route.id for route in self.route_service.trip(route_service.Stop("place-asmnl"), new_there)],
+            "Stop outside the network was not planned on the current one"
+        )
+
+    def test_refresh_precomputed(self):
+        with responses.RequestsMock() as response:
+            self.alternating_network(response)
+            self.route_service.precompute()
+            self.route_service.refresh()
+            table, routes = self.route_service._transfer_lookup
+        self.assertIn("Mattapan", table.route_ids, "Transfer table was not rebuilt")
+        self.assertIs(self.route_service.network, routes[0]._network, "Transfer table routes are not of the new network")
+        trip = self.route_service.trip(self.route_service.stop("Mattapan"), self.route_service.stop("Arlington"))
+        self.assertListEqual(["Mattapan", "Red", "Green-B"], [route.id for route in trip], "Expected trip was not produced!")
+
+    def test_refresher(self):
+        with responses.RequestsMock() as response:
+            self.alternating_network(response)
+            self.route_service.load()
+            with route_service.NetworkRefresher(self.route_service, interval=0.01, reload_interval=0.05) as refresher:
+                deadline = time.monotonic() + 10
+                while refresher.refreshes < 8 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+            refreshes = refresher.refreshes
+        self.assertGreaterEqual(refreshes, 8, "Network was not refreshed in the background")
+        self.assertIsNone(refresher.error, "Background refresh failed")
+        time.sleep(0.05)
+        self.assertEqual(refreshes, refresher.refreshes, "Refresher did not stop")
+
+    def test_refresher_connection_lost(self):
+        routes_and_stops = ((RED_ROUTE, RED_STOP_RESPONSE), (GREEN_B_ROUTE, GREEN_B_STOP_RESPONSE))
+        with fake_mbta_server(routes_and_stops) as server:
+            self.route_service.base_url = server.base_url
+            self.route_service.backoff_factor = 0
+            self.route_service.load()
+            server.drop_connections = True
+            with route_service.NetworkRefresher(self.route_service, interval=0.01) as refresher:
+                deadline = time.monotonic() + 10
+                while refresher.refreshes < 2 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                self.assertGreaterEqual(refresher.refreshes, 2, "Refresher stopped after losing its connection")
+                self.assertIsInstance(refresher.error, route_service.RouteServiceHttpException, "Lost connection was not reported")
+                server.drop_connections = False
+                while refresher.error is not None and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                self.assertIsNone(refresher.error, "Refresher did not recover")
+        self.assertGreater(server.stats["dropped"], 0, "No connection was dropped")
+
     def test_route_not_exists(self):
         unexpected_route = route_service.MBTARoute(RED_ROUTE)
         with responses.RequestsMock() as response:
@@ -2185,6 +2733,240 @@ class TestMBTARouteService(unittest.TestCase):
             trip = self.route_service.trip(starting_stop, destination_stop)
             self.assertListEqual([], trip, "Trip exists")
 
+    def test_transfers(self):
+        trip_response = copy.deepcopy(ROUTE_RESPONSE)
+
+        trip_response["data"].append(RED_ROUTE)
+        trip_response["data"].append(GREEN_B_ROUTE)
+        trip_response["data"].append(MATTAPAN_ROUTE)
+        with responses.RequestsMock() as response:
+            response.add(responses.GET, self.route_path, json=trip_response)
+            response.add(
+                responses.GET, self.stop_path,
+                match=[responses.matchers.query_param_matcher({"filter[route]": RED_ROUTE["id"]})],
+                json=RED_STOP_RESPONSE
+            )
+            response.add(
+                responses.GET, self.stop_path,
+                match=[responses.matchers.query_param_matcher({"filter[route]": GREEN_B_ROUTE["id"]})],
+                json=GREEN_B_STOP_RESPONSE
+            )
+            response.add(
+                responses.GET, self.stop_path,
+                match=[responses.matchers.query_param_matcher({"filter[route]": MATTAPAN_ROUTE["id"]})],
+                json=MATTAPAN_STOP_RESPONSE
+            )
+            red_route = self.route_service.route("Red Line")
+            green_b_route = self.route_service.route("Green Line B")
+            mattapan_route = self.route_service.route("Mattapan Trolley")
+            red_transfers = self.route_service.transfers(red_route)
+            self.assertSetEqual({green_b_route, mattapan_route}, set(red_transfers), "Unexpected transfers from the Red Line")
+            self.assertSetEqual({self.route_service.stop("Park Street")}, red_transfers[green_b_route], "Unexpected Red/Green transfer stops")
+            self.assertSetEqual({self.route_service.stop("Ashmont")}, red_transfers[mattapan_route], "Unexpected Red/Mattapan transfer stops")
+            self.assertSetEqual({red_route}, set(self.route_service.transfers(green_b_route)), "Unexpected transfers from the Green Line B")
+            self.assertSetEqual(
+                {self.route_service.stop("Park Street"), self.route_service.stop("Ashmont")}, self.route_service.connecting_stops,
+                "Unexpected connecting stops"
+            )
+
+    def test_trip_precomputed(self):
+        trip_response = copy.deepcopy(ROUTE_RESPONSE)
+
+        trip_response["data"].append(RED_ROUTE)
+        trip_response["data"].append(GREEN_B_ROUTE)
+        trip_response["data"].append(MATTAPAN_ROUTE)
+        red_route = route_service.MBTARoute(RED_ROUTE)
+        green_b_route = route_service.MBTARoute(GREEN_B_ROUTE)
+        with responses.RequestsMock() as response:
+            response.add(responses.GET, self.route_path, json=trip_response)
+            response.add(
+                responses.GET, self.stop_path,
+                match=[responses.matchers.query_param_matcher({"filter[route]": RED_ROUTE["id"]})],
+                json=RED_STOP_RESPONSE
+            )
+            response.add(
+                responses.GET, self.stop_path,
+                match=[responses.matchers.query_param_matcher({"filter[route]": GREEN_B_ROUTE["id"]})],
+                json=GREEN_B_STOP_RESPONSE
+            )
+            response.add(
+                responses.GET, self.stop_path,
+                match=[responses.matchers.query_param_matcher({"filter[route]": MATTAPAN_ROUTE["id"]})],
+                json=MATTAPAN_STOP_RESPONSE
+            )
+            self.route_service.precompute()
+            trip = self.route_service.trip(self.route_service.stop("Mattapan"), self.route_service.stop("Arlington"))
+            self.assertListEqual([route_service.MBTARoute(MATTAPAN_ROUTE), red_route, green_b_route], trip, "Expected trip was not produced!")
+
+    def test_concurrent_stops_deterministic(self):
+        networks = []
+        for workers in (1, 4):
+            service = route_service.MBTARouteService(workers=workers)
+            with responses.RequestsMock() as response:
+                self.add_network(
+                    response, (RED_ROUTE, RED_STOP_RESPONSE), (GREEN_B_ROUTE, GREEN_B_STOP_RESPONSE), (MATTAPAN_ROUTE, MATTAPAN_STOP_RESPONSE)
+                )
+                networks.append({route.id: sorted(stop.id for stop in route.stops) for route in service.routes})
+                park_street = service.stop("Park Street")
+                self.assertSetEqual({"Red", "Green-B"}, set(route.id for route in park_street.routes), "Park Street lost a route")
+                for route in park_street.routes:
+                    self.assertTrue(any(stop is park_street for stop in route.stops), f"{route} has a second copy of Park Street")
+        self.assertDictEqual(networks[0], networks[1], "Concurrent loading produced a different network")
+
+    def test_concurrent_stops_retry_429(self):
+        service = route_service.MBTARouteService(workers=4)
+        with responses.RequestsMock() as response:
+            response.add(
+                responses.GET, self.stop_path, status=429, headers={"Retry-After": "0"},
+                match=[responses.matchers.query_param_matcher({"filter[route]": RED_ROUTE["id"]})],
+            )
+            self.add_network(
+                response, (RED_ROUTE, RED_STOP_RESPONSE), (GREEN_B_ROUTE, GREEN_B_STOP_RESPONSE), (MATTAPAN_ROUTE, MATTAPAN_STOP_RESPONSE)
+            )
+            trip = service.trip(service.stop("Ashmont"), service.stop("Arlington"))
+            self.assertListEqual([service.route("Red Line"), service.route("Green Line B")], trip, "Expected trip was not produced!")
+
+    def test_concurrent_stops_status_400(self):
+        service = route_service.MBTARouteService(workers=4)
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as response:
+            response.add(
+                responses.GET, self.stop_path, status=400,
+                match=[responses.matchers.query_param_matcher({"filter[route]": GREEN_B_ROUTE["id"]})],
+            )
+            self.add_network(response, (RED_ROUTE, RED_STOP_RESPONSE), (MATTAPAN_ROUTE, MATTAPAN_STOP_RESPONSE))
+            route_response = copy.deepcopy(ROUTE_RESPONSE)
+            route_response["data"].extend([RED_ROUTE, GREEN_B_ROUTE, MATTAPAN_ROUTE])
+            response.replace(responses.GET, self.route_path, json=route_response)
+            self.assertRaises(route_service.RouteServiceHttpException, service.route, "X")
+
+    def bulk_stop_response(self, *routes_and_stops):
+        """
+        A compound stop response for several routes, each stop related to the route it was listed for.
+        """
+        bulk_response = {"data": [], "included": [], "jsonapi": {"version": "1.0"}}
+        for route, stop_response in routes_and_stops:
+            bulk_response["included"].append(route)
+            for stop in copy.deepcopy(stop_response["data"]):
+                stop["relationships"]["route"] = {"data": {"id": route["id"], "type": "route"}}
+                bulk_response["data"].append(stop)
+        return bulk_response
+
+    def test_bulk_stops(self):
+        service = route_service.MBTARouteService(bulk=10)
+        routes_and_stops = ((RED_ROUTE, RED_STOP_RESPONSE), (GREEN_B_ROUTE, GREEN_B_STOP_RESPONSE), (MATTAPAN_ROUTE, MATTAPAN_STOP_RESPONSE))
+        route_response = copy.deepcopy(ROUTE_RESPONSE)
+        route_response["data"].extend([RED_ROUTE, GREEN_B_ROUTE, MATTAPAN_ROUTE])
+        with responses.RequestsMock() as response:
+            response.add(responses.GET, self.route_path, json=route_response)
+            response.add(
+                responses.GET, self.stop_path,
+                match=[responses.matchers.query_param_matcher({"filter[route]": "Red,Green-B,Mattapan", "include": "route", "fields[route]": "type"})],
+                json=self.bulk_stop_response(*routes_and_stops)
+            )
+            with unittest.mock.patch.object(service, "_stop", wraps=service._stop) as parse:
+                trip = service.trip(service.stop("Ashmont"), service.stop("Arlington"))
+            self.assertEqual(2, len(response.calls), "Expected a single request for all stops")
+        unique_stops = set(stop["id"] for _, stop_response in routes_and_stops for stop in stop_response["data"])
+        self.assertEqual(len(unique_stops), parse.call_count, "Expected stops repeated for each of their routes to be parsed once")
+        self.assertListEqual([service.route("Red Line"), service.route("Green Line B")], trip, "Expected trip was not produced!")
+        for route, stop_response in routes_and_stops:
+            expected_stops = set(stop["id"] for stop in stop_response["data"])
+            actual_stops = set(stop.id for stop in service.route(route["attributes"]["long_name"]).stops)
+            self.assertSetEqual(expected_stops, actual_stops, f"Unexpected stops for {route['id']}")
+
+    def test_bulk_stops_fallback(self):
+        service = route_service.MBTARouteService(bulk=2, workers=1)
+        with responses.RequestsMock() as response:
+            response.add(
+                responses.GET, self.stop_path, status=400,
+                match=[responses.matchers.query_param_matcher({"filter[route]": "Red,Green-B", "include": "route", "fields[route]": "type"})],
+            )
+            response.add(
+                responses.GET, self.stop_path,
+                match=[responses.matchers.query_param_matcher({"filter[route]": "Mattapan", "include": "route", "fields[route]": "type"})],
+                json=self.bulk_stop_response((MATTAPAN_ROUTE, MATTAPAN_STOP_RESPONSE))
+            )
+            self.add_network(response, (RED_ROUTE, RED_STOP_RESPONSE), (GREEN_B_ROUTE, GREEN_B_STOP_RESPONSE))
+            route_response = copy.deepcopy(ROUTE_RESPONSE)
+            route_response["data"].extend([RED_ROUTE, GREEN_B_ROUTE, MATTAPAN_ROUTE])
+            response.replace(responses.GET, self.route_path, json=route_response)
+            trip = service.trip(service.stop("Mattapan"), service.stop("Arlington"))
+            self.assertEqual(5, len(response.calls), "Expected two bulk requests and a request per route of the failed batch")
+        self.assertListEqual(
+            [service.route("Mattapan Trolley"), service.route("Red Line"), service.route("Green Line B")], trip, "Expected trip was not produced!"
+        )
+
+    def lean_response(self, response, fields):
+        lean = copy.deepcopy(response)
+        for resource in lean["data"]:
+            resource["attributes"] = {field: resource["attributes"][field] for field in fields}
+            del resource["relationships"], resource["links"]
+        return lean
+
+    def test_lean(self):
+        service = route_service.MBTARouteService(lean=True, workers=1)
+        route_response = copy.deepcopy(ROUTE_RESPONSE)
+        route_response["data"].extend([RED_ROUTE, MATTAPAN_ROUTE])
+        with responses.RequestsMock() as response:
+            response.add(
+                responses.GET, self.route_path, json=self.lean_response(route_response, ["long_name"]),
+                match=[responses.matchers.query_param_matcher({"filter[type]": "", "fields[route]": "long_name"})]
+            )
+            for route, stop_response in ((RED_ROUTE, RED_STOP_RESPONSE), (MATTAPAN_ROUTE, MATTAPAN_STOP_RESPONSE)):
+                response.add(
+                    responses.GET, self.stop_path, json=self.lean_response(stop_response, ["name"]),
+                    match=[responses.matchers.query_param_matcher({"filter[route]": route["id"], "fields[stop]": "name"})]
+                )
+            trip = service.trip(service.stop("Mattapan"), service.stop("Alewife"))
+            self.assertListEqual([service.route("Mattapan Trolley"), service.route("Red Line")], trip, "Expected trip was not produced!")
+            self.assertEqual(3, len(response.calls), "Lean loading made unexpected requests")
+
+            ashmont = service.stop("Ashmont")
+            self.assertTrue(ashmont.lean, "Stop was not loaded lean")
+            stop_ids = set(stop.id for stop in service.stops)
+            stop_details = copy.deepcopy(RED_STOP_RESPONSE)
+            stop_details["data"].extend(s for s in MATTAPAN_STOP_RESPONSE["data"] if s["id"] not in set(r["id"] for r in RED_STOP_RESPONSE["data"]))
+            response.add(responses.GET, self.stop_path, json=stop_details)
+            expected = next(s for s in RED_STOP_RESPONSE["data"] if s["id"] == ashmont.id)
+            self.assertEqual(expected["attributes"]["latitude"], ashmont.latitude, "Lazy attribute has the wrong value")
+            query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(response.calls[-1].request.url).query))
+            self.assertEqual(ashmont.id, query["filter[id]"].split(",")[0], "Details were not requested for the accessed stop first")
+            self.assertSetEqual(stop_ids, set(query["filter[id]"].split(",")), "Details were not requested in bulk")
+            self.assertEqual(expected["links"], ashmont.links, "Lazy member has the wrong value")
+            self.assertFalse(ashmont.lean, "Stop is still lean after loading its details")
+            self.assertFalse(any(stop.lean for stop in service.stops), "Details were not loaded in bulk")
+            self.assertEqual(4, len(response.calls), "Details were not loaded in bulk")
+            mattapan = service.stop("Mattapan")
+            expected = next(s for s in MATTAPAN_STOP_RESPONSE["data"] if s["id"] == mattapan.id)
+            self.assertEqual(expected["attributes"]["address"], mattapan.address, "Lazy attribute has the wrong value")
+            self.assertEqual(4, len(response.calls), "Details were requested twice")
+            response.add(responses.GET, self.route_path, json=route_response)
+            self.assertEqual(RED_ROUTE["attributes"]["color"], service.route("Red").color, "Lazy attribute has the wrong value")
+
+        renamed = copy.deepcopy(route_response)
+        renamed["data"][1]["attributes"]["long_name"] = "Mattapan Line"
+        with responses.RequestsMock() as response:
+            response.add(responses.GET, self.route_path, json=self.lean_response(renamed, ["long_name"]))
+            response.add(
+                responses.GET, self.stop_path, json=self.lean_response(MATTAPAN_STOP_RESPONSE, ["name"]),
+                match=[responses.matchers.query_param_matcher({"filter[route]": "Mattapan", "fields[stop]": "name"})]
+            )
+            changes = service.refresh()
+        self.assertListEqual(["Mattapan"], changes.changed, "Loaded details were taken for a change")
+        self.assertFalse(service.stop("Alewife").lean, "Kept stop lost its details")
+        self.assertEqual(RED_STOP_RESPONSE["data"][0]["attributes"]["address"], service.stop("Alewife").address, "Kept stop lost its details")
+
+    def test_lean_bulk(self):
+        routes_and_stops = ((RED_ROUTE, RED_STOP_RESPONSE), (GREEN_B_ROUTE, GREEN_B_STOP_RESPONSE), (MATTAPAN_ROUTE, MATTAPAN_STOP_RESPONSE))
+        with fake_mbta_server(routes_and_stops) as server:
+            service = route_service.MBTARouteService(lean=True, bulk=10, workers=1)
+            service.base_url = server.base_url
+            trip = service.trip(service.stop("Mattapan"), service.stop("Alewife"))
+            self.assertListEqual([service.route("Mattapan Trolley"), service.route("Red Line")], trip, "Expected trip was not produced!")
+            self.assertTrue(service.stop("Ashmont").lean, "Stop was not loaded lean")
+            service.close()
+        self.assertEqual(2, server.stats["requests"], "Lean stops were not loaded with one bulk request")
+
     def test_routes_status_400(self):
         with responses.RequestsMock() as response:
             response.add(responses.GET, self.route_path, status=400)
@@ -2237,3 +3019,776 @@ class TestMBTARouteService(unittest.TestCase):
             response.add(responses.GET, self.stop_path, json={})
             self.assertRaises(route_service.RouteServiceJsonException, self.route_service.route, "X")
 
+
+def fake_mbta_server(routes_and_stops, throttled=()):
+    """
+    A fake_mbta.FakeMBTAServer serving the route and stop fixtures. Routes listed in throttled answer their first stop
+    request with a 429.
+    """
+    server = fake_mbta.FakeMBTAServer([route for route, _ in routes_and_stops], [stops["data"] for _, stops in routes_and_stops])
+    server.throttled.update(throttled)
+    return server
+
+
+def on_route(stop, route_id):
+    """
+    The stop resource as streamed for its route, with the route relationship the API includes.
+    """
+    stop = copy.deepcopy(stop)
+    stop["relationships"]["route"] = {"data": {"id": route_id, "type": "route"}}
+    return stop
+
+
+class TestEventStream(unittest.TestCase):
+    def test_events(self):
+        document = b": keep-alive\r\nretry: 2500\r\nevent: reset\r\ndata: [1,\r\ndata: 2]\r\n\r\nid: 7\ndata:{\"id\": \"\xc3\xa9\"}\n\n"
+        for size in (1, 3, len(document)):
+            stream = route_service.EventStream(document[i:i + size] for i in range(0, len(document), size))
+            self.assertListEqual([("reset", "[1,\n2]"), ("message", '{"id": "\u00e9"}')], list(stream), f"Events differ in chunks of {size}")
+            self.assertEqual(2.5, stream.retry, "Retry was not read")
+            self.assertEqual("7", stream.last_id, "Event id was not read")
+
+    def test_incomplete(self):
+        self.assertListEqual([], list(route_service.EventStream([b"event: add\ndata: {}\n"])), "Unfinished event was dispatched")
+
+
+class TestNetworkSubscription(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = fake_mbta_server(((RED_ROUTE, RED_STOP_RESPONSE), (GREEN_B_ROUTE, GREEN_B_STOP_RESPONSE))).start()
+        self.route_service = route_service.MBTARouteService(workers=1)
+        self.route_service.base_url = self.server.base_url
+        self.subscription = None
+
+    def tearDown(self) -> None:
+        if self.subscription is not None:
+            self.subscription.stop(10)
+        self.server.stop()
+
+    def wait(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise AssertionError("Timed out waiting for the stream")
+            time.sleep(0.01)
+
+    def serve(self, routes_and_stops):
+        """
+        Serve routes_and_stops from now on, as (route, stop resources) pairs.
+        """
+        self.server.update([route for route, _ in routes_and_stops], [stops for _, stops in routes_and_stops])
+
+    def served(self):
+        return [(route, self.server.route_stops[route["id"]]) for route in self.server.routes]
+
+    def subscribe(self):
+        self.subscription = route_service.NetworkSubscription(self.route_service)
+        self.subscription.backoff = 0.05
+        self.subscription.batch_interval = 0.01
+        self.subscription.start()
+        self.wait(lambda: self.subscription.events >= 2 and len(self.server.streams["/stops"]) == 1)
+        return self.subscription
+
+    def applied(self, condition):
+        self.wait(lambda: condition(self.route_service))
+
+    def test_updates(self):
+        table = self.route_service.precompute()
+        subscription = self.subscribe()
+        self.assertFalse(subscription.changes, "Resets of an unchanged network changed it")
+        arlington = copy.deepcopy(next(s for s in GREEN_B_STOP_RESPONSE["data"] if s["id"] == "place-armnl"))
+        arlington["attributes"]["name"] = "Arlington Street"
+        self.server.send("/stops", "update", on_route(arlington, "Green-B"))
+        self.applied(lambda service: service.stop("place-armnl").name == "Arlington Street")
+        self.assertIs(table, self.route_service._transfer_lookup[0], "Transfer table was rebuilt for a renamed stop")
+
+        self.serve(self.served() + [(MATTAPAN_ROUTE, MATTAPAN_STOP_RESPONSE["data"])])
+        self.server.send("/routes", "add", MATTAPAN_ROUTE)
+        self.applied(lambda service: service.route("Mattapan") is not None)
+        trip = self.route_service.trip(self.route_service.stop("Mattapan"), self.route_service.stop("Arlington Street"))
+        self.assertListEqual(["Mattapan", "Red", "Green-B"], [route.id for route in trip], "Added route is not connected")
+        self.assertIsNot(table, self.route_service._transfer_lookup[0], "Transfer table was not rebuilt for an added route")
+        self.wait(lambda: any("Mattapan" in query["filter[route]"].split(",") for query in list(self.server.streams["/stops"].values())))
+
+        self.server.send("/stops", "remove", {"id": "place-matt", "type": "stop"})
+        self.applied(lambda service: service.stop("place-matt") is None)
+        self.assertEqual(len(MATTAPAN_STOP_RESPONSE["data"]) - 1, len(self.route_service.route("Mattapan").stops), "Stop was not removed")
+        self.server.send("/routes", "remove", {"id": "Green-B", "type": "route"})
+        self.applied(lambda service: service.route("Green-B") is None)
+        self.assertIsNone(self.route_service.stop("place-lake"), "Stop of the removed route was kept")
+        self.assertIsNotNone(self.route_service.stop("place-pktrm"), "Stop of another route was removed")
+        self.assertIsNone(subscription.error, "Restarting the stop stream was reported as a failure")
+
+    def test_stop_leaves_route(self):
+        self.subscribe()
+        park_street = next(s for s in GREEN_B_STOP_RESPONSE["data"] if s["id"] == "place-pktrm")
+        self.server.send("/stops", "update", dict(on_route(park_street, "Red"), relationships={"route": {"data": [{"id": "Red", "type": "route"}]}}))
+        self.applied(lambda service: "place-pktrm" not in set(stop.id for stop in service.route("Green-B").stops))
+        self.assertIn("place-pktrm", set(stop.id for stop in self.route_service.route("Red").stops), "Stop left the route it names")
+
+        self.server.send("/stops", "update", on_route(park_street, "Green-B"))
+        self.applied(lambda service: "place-pktrm" in set(stop.id for stop in service.route("Green-B").stops))
+        self.assertIn("place-pktrm", set(stop.id for stop in self.route_service.route("Red").stops), "Stop left a route it was not sent for")
+
+        self.serve([(route, [stop for stop in stops if (stop["id"], route["id"]) != ("place-pktrm", "Green-B")]) for route, stops in self.served()])
+        self.server.disconnect("/stops")
+        self.applied(lambda service: "place-pktrm" not in set(stop.id for stop in service.route("Green-B").stops))
+        self.assertIn("place-pktrm", set(stop.id for stop in self.route_service.route("Red").stops), "Reset removed the stop from its other route")
+
+    def test_reconnect(self):
+        subscription = self.subscribe()
+        connections = subscription.connections
+        self.serve(self.served()[:1])
+        self.server.disconnect("/routes")
+        self.applied(lambda service: service.route("Green-B") is None)
+        self.assertGreater(subscription.connections, connections, "Stream was not reconnected")
+        self.assertIsNotNone(self.route_service.stop("place-harsq"), "Reset removed the wrong stops")
+
+    def test_stop(self):
+        subscription = route_service.NetworkSubscription(self.route_service)
+        subscription.stop()
+        subscription.start()
+        subscription.stop(10)
+        subscription.stop(10)
+        self.assertIsNone(subscription.error, "Stopping the subscription failed")
+
+    def test_backoff(self):
+        self.server.stream_failures["/routes"] = 3
+        delays = []
+        backoff = route_service.NetworkSubscription._backoff
+        with unittest.mock.patch.object(route_service.NetworkSubscription, "_backoff", lambda *args: delays.append(backoff(*args)) or delays[-1]):
+            subscription = self.subscribe()
+        self.assertEqual(3, self.server.stats["503"], "Failed stream was not retried")
+        self.assertListEqual([0.05, 0.1, 0.2], delays, "Retries did not back off")
+        self.assertIsInstance(subscription.error, route_service.RouteServiceHttpException, "Failure was not reported")
+
+
+class TestPhaseTimings(unittest.TestCase):
+    def test_nested(self):
+        timings = route_service.PhaseTimings()
+        # The clock reads as load starts, http starts, http ends and load ends
+        with unittest.mock.patch("time.perf_counter", side_effect=[10.0, 10.02, 10.05, 10.06]):
+            with timings.phase("load"):
+                with timings.phase("http"):
+                    pass
+        stats = timings.stats()
+        self.assertListEqual(["load", "http"], list(stats), "Phases are not in order")
+        self.assertAlmostEqual(0.03, stats["http"]["seconds"], places=9, msg="Nested phase was not timed")
+        self.assertAlmostEqual(0.03, stats["load"]["seconds"], places=9, msg="Nested phase was counted in the outer phase")
+        self.assertAlmostEqual(0.06, stats["load"]["inclusive_seconds"], places=9, msg="Inclusive time left out the nested phase")
+        self.assertAlmostEqual(
+            stats["load"]["inclusive_seconds"], stats["load"]["seconds"] + stats["http"]["seconds"], places=9,
+            msg="Phases do not add up to the outer phase"
+        )
+        timings.reset()
+        self.assertDictEqual({}, timings.stats(), "Timings were not reset")
+
+    def test_iterate(self):
+        timings = route_service.PhaseTimings()
+        self.assertListEqual([0, 1, 2], list(timings.iterate("decode", range(3))), "Items were changed")
+        self.assertEqual(4, timings.stats()["decode"]["calls"], "Expected a call per item and one for the end")
+
+    def test_threads(self):
+        timings = route_service.PhaseTimings()
+
+        def work():
+            with timings.phase("http"):
+                time.sleep(0.02)
+
+        with timings.phase("load"):
+            worker = threading.Thread(target=work)
+            worker.start()
+            worker.join()
+        stats = timings.stats()
+        self.assertEqual(1, stats["http"]["calls"], "Worker phase was not timed")
+        self.assertGreaterEqual(stats["load"]["seconds"], 0.02, "Phase of another thread was nested")
+
+    def test_service(self):
+        timings = route_service.PhaseTimings()
+        with fake_mbta_server(((RED_ROUTE, RED_STOP_RESPONSE), (GREEN_B_ROUTE, GREEN_B_STOP_RESPONSE)), throttled={"Red"}) as server:
+            service = route_service.MBTARouteService(workers=2, timings=timings)
+            service.base_url = server.base_url
+            service.load()
+        for phase in ("load", "http", "backoff", "decode", "construct", "assemble"):
+            self.assertIn(phase, timings.stats(), f"{phase} was not timed")
+        self.assertNotIn("plan", timings.stats(), "Loading planned a trip")
+        ashmont, arlington = service.stop("Ashmont"), service.stop("Arlington")
+        service.trip(ashmont, arlington)
+        self.assertEqual(1, timings.stats()["plan"]["calls"], "Trip was not timed")
+        self.assertEqual(2, len(list(service.trips([(ashmont, arlington), (arlington, ashmont)]))), "Wrong number of trips")
+        self.assertEqual(4, timings.stats()["plan"]["calls"], "Trips were not timed")
+        table = str(timings)
+        for phase in timings.stats():
+            self.assertIn(phase, table, f"{phase} is missing from the summary")
+
+    def test_disabled(self):
+        service = route_service.MBTARouteService()
+        self.assertIsNone(service.timings, "Timings are enabled by default")
+        with responses.RequestsMock() as response:
+            route_response = copy.deepcopy(ROUTE_RESPONSE)
+            route_response["data"].append(RED_ROUTE)
+            response.add(responses.GET, f"{service.base_url}{service.route_path}", json=route_response)
+            response.add(responses.GET, f"{service.base_url}{service.stop_path}", json=RED_STOP_RESPONSE)
+            self.assertEqual(1, len(service.routes), "Untimed service did not load")
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def test_render(self):
+        metrics = route_service.MetricsRegistry()
+        requests = metrics.counter("requests_total", "Requests\nmade", ("endpoint",))
+        requests.inc(endpoint="/stops")
+        requests.inc(2, endpoint='/a"b\\')
+        metrics.counter("plain_total", "Plain").inc()
+        latency = metrics.histogram("latency_seconds", "Latency", ("op",), (0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 5.0):
+            latency.observe(value, op="trip")
+        self.assertIs(requests, metrics.counter("requests_total", "Requests", ("endpoint",)), "Metric was registered twice")
+        self.assertEqual(4, latency.count(op="trip"), "Wrong count")
+        self.assertAlmostEqual(5.65, latency.sum(op="trip"), msg="Wrong sum")
+        self.assertEqual(2, requests.value(endpoint='/a"b\\'), "Wrong value")
+        self.assertEqual(
+            "# HELP latency_seconds Latency\n"
+            "# TYPE latency_seconds histogram\n"
+            'latency_seconds_bucket{op="trip",le="0.1"} 2\n'
+            'latency_seconds_bucket{op="trip",le="1.0"} 3\n'
+            'latency_seconds_bucket{op="trip",le="+Inf"} 4\n'
+            'latency_seconds_sum{op="trip"} 5.65\n'
+            'latency_seconds_count{op="trip"} 4\n'
+            "# HELP plain_total Plain\n"
+            "# TYPE plain_total counter\n"
+            "plain_total 1\n"
+            "# HELP requests_total Requests\\nmade\n"
+            "# TYPE requests_total counter\n"
+            'requests_total{endpoint="/a\\"b\\\\"} 2\n'
+            'requests_total{endpoint="/stops"} 1\n',
+            metrics.render(), "Wrong Prometheus text"
+        )
+
+    def test_conflict(self):
+        metrics = route_service.MetricsRegistry()
+        metrics.counter("requests_total", "Requests", ("endpoint",))
+        with self.assertRaises(ValueError):
+            metrics.histogram("requests_total", "Requests", ("endpoint",))
+        with self.assertRaises(ValueError):
+            metrics.counter("requests_total", "Requests", ("status",))
+
+    def test_write(self):
+        metrics = route_service.MetricsRegistry()
+        metrics.counter("plain_total", "Plain").inc()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "routes.prom")
+            metrics.write(path)
+            with open(path) as metrics_file:
+                self.assertEqual(metrics.render(), metrics_file.read(), "Written metrics differ")
+            self.assertListEqual(["routes.prom"], os.listdir(directory), "Temporary file was left behind")
+
+    def test_service(self):
+        metrics = route_service.MetricsRegistry()
+        with fake_mbta_server(((RED_ROUTE, RED_STOP_RESPONSE), (GREEN_B_ROUTE, GREEN_B_STOP_RESPONSE)), throttled={"Red"}) as server:
+            service = route_service.MBTARouteService(workers=2, metrics=metrics)
+            service.base_url = server.base_url
+            service.load()
+        service.trip(service.stop("Ashmont"), service.stop("Arlington"))
+        list(service.trips([(service.stop("Ashmont"), service.stop("Arlington"))]))
+        service.stop("Nowhere")
+        service.route("Red Line")
+        http_duration = metrics.get("route_service_http_request_duration_seconds")
+        self.assertEqual(1, http_duration.count(endpoint="/routes", status=200), "Route request was not recorded")
+        self.assertEqual(2, http_duration.count(endpoint="/stops", status=200), "Stop requests were not recorded")
+        self.assertEqual(1, metrics.get("route_service_http_retries_total").value(endpoint="/stops", reason="429"), "429 was not counted")
+        self.assertGreater(metrics.get("route_service_http_received_bytes_total").value(endpoint="/stops"), 0, "Bytes were not counted")
+        self.assertEqual(2, metrics.get("route_service_trip_duration_seconds").count(), "Trips were not recorded")
+        self.assertEqual(1, metrics.get("route_service_load_duration_seconds").count(kind="load"), "Load was not recorded")
+        lookups = metrics.get("route_service_lookups_total")
+        self.assertEqual(1, lookups.value(kind="stop", result="miss"), "Missed lookup was not counted")
+        self.assertEqual(4, lookups.value(kind="stop", result="hit"), "Lookups were not counted")
+        self.assertEqual(1, lookups.value(kind="route", result="hit"), "Route lookup was not counted")
+
+    def test_retries_exhausted(self):
+        metrics = route_service.MetricsRegistry()
+        with fake_mbta.FakeMBTAServer([RED_ROUTE], [RED_STOP_RESPONSE["data"]], rate_limit=0.5, retry_after=0) as server:
+            service = route_service.MBTARouteService(metrics=metrics)
+            service.base_url = server.base_url
+            service.retries, service.backoff_factor = 2, 0
+            self.assertRaises(route_service.RouteServiceHttpException, service.load)
+        self.assertEqual(3, server.stats["429"], "Expected a request and two retries")
+        self.assertEqual(2, metrics.get("route_service_http_retries_total").value(endpoint="/routes", reason="429"), "The exhausted attempt was counted")
+
+    def test_cache(self):
+        metrics = route_service.MetricsRegistry()
+        with tempfile.TemporaryDirectory() as directory, fake_mbta_server(((RED_ROUTE, RED_STOP_RESPONSE),)) as server:
+            cache = route_service.NetworkCache(directory)
+            for use_cache in (True, True, False):
+                service = route_service.MBTARouteService(cache=cache, metrics=metrics)
+                service.base_url = server.base_url
+                service.load(use_cache)
+            cache.ttl = -1
+            service.load()
+        cache_requests = metrics.get("route_service_cache_requests_total")
+        for result in ("miss", "hit", "bypass", "expired"):
+            self.assertEqual(1, cache_requests.value(result=result), f"Cache {result} was not counted")
+
+
+class TestJSONAPIStream(unittest.TestCase):
+    def chunks(self, document, size):
+        encoded = json.dumps(document, ensure_ascii=False).encode("utf-8") if not isinstance(document, bytes) else document
+        return [encoded[index:index + size] for index in range(0, len(encoded), size)]
+
+    def test_elements(self):
+        document = copy.deepcopy(RED_STOP_RESPONSE)
+        document["data"][0]["attributes"]["name"] = "Ashmont – Étoile"  # multi-byte characters split across chunks
+        document["links"] = {"next": None, "count": 12345}
+        for size in (1, 7, 4096):
+            stream = route_service.JSONAPIStream(self.chunks(document, size))
+            self.assertListEqual(document["data"], list(stream), f"Elements differ when read {size} bytes at a time")
+            self.assertDictEqual(document["links"], stream.members["links"], "Other members were not decoded")
+            self.assertDictEqual(document["jsonapi"], stream.members["jsonapi"], "Other members were not decoded")
+
+    def test_incremental(self):
+        chunks = self.chunks(RED_STOP_RESPONSE, 64)
+        read = []
+
+        def reader():
+            for chunk in chunks:
+                read.append(chunk)
+                yield chunk
+
+        first = next(iter(route_service.JSONAPIStream(reader())))
+        self.assertEqual(RED_STOP_RESPONSE["data"][0], first, "Unexpected first element")
+        self.assertLess(len(read), len(chunks) // 4, "The first element was not yielded until most of the document was read")
+
+    def test_empty(self):
+        self.assertListEqual([], list(route_service.JSONAPIStream(self.chunks(ROUTE_RESPONSE, 3))), "Unexpected elements")
+
+    def test_missing_data(self):
+        self.assertRaises(KeyError, list, route_service.JSONAPIStream(self.chunks({"jsonapi": {}}, 3)))
+        self.assertRaises(KeyError, list, route_service.JSONAPIStream(self.chunks({}, 3)))
+
+    def test_malformed(self):
+        self.assertRaises(ValueError, list, route_service.JSONAPIStream([b'{"data": [{"id": 1}, {"id": 2']))
+        self.assertRaises(ValueError, list, route_service.JSONAPIStream([b'{"data": [{"id": 1}} ']))
+        self.assertRaises(ValueError, list, route_service.JSONAPIStream([b'[]']))
+        self.assertRaises(ValueError, list, route_service.JSONAPIStream([b'{"data": {"id": 1}}']))
+        self.assertRaises(ValueError, list, route_service.JSONAPIStream([b'{"data": []} {"data": []}']))
+        self.assertRaises(ValueError, list, route_service.JSONAPIStream([b'{"data": [1.]}']))
+
+    def test_split_numbers(self):
+        for chunks, expected in (
+                ([b'{"data": [42.', b'316]}'], [42.316]), ([b'{"data": [1', b'e', b'-3, -', b'7]}'], [1e-3, -7]),
+                ([b'{"data": [12', b'34]}'], [1234]), ([b'{"data": [true', b']}'], [True])
+        ):
+            self.assertListEqual(expected, list(route_service.JSONAPIStream(chunks)), f"Number split as {chunks} was misread")
+
+
+class TestNetworkCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = route_service.NetworkCache(self.directory.name, ttl=60)
+        self.route_path = f"{route_service.MBTARouteService.base_url}{route_service.MBTARouteService.route_path}"
+        self.stop_path = f"{route_service.MBTARouteService.base_url}{route_service.MBTARouteService.stop_path}"
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def load_network(self, service):
+        with responses.RequestsMock() as response:
+            route_response = copy.deepcopy(ROUTE_RESPONSE)
+            route_response["data"].extend([RED_ROUTE, GREEN_B_ROUTE, MATTAPAN_ROUTE])
+            response.add(responses.GET, self.route_path, json=route_response)
+            for route, stop_response in ((RED_ROUTE, RED_STOP_RESPONSE), (GREEN_B_ROUTE, GREEN_B_STOP_RESPONSE), (MATTAPAN_ROUTE, MATTAPAN_STOP_RESPONSE)):
+                response.add(
+                    responses.GET, self.stop_path,
+                    match=[responses.matchers.query_param_matcher({"filter[route]": route["id"]})],
+                    json=stop_response
+                )
+            service.load()
+
+    def test_warm_start(self):
+        self.load_network(route_service.MBTARouteService(cache=self.cache))
+        service = route_service.MBTARouteService(cache=self.cache)
+        with responses.RequestsMock():  # any request would fail
+            trip = service.trip(service.stop("Ashmont"), service.stop("Arlington"))
+            self.assertListEqual([service.route("Red Line"), service.route("Green Line B")], trip, "Expected trip was not produced!")
+            stop_ids = set(s["id"] for s in RED_STOP_RESPONSE["data"] + GREEN_B_STOP_RESPONSE["data"] + MATTAPAN_STOP_RESPONSE["data"])
+            self.assertEqual(len(stop_ids), len(service.stops), "Unexpected number of stops")
+            ashmont = service.stop("Ashmont")
+            expected = route_service.MBTAStop(next(s for s in RED_STOP_RESPONSE["data"] if s["id"] == ashmont.id))
+            for attribute in route_service.MBTAStop.__slots__:
+                if attribute != "routes":
+                    self.assertEqual(getattr(expected, attribute), getattr(ashmont, attribute), f"Cached stop {attribute} differs")
+
+    def test_key(self):
+        self.load_network(route_service.MBTARouteService(cache=self.cache))
+        service = route_service.MBTARouteService(cache=self.cache, route_types=[route_service.RouteTypes.BUS])
+        self.assertIsNone(self.cache.read(service.cache_key), "Networks with different route types share a cache entry")
+
+    def test_expired(self):
+        self.load_network(route_service.MBTARouteService(cache=self.cache))
+        self.cache.ttl = -1
+        service = route_service.MBTARouteService(cache=self.cache)
+        self.assertIsNone(self.cache.read(service.cache_key), "Expired network was read")
+        self.load_network(service)
+
+    def test_refresh(self):
+        self.load_network(route_service.MBTARouteService(cache=self.cache))
+        service = route_service.MBTARouteService(cache=self.cache)
+        with responses.RequestsMock() as response:
+            route_response = copy.deepcopy(ROUTE_RESPONSE)
+            route_response["data"].append(MATTAPAN_ROUTE)
+            response.add(responses.GET, self.route_path, json=route_response)
+            response.add(responses.GET, self.stop_path, json=MATTAPAN_STOP_RESPONSE)
+            service.load(use_cache=False)
+        self.assertEqual(1, len(service.routes), "Refresh did not replace the network")
+        self.assertEqual(1, len(route_service.MBTARouteService(cache=self.cache).routes), "Refresh did not replace the cached network")
+
+    def test_revalidate(self):
+        routes_and_stops = ((RED_ROUTE, RED_STOP_RESPONSE), (GREEN_B_ROUTE, GREEN_B_STOP_RESPONSE), (MATTAPAN_ROUTE, MATTAPAN_STOP_RESPONSE))
+        route_response = copy.deepcopy(ROUTE_RESPONSE)
+        route_response["data"].extend([RED_ROUTE, GREEN_B_ROUTE, MATTAPAN_ROUTE])
+        with responses.RequestsMock() as response:
+            response.add(responses.GET, self.route_path, json=route_response, headers={"ETag": '"routes-1"'})
+            for route, stop_response in routes_and_stops:
+                response.add(
+                    responses.GET, self.stop_path, json=stop_response,
+                    headers={"ETag": f'"{route["id"]}-1"', "Last-Modified": "Mon, 02 Oct 2023 12:00:00 GMT"},
+                    match=[responses.matchers.query_param_matcher({"filter[route]": route["id"]})],
+                )
+            route_service.MBTARouteService(cache=self.cache).load()
+
+        changed_mattapan_stops = copy.deepcopy(MATTAPAN_STOP_RESPONSE)
+        changed_mattapan_stops["data"] = changed_mattapan_stops["data"][:2]
+        service = route_service.MBTARouteService(cache=self.cache)
+        with responses.RequestsMock() as response:
+            response.add(
+                responses.GET, self.route_path, status=304, match=[responses.matchers.header_matcher({"If-None-Match": '"routes-1"'})]
+            )
+            for route, stop_response in routes_and_stops[:2]:
+                response.add(
+                    responses.GET, self.stop_path, status=304,
+                    match=[
+                        responses.matchers.query_param_matcher({"filter[route]": route["id"]}),
+                        responses.matchers.header_matcher({
+                            "If-None-Match": f'"{route["id"]}-1"', "If-Modified-Since": "Mon, 02 Oct 2023 12:00:00 GMT"
+                        })
+                    ],
+                )
+            response.add(
+                responses.GET, self.stop_path, json=changed_mattapan_stops, headers={"ETag": '"Mattapan-2"'},
+                match=[responses.matchers.query_param_matcher({"filter[route]": "Mattapan"})],
+            )
+            service.load(use_cache=False)
+
+        self.assertEqual(3, len(service.routes), "Unmodified routes were not reused")
+        self.assertSetEqual(
+            set(stop["id"] for stop in RED_STOP_RESPONSE["data"]), set(stop.id for stop in service.route("Red Line").stops),
+            "Unmodified stops were not reused"
+        )
+        self.assertEqual(2, len(service.route("Mattapan Trolley").stops), "Modified stops were not updated")
+        trip = service.trip(service.stop("Ashmont"), service.stop("Arlington"))
+        self.assertListEqual([service.route("Red Line"), service.route("Green Line B")], trip, "Expected trip was not produced!")
+        validators = self.cache.read(service.cache_key).validators
+        self.assertIn({"etag": '"Mattapan-2"'}, validators.values(), "New validators were not saved")
+        self.assertIn({"etag": '"routes-1"'}, validators.values(), "Unmodified validators were not kept")
+
+    def test_clear(self):
+        service = route_service.MBTARouteService(cache=self.cache)
+        self.load_network(service)
+        self.assertIsNotNone(self.cache.read(service.cache_key), "Network was not cached")
+        self.cache.clear()
+        self.assertIsNone(self.cache.read(service.cache_key), "Cache was not cleared")
+
+    def test_warm_start_imports(self):
+        self.load_network(route_service.MBTARouteService(cache=self.cache))
+        script = (
+            "import sys, route_service\n"
+            f"service = route_service.MBTARouteService(cache=route_service.NetworkCache({self.directory.name!r}))\n"
+            "print(service.trip(service.stop('Ashmont'), service.stop('Arlington')))\n"
+            "print(sorted(name for name in ('requests', 'urllib3', 'logging') if name in sys.modules))\n"
+        )
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual("", result.stderr, "Warm start failed")
+        self.assertEqual("[MBTARoute(Red Line), MBTARoute(Green Line B)]\n[]\n", result.stdout, "Warm start imported the HTTP stack or logging")
+
+    def test_lazy_restore(self):
+        self.load_network(route_service.MBTARouteService(cache=self.cache))
+        snapshot = self.cache.read(route_service.MBTARouteService(cache=self.cache).cache_key)
+        made = []
+        network = snapshot.network(lambda route: made.append(route["id"]) or route_service.MBTARoute(route), route_service.MBTAStop)
+        self.assertListEqual([], made, "Routes were made before they were used")
+        self.assertEqual("Red", network.route("Red Line").id, "Route was not found by name")
+        self.assertListEqual(["Red"], made, "Routes other than the one used were made")
+        ashmont = network.stop("Ashmont")
+        self.assertIs(ashmont, network.stop(ashmont.id), "Stop was made twice")
+        self.assertIn(network.route("Red"), ashmont.routes, "Restored stop is not on its route")
+        trip = [network.routes[route].id for route in network.trip(ashmont._index, network.stop("Arlington")._index)]
+        self.assertListEqual(["Red", "Green-B"], trip, "Restored network plans the wrong trip")
+
+    def test_snapshot_format(self):
+        service = route_service.MBTARouteService(cache=self.cache)
+        self.load_network(service)
+        with open(self.cache.path(service.cache_key), "rb") as cache_file:
+            data = cache_file.read()
+        snapshot = route_service.NetworkSnapshot.loads(data)
+        self.assertEqual(service.cache_key, snapshot.key, "Snapshot key was not saved")
+        for name in route_service.Network._arrays:
+            self.assertEqual(list(getattr(service.network, name)), list(snapshot.arrays[name]), f"{name} was not saved")
+        self.assertListEqual(service.network.stop_labels, snapshot.stop_labels, "Stop names were not saved")
+        self.assertDictEqual(service.stop("Ashmont").as_json(), snapshot.stop_json(service.network.stop_ids[service.stop("Ashmont").id]), "Stop was not saved")
+        for corrupt in (data[:-1], data[:20], b"RTSNAPSH" + b"\x02" + data[9:], b"{" + data[1:]):
+            with self.assertRaises(ValueError, msg="Corrupt snapshot was loaded"):
+                route_service.NetworkSnapshot.loads(corrupt)
+
+    def test_corrupt(self):
+        service = route_service.MBTARouteService(cache=self.cache)
+        os.makedirs(self.directory.name, exist_ok=True)
+        with open(self.cache.path(service.cache_key), "w") as cache_file:
+            cache_file.write("{")
+        self.assertIsNone(self.cache.read(service.cache_key), "Corrupt network was read")
+        self.load_network(service)
+
+
+class TestRouteServer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.routes, self.stops = mesh_network(60, 5)
+        route_service.Network(self.routes, [list(route.stops) for route in self.routes])
+        self.route_service = StaticRouteService(self.routes)
+        self.server = self.start(route_service.RouteServer(self.route_service, "127.0.0.1:0"))
+        self.client = route_service.RouteClient(self.server.address, timeout=10)
+
+    def tearDown(self) -> None:
+        self.client.close()
+        self.server.shutdown()
+        self.thread.join(10)
+
+    def start(self, server):
+        self.thread = threading.Thread(target=server.run, daemon=True)
+        self.thread.start()
+        self.assertTrue(server.ready.wait(10), "Server did not start")
+        return server
+
+    def ids(self, trip):
+        return [route.id for route in trip]
+
+    def test_trip(self):
+        here, there = self.client.stop("stop-0-1"), self.client.stop("stop-21-1")
+        self.assertEqual("stop-0-1", here.id, "Stop was not found")
+        expected = self.route_service.trip(self.stops[0][1], self.stops[21][1])
+        trip = self.client.trip(here, there)
+        self.assertListEqual(self.ids(expected), self.ids(trip), "Remote trip differs")
+        self.assertEqual(str(expected[0]), str(trip[0]), "Remote route has the wrong name")
+
+    def test_pipelined_trips(self):
+        pairs = [(self.stops[i % 60][i % 5], self.stops[(i * 7) % 60][(i * 3) % 5]) for i in range(1000)]
+        remote_pairs = [(route_service.RemoteStop(h.id, str(h)), route_service.RemoteStop(t.id, str(t))) for h, t in pairs]
+        remote_pairs[10] = ("here", "there")
+        expected = [self.ids(trip) for trip in self.route_service.trips(pairs)]
+        expected[10] = []
+        self.assertListEqual(expected, [self.ids(trip) for trip in self.client.trips(remote_pairs)], "Pipelined trips differ")
+
+    def test_lookups(self):
+        self.assertIsNone(self.client.stop("nowhere"), "Unknown stop was found")
+        self.assertEqual("route-7", self.client.route("route-7").id, "Route was not found")
+        self.assertEqual("stop-12-3", self.client.stop_candidates("stop 12 3", 1)[0][0].id, "Stop candidates differ")
+        self.assertListEqual(["stop-59-0", "stop-59-1"], self.client.stop_index.complete("STOP-59", 2), "Stop names differ")
+
+    def test_network(self):
+        self.assertSetEqual(set(r.id for r in self.routes), set(r.id for r in self.client.routes), "Routes differ")
+        for route in self.client.routes:
+            expected = set(stop.id for stop in self.route_service.route(route.id).stops)
+            self.assertSetEqual(expected, set(stop.id for stop in route.stops), f"{route} has the wrong stops")
+
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "pairs.csv")
+            with open(path, "w") as pairs:
+                pairs.write("stop-0-1,stop-21-1\nstop-3-3,nowhere\n")
+            expected, remote = io.StringIO(), io.StringIO()
+            route_service.batch_trips(self.route_service, path, output=expected)
+            route_service.batch_trips(self.client, path, output=remote)
+        self.assertEqual(expected.getvalue(), remote.getvalue(), "Batch through the server differs")
+
+    def test_pipelined_errors(self):
+        requests = [{"op": "stop", "key": "stop-0-1"}, {"op": "unknown"}, {"op": "stop", "key": "stop-4-4"}, {"op": "unknown"}]
+        with self.assertRaises(route_service.RouteServiceException):
+            list(self.client._requests(requests))
+        self.assertEqual("stop-4-4", self.client.stop("stop-4-4").id, "Responses of the failed batch were left unread")
+        self.assertEqual("route-2", self.client.route("route-2").id, "Responses of the failed batch were left unread")
+
+    def test_malformed_requests(self):
+        host, port = self.server.address.rsplit(":", 1)
+        with socket.create_connection((host, int(port)), timeout=10) as connection:
+            connection.sendall(b'{"op": "fly", "id": 1}\nnot json\n{"op": "stop", "key": "stop-0-0", "id": 3}\n')
+            responses = connection.makefile("rb")
+            self.assertIn("Unknown operation", json.loads(responses.readline())["error"], "Unknown operation was answered")
+            self.assertIn("Malformed request", json.loads(responses.readline())["error"], "Malformed request was answered")
+            self.assertDictEqual({"stop": ["stop-0-0", "stop-0-0"], "id": 3}, json.loads(responses.readline()), "Connection did not survive errors")
+
+    def test_unknown_stop(self):
+        with self.assertRaisesRegex(route_service.RouteServiceException, 'Unable to find the stop "Nowhere"'):
+            self.client.trip(route_service.Stop("stop-0-1"), route_service.Stop("Nowhere"))
+        self.assertTrue(self.client.trip(self.client.stop("stop-0-1"), self.client.stop("stop-21-1")), "Connection did not survive the error")
+
+    def test_unix_socket(self):
+        with tempfile.TemporaryDirectory() as directory:
+            server = route_service.RouteServer(self.route_service, os.path.join(directory, "routes.sock"))
+            thread = threading.Thread(target=server.run, daemon=True)
+            thread.start()
+            self.assertTrue(server.ready.wait(10), "Server did not start")
+            with route_service.RouteClient(server.address, timeout=10) as client:
+                self.assertEqual("stop-4-4", client.stop("stop-4-4").id, "Stop was not found over a Unix socket")
+            server.shutdown()
+            thread.join(10)
+
+    def test_connection_refused(self):
+        self.server.shutdown()
+        self.thread.join(10)
+        with self.assertRaises(route_service.RouteServiceException):
+            self.client.stop("stop-0-0")
+
+    def test_metrics(self):
+        metrics = route_service.MetricsRegistry()
+        server = route_service.RouteServer(self.route_service, "127.0.0.1:0", metrics=metrics)
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        self.assertTrue(server.ready.wait(10), "Server did not start")
+        try:
+            with route_service.RouteClient(server.address, timeout=10) as client:
+                client.trip(client.stop("stop-0-1"), client.stop("stop-21-1"))
+            host, port = server.address.rsplit(":", 1)
+            with socket.create_connection((host, int(port)), timeout=10) as connection:
+                connection.sendall(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+                response = b"".join(iter(lambda: connection.recv(65536), b""))
+            with socket.create_connection((host, int(port)), timeout=10) as connection:
+                connection.sendall(b"GET / HTTP/1.1\r\n\r\n")
+                missing = b"".join(iter(lambda: connection.recv(65536), b""))
+        finally:
+            server.shutdown()
+            thread.join(10)
+        headers, body = response.split(b"\r\n\r\n", 1)
+        self.assertTrue(headers.startswith(b"HTTP/1.1 200"), "Metrics were not served")
+        self.assertIn(b"text/plain; version=0.0.4", headers, "Metrics are not in the Prometheus text format")
+        self.assertIn(b'route_service_server_request_duration_seconds_count{op="trip"} 1', body, "Trip request was not recorded")
+        self.assertIn(b'route_service_server_request_duration_seconds_count{op="stop"} 2', body, "Stop requests were not recorded")
+        self.assertTrue(missing.startswith(b"HTTP/1.1 404"), "Unknown path was answered")
+
+    def test_warm_trips(self):
+        here, there = self.client.stop("stop-0-1"), self.client.stop("stop-33-1")
+        expected = self.ids(self.client.trip(here, there))
+        connection = self.client._socket
+        for _ in range(200):
+            self.assertListEqual(expected, self.ids(self.client.trip(here, there)), "Repeated trip differs")
+        self.assertIs(connection, self.client._socket, "Trips did not share the client's connection")
+
+
+class TestImportTime(unittest.TestCase):
+    # Modules only some code paths need, which must not be imported with route_service
+    DEFERRED = ("requests", "urllib3", "json", "logging", "email.utils", "concurrent.futures", "hashlib", "tempfile", "argparse", "numpy", "mmap")
+    # Share of the time importing requests (measured in the same process) importing route_service's dependencies may
+    # take, excluding route_service itself (whose time depends on whether bytecode is cached), so the budget scales
+    # with the machine but the HTTP stack alone does not fit
+    BUDGET_SHARE = 0.5
+
+    def test_import_time(self):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import route_service; import requests"], capture_output=True,
+            text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        self.assertEqual(0, result.returncode, result.stderr)
+        # Each module is listed after the modules it imported, so route_service's follow the last module imported before
+        imports, requests_time = {}, None
+        for line in result.stderr.splitlines():
+            if line.startswith("import time:") and "self [us]" not in line:
+                self_time, cumulative, name = line[len("import time:"):].split("|")
+                if "route_service" in imports:
+                    if name.strip() == "requests":
+                        requests_time = int(cumulative)
+                    continue
+                imports[name.strip()] = (int(self_time), int(cumulative))
+                if name.strip() != "route_service" and not name.startswith("  "):  # imported before route_service (by site)
+                    imports = {}
+        self.assertIn("route_service", imports, "route_service was not imported")
+        for name in self.DEFERRED:
+            self.assertNotIn(name, imports, f"Importing route_service imported {name}")
+        self.assertIsNotNone(requests_time, "requests was not imported")
+        self_time, cumulative = imports["route_service"]
+        self.assertLess(
+            cumulative - self_time, self.BUDGET_SHARE * requests_time,
+            f"Importing route_service's dependencies took {cumulative - self_time}us, requests {requests_time}us"
+        )
+
+
+class TestAsyncMBTARouteService(unittest.IsolatedAsyncioTestCase):
+    def fake_server(self, throttled=()):
+        return fake_mbta_server(
+            ((RED_ROUTE, RED_STOP_RESPONSE), (GREEN_B_ROUTE, GREEN_B_STOP_RESPONSE), (MATTAPAN_ROUTE, MATTAPAN_STOP_RESPONSE)),
+            throttled=throttled
+        )
+
+    def async_route_service(self, server, workers=2):
+        service = route_service.AsyncMBTARouteService(workers=workers)
+        service.base_url = server.base_url
+        return service
+
+    async def test_load(self):
+        with self.fake_server() as server:
+            service = self.async_route_service(server)
+            self.assertFalse(service.loaded, "Service loaded before load()")
+            self.assertRaises(route_service.RouteServiceException, lambda: service.routes)
+            await service.load()
+            await service.load()
+        self.assertEqual(4, server.stats["requests"], "Expected one route request and one stop request per route")
+        self.assertEqual(3, len(service.routes), "Unexpected number of routes")
+        stop_ids = set(s["id"] for s in RED_STOP_RESPONSE["data"] + GREEN_B_STOP_RESPONSE["data"] + MATTAPAN_STOP_RESPONSE["data"])
+        self.assertEqual(len(stop_ids), len(service.stops), "Unexpected number of stops")
+
+    async def test_refresh(self):
+        with self.fake_server() as server:
+            service = self.async_route_service(server)
+            self.assertRaises(route_service.RouteServiceException, service.refresh)
+            await service.load()
+            self.assertRaises(route_service.RouteServiceException, service.refresh)
+            self.assertRaises(route_service.RouteServiceException, service.subscribe)
+            self.assertRaises(route_service.RouteServiceException, route_service.NetworkRefresher, service)
+            await service.load(reload=True)
+        self.assertEqual(8, server.stats["requests"], "Expected the network to be requested again by load(reload=True)")
+
+    async def test_trip(self):
+        with self.fake_server() as server:
+            service = self.async_route_service(server)
+            ashmont = await service.stop("Ashmont")
+            arlington = await service.stop("Arlington")
+            trip = await service.trip(ashmont, arlington)
+        self.assertListEqual([await service.route("Red Line"), await service.route("Green Line B")], trip, "Expected trip was not produced!")
+
+    async def test_retry_429(self):
+        with self.fake_server(throttled={"Red", "Mattapan"}) as server:
+            service = self.async_route_service(server, workers=3)
+            await service.load()
+        self.assertEqual(6, server.stats["requests"], "Rate limited requests were not retried")
+        self.assertIsNotNone(await service.stop("Alewife"), "Red Line stops were not loaded after a retry")
+
+    async def test_timings(self):
+        timings = route_service.PhaseTimings()
+        with self.fake_server(throttled={"Red"}) as server:
+            service = route_service.AsyncMBTARouteService(workers=2, timings=timings)
+            service.base_url = server.base_url
+            await service.trip(await service.stop("Ashmont"), await service.stop("Arlington"))
+        for phase in ("http", "backoff", "decode", "construct", "assemble", "plan"):
+            self.assertIn(phase, timings.stats(), f"{phase} was not timed")
+        self.assertEqual(4, timings.stats()["decode"]["calls"], "Expected one decoded response per request")
+
+    async def test_metrics(self):
+        metrics = route_service.MetricsRegistry()
+        with self.fake_server(throttled={"Red"}) as server:
+            service = route_service.AsyncMBTARouteService(workers=2, metrics=metrics)
+            service.base_url = server.base_url
+            await service.trip(await service.stop("Ashmont"), await service.stop("Arlington"))
+        self.assertEqual(3, metrics.get("route_service_http_request_duration_seconds").count(endpoint="/stops", status=200), "Stop requests were not recorded")
+        self.assertEqual(1, metrics.get("route_service_http_retries_total").value(endpoint="/stops", reason="429"), "429 was not counted")
+        self.assertEqual(1, metrics.get("route_service_trip_duration_seconds").count(), "Trip was not recorded")
+
+    async def test_status_404(self):
+        with self.fake_server() as server:
+            service = self.async_route_service(server)
+            service.route_path = "/missing"
+            with self.assertRaises(route_service.RouteServiceHttpException):
+                await service.load()